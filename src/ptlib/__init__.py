@@ -24,7 +24,7 @@ from ptlib import errors
 from ptlib.core.api import (
     JobSpec, Job,
     Queue,
-    EmptyTask, Task,
+    EmptyTask, Task, AsyncTask,
     Worker,
     Controller
 )  # move to bottom
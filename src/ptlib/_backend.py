@@ -1,5 +1,3 @@
-from time import time_ns
-
 #################### BACKEND CONFIGURATION ####################
 """
 This file contains backend configurations for several objects, where 
@@ -7,13 +5,51 @@ each class corresponds to the name of a file script in the package.
 """
 
 
+class _QUEUE:
+    CACHE_LINE_NBYTES = 64  # keeps producer and consumer counters apart
+    ARENA_FRACTION = 0.25   # slots whose largest ragged subjobs fit the arena
+    SPIN_COUNT = 50         # tries before a waiting endpoint yields the core
+    YIELD_COUNT = 5         # ... and yields before it sleeps on a semaphore
+    PARK_NS = 50_000        # jobs this far apart are waited for by spinning
+    MAX_SPIN_NS = 200_000   # longest time an auto-tuned endpoint spins
+
+
+class _CONTROLLER:
+    META_FLUSH_INTERVAL = 0.1  # seconds between metadata updates when idle
+    START_METHOD = "spawn"     # or "forkserver" or "fork" (not on Windows)
+    PRELOAD_MODULES = ["numpy", "ptlib"]  # imported once by the forkserver
+    AUTOSCALE_INTERVAL = 0.5   # seconds between autoscaling decisions
+    SCALE_UP_FILL = 0.75       # input queue fill above which a task may grow
+    SCALE_DOWN_FILL = 0.25     # input queue fill below which a task may shrink
+    SCALE_UP_BUSY = 0.8        # fraction of time workers must spend on jobs
+    SCALE_DOWN_BUSY = 0.5      # ... or may spend on jobs to shrink the task
+    SCALE_PATIENCE = 2         # consecutive decisions needed before scaling
+    RETIRE_POLL_INTERVAL = 0.1  # seconds an idle scaled worker waits for a job
+    WAIT_TUNE_INTERVAL = 1.0   # seconds between tuning queue wait policies
+    METRICS_INTERVAL = 1.0     # seconds between publishing metrics
+
+
+class _AFFINITY:
+    NODE_DIR = "/sys/devices/system/node"  # NUMA topology (Linux only)
+
+
 class _METADATA:
-    JOB_SPEC_EXAMPLES = [[1, 1, 1], [time_ns(), time_ns()]]
-    QUEUE_MAX_SIZE = 30
+    RING_SIZE = 4096        # job timings buffered per worker between updates
+    SPILL_MANIFEST = "metadata.pkl"
+    HIST_SIGNIFICANT_BITS = 7  # job durations are kept to within 1.6%
+    HIST_MAX_BITS = 42      # ... up to 73 minutes
+
+
+class _EXPORTER:
+    HOST = "127.0.0.1"      # metrics are only served to this machine
+    PREFIX = "ptlib"        # prefix of every metric name
+    BUCKETS_NS = tuple(1000 * 4 ** i for i in range(14))  # 1 us - 67 s
 
 
 class _DIAGRAM:
     PTD_SPACING = 1.5
     CONSOLE_WIDTH = 100
     TIME_DIV = 1e9          # Nanoseconds
+    STATS_CHUNK_SIZE = 1 << 20  # jobs loaded at once from spilled metadata
+    PERCENTILES = (50, 99, 99.9)  # of the job durations of each task
 ###############################################################
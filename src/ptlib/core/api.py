@@ -1,5 +1,5 @@
 from ptlib.core.job import JobSpec, Job
 from ptlib.core.queue import Queue
-from ptlib.core.task import EmptyTask, Task
+from ptlib.core.task import EmptyTask, Task, AsyncTask
 from ptlib.core.worker import Worker
 from ptlib.core.controller import Controller
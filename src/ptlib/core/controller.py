@@ -1,18 +1,51 @@
+import os
 import multiprocessing as mp
+from multiprocessing.connection import wait
+from pickle import dump, load
+from time import time_ns
 
+import ptlib._backend as ptconfig
+from ptlib.core.job import Job
 from ptlib.core.metadata import MetadataManager
-from ptlib.core.task import Task, EmptyTask
-from ptlib.core.queue import Queue
+from ptlib.core.task import Task
+from ptlib.core.queue import Queue, FIFOQueue, ArenaQueue, JoinQueue, \
+    OrderedQueue
+from ptlib.utils import affinity
 from ptlib.utils.diagram import Diagram
+from ptlib.utils.exporter import MetricsExporter
 
 
 class Controller:
     """ The controller. *** COME BACK *** """
 
+    # autoscaling thresholds (see `_autoscale`)
+    AUTOSCALE_INTERVAL = ptconfig._CONTROLLER.AUTOSCALE_INTERVAL
+    SCALE_UP_FILL = ptconfig._CONTROLLER.SCALE_UP_FILL
+    SCALE_DOWN_FILL = ptconfig._CONTROLLER.SCALE_DOWN_FILL
+    SCALE_UP_BUSY = ptconfig._CONTROLLER.SCALE_UP_BUSY
+    SCALE_DOWN_BUSY = ptconfig._CONTROLLER.SCALE_DOWN_BUSY
+    SCALE_PATIENCE = ptconfig._CONTROLLER.SCALE_PATIENCE
+
+    # wait policy tuning (see `_tune_waits`)
+    WAIT_TUNE_INTERVAL = ptconfig._CONTROLLER.WAIT_TUNE_INTERVAL
+    PARK_NS = ptconfig._QUEUE.PARK_NS
+    MAX_SPIN_NS = ptconfig._QUEUE.MAX_SPIN_NS
+
+    # seconds between publishing metrics (see `metrics_port`)
+    METRICS_INTERVAL = ptconfig._CONTROLLER.METRICS_INTERVAL
+
     def __init__(self,
                  pipeline: Task,
                  queue_max_size: int = 5,
-                 total_jobs: int = None):
+                 total_jobs: int = None,
+                 meta_flush_interval: float = ptconfig._CONTROLLER.META_FLUSH_INTERVAL,
+                 spill_dir: str = None,
+                 spec_cache: str = None,
+                 persistent: bool = False,
+                 start_method: str = ptconfig._CONTROLLER.START_METHOD,
+                 metrics_port: int = None,
+                 metrics_path: str = None,
+                 trace: bool = False):
         """
         Parameters:
             pipeline: ptlib.Task
@@ -24,56 +57,208 @@ class Controller:
                 runtime analytics, not computation. Can be passed as an 
                 argument or set by overloading the `Task.get_total_jobs` 
                 function in the first task of `pipeline`.
+            meta_flush_interval: (optional) float
+                The longest time in seconds that the controller sleeps 
+                between metadata updates. The controller also wakes up when 
+                a worker exits or a worker's timing ring is half full.
+            spill_dir: (optional) str
+                If given, job timings are appended to files in this 
+                directory as they are collected instead of being kept in 
+                memory. Open them with `ptlib.utils.diagram.Diagram.from_spill`.
+            spec_cache: (optional) str
+                If given, the output job structure of each task is stored in 
+                this file and reused by later runs instead of being inferred 
+                (see `Task.output_spec`). Delete the file after changing the 
+                output of a task.
+            persistent: (optional) bool
+                If True, workers stay alive between runs and the queues are 
+                reused, so `run` can be called repeatedly without starting 
+                new processes. Call `close` to stop the workers.
+            start_method: (optional) str
+                How worker processes are started: "spawn", "forkserver" or 
+                "fork" (see `multiprocessing`). The forkserver imports numpy, 
+                ptlib and the modules of every task once, so each worker 
+                starts without importing them again.
+            metrics_port: (optional) int
+                If given, metrics such as the throughput and busy ratio of 
+                each task and worker, the depth of each queue and histograms 
+                of job durations are served on this port of localhost in the 
+                Prometheus text format while `run` is executing (see 
+                `ptlib.utils.exporter.MetricsExporter`). They are updated 
+                every `METRICS_INTERVAL` seconds. The port is served until 
+                the end of `run`, or until `close` if `persistent` is True.
+            metrics_path: (optional) str
+                If given, the same metrics are written to this file instead 
+                (or as well), e.g. for the textfile collector of 
+                node_exporter.
+            trace: (optional) bool
+                If True, every job carries its origin time and the time it 
+                was put in each queue (see `ptlib.core.queue.FIFOQueue.trace`), 
+                so the latency of jobs is split into the time they wait in 
+                queues and the time they are mapped at each task (see 
+                `ptlib.utils.diagram.Diagram.get_trace_stats`).
         """
 
-        # for process start method to spawn correctly
-        mp.set_start_method("spawn", force=True)
+        # set process start method (the forkserver is only started once, so
+        # modules are preloaded by the first controller that uses it)
+        if start_method == "forkserver":
+            mp.set_forkserver_preload(self._get_preload_modules(pipeline))
+        mp.set_start_method(start_method, force=True)
 
         # get the number of jobs intended to be processed by the pipeline
         total_jobs = total_jobs or pipeline.get_total_jobs()
 
         # create metadata manager before tasks are set up
-        self.meta_manager = MetadataManager(pipeline, total_jobs)
+        self.meta_manager = MetadataManager(pipeline, total_jobs, spill_dir)
 
         # store initialization arguments
         self.pipeline = pipeline
         self.queue_max_size = queue_max_size
+        self.meta_flush_interval = meta_flush_interval
+        self.spec_cache = spec_cache
+        self.persistent = persistent
+        self.trace = trace
+
+        # publish metrics while running
+        self._exporter = None
+        if metrics_port is not None or metrics_path is not None:
+            self._exporter = MetricsExporter(metrics_port, metrics_path)
 
         # set up tasks
         self._set_up_tasks()
 
-    def run(self):
+        # time of one spin of a waiting endpoint (see `_tune_waits`)
+        self._spin_ns = FIFOQueue._time_try_acquire()
+
+        # pin workers to cores and allocate their input jobs nearby
+        self._place_workers()
+
+        # give workers a pipe to start each run
+        if persistent:
+            for task in self.pipeline.iter_tasks():
+                task._make_persistent()
+
+    def run(self, inputs=None):
         """ 
-        The main run loop for the pipeline. 
+        The main run loop for the pipeline. `inputs` is passed to 
+        `Task.reset` in every worker before it starts processing jobs.
         """
 
         # set start time
         self.meta_manager.set_time()
 
-        # start all worker processes
-        for task in self.pipeline.iter_tasks():
-            task._start_workers()
+        # start a run of all worker processes (before any worker threads, so
+        # that forked processes do not inherit running threads)
+        for task in sorted(self.pipeline.iter_tasks(),
+                           key=lambda task: task.THREADED):
+            task._start_workers(inputs)
+
+        # only count the jobs of this run towards autoscaling and tuning
+        self.meta_manager._busy.clear()
+        self.meta_manager._num_jobs.clear()
+        self._scale_time = self._tune_time = self._metrics_time = time_ns()
+
+        running = list(self.pipeline.iter_tasks())
+        while running:
+            # sleep until a worker of a running task finishes, metadata is
+            # ready, or the flush interval passes
+            wait(sum([task._get_handles() for task in running], []) +
+                 [self.meta_manager.meta_rings.ready],
+                 timeout=self.meta_flush_interval)
 
-        task = self.pipeline
-        while task is not EmptyTask:
             # update metadata
             self.meta_manager.update()
 
-            # if current task finishes, send kill signal to workers
-            if not task._workers_running():
+            # add or retire workers of autoscaled tasks
+            if time_ns() - self._scale_time >= self.AUTOSCALE_INTERVAL * 1e9:
+                self._autoscale(running)
+
+            # adapt how workers wait on the queues to the rate of jobs
+            if time_ns() - self._tune_time >= self.WAIT_TUNE_INTERVAL * 1e9:
+                self._tune_waits(running)
+
+            if self._exporter is not None and \
+                    time_ns() - self._metrics_time >= self.METRICS_INTERVAL * 1e9:
+                self._export_metrics()
+
+            for task in list(running):
+                if task._workers_running():
+                    continue
+
                 print(f"Task Finished: {task.name}")
-                task = task.next
-                task._kill_workers()
+                running.remove(task)
+
+                # once every task that a task follows finishes, send kill
+                # signal to its workers
+                for child in task.children:
+                    if not any(parent in running for parent in child.parents):
+                        child._kill_workers()
+
+        # empty and reopen the queues closed by this run for the next one
+        if self.persistent:
+            for task in self.pipeline.iter_tasks():
+                task.input_q._reopen()
 
         # finish retreiving metadata (in case loop exits before getting all metadata)
         self.meta_manager.update()
 
+        # the controller fell too far behind to keep every job timing
+        if (num_dropped := sum(self.meta_manager._dropped.values())) > 0:
+            print(f"Warning: {num_dropped} job timings were dropped")
+
         # set finish time
         self.meta_manager.set_time()
 
+        # publish the final metrics of the run
+        if self._exporter is not None:
+            self._export_metrics()
+
+        # a pipeline that is not persistent collects no more metadata and
+        # stops publishing metrics
+        if not self.persistent:
+            self.meta_manager.close()
+            if self._exporter is not None:
+                self._exporter.close()
+
         print(self.meta_manager._meta)
         print("controller done")
 
+    def close(self):
+        """
+        Stops the workers of a persistent pipeline, which then run their 
+        cleanup routines, and stops publishing metrics. A pipeline that is 
+        not persistent was already closed at the end of `run`, so this only 
+        waits for its workers.
+        """
+
+        for task in self.pipeline.iter_tasks():
+            task._stop_workers()
+
+        # collect the final worker lifetimes
+        if self.persistent:
+            self.meta_manager.update()
+            self.meta_manager.set_time()
+            self.meta_manager.close()
+
+        if self._exporter is not None:
+            self._exporter.close()
+
+    def stats(self):
+        """
+        Returns a snapshot of the telemetry counters of the output queue of
+        each task that other tasks follow (see `FIFOQueue.get_stats`), as a
+        dictionary where `stats[task id]` also holds the name of the task and
+        the time of the snapshot in nanoseconds. The counters are read
+        without locking, so this can be called from another thread at any
+        time (e.g. while `run` is running) without slowing down the workers.
+        Throughput is the change in `puts` between two snapshots.
+        """
+
+        now = time_ns()
+
+        return {task.id: dict(queue.get_stats(), task=task.name, time=now)
+                for task, queue in self._output_qs.items()}
+
     def graph(self, save_path=""):
         """
         Creates and shows parallel timing diagram. If `save_path` is empty, then 
@@ -90,41 +275,253 @@ class Controller:
         Sets up each task with the appropriate queue.
         """
 
-        # set default input job and fake input queue
-        input_job, input_q, = None, Queue()
+        # output job structure, example output job and output queue of each
+        # task that is followed by other tasks
+        job_specs, output_jobs, output_qs = dict(), dict(), dict()
 
+        # load output job structures from previous runs
+        cached_specs = self._load_spec_cache()
+
+        # (tasks are yielded after every task they follow)
         for task in self.pipeline.iter_tasks():
             print(f"Creating Task: {task.name} | ID: {task.id}")
 
-            # skip last task
-            if task.next is EmptyTask:
-                break
-
-            # try to infer output job structure and set output to input of next task
-            # input_job, job_specs = task._infer_structure(input_job)
-            job_specs, input_job = task._infer_structure(input_job)
-
-            # create and store output queue
-            output_q = Queue(job_specs, capacity=self.queue_max_size)
+            # set default input job and fake input queue for the first tasks,
+            # otherwise read from the output queue of each task it follows
+            if not task.parents:
+                input_specs, input_job, input_q = None, None, Queue()
+            elif len(task.parents) == 1:
+                parent, = task.parents
+                input_specs, input_job = job_specs[parent], output_jobs[parent]
+                input_q = self._get_reader(parent, task, output_qs)
+            else:
+                input_specs = [job_specs[parent] for parent in task.parents]
+                input_job = self._join_jobs(
+                    task, [output_jobs[parent] for parent in task.parents])
+                input_q = JoinQueue([self._get_reader(parent, task, output_qs)
+                                     for parent in task.parents],
+                                    task.REORDER_BUFFER_SIZE)
+
+            # the jobs to join arrive at a single worker
+            if len(task.parents) > 1 and task._get_max_workers() > 1:
+                raise ValueError(
+                    f"Task {task.name} joins several tasks, so it can only "
+                    "have one worker")
+
+            # reorder jobs for an ordered task
+            if task.ORDERED and task.parents:
+                if task._get_max_workers() > 1:
+                    raise ValueError(
+                        f"Ordered task {task.name} can only have one worker")
+                input_q = OrderedQueue(input_q, task.REORDER_BUFFER_SIZE)
 
             # set input queue of task (see method documentation for reason)
             task._set_input_queue(input_q)
 
+            # the last tasks have no output queue
+            if not task.children:
+                output_q = Queue()
+                task.create_workers(input_q, output_q,
+                                    self.meta_manager.meta_rings)
+                self._set_up_autoscaling(task, output_q)
+                continue
+
+            # try to infer output job structure
+            # (tasks are identified by their type, position, and input structure)
+            key = (task.ttype.__module__, task.ttype.__qualname__, task.id,
+                   task.MICRO_BATCH_SIZE, str(input_specs))
+            if key in cached_specs:
+                job_specs[task] = cached_specs[key]
+                output_jobs[task] = Job(job_specs[task])
+            else:
+                job_specs[task], output_jobs[task] = \
+                    task._infer_structure(input_job)
+                cached_specs[key] = job_specs[task]
+
+            # create and store output queue (lock-free if it links two workers,
+            # in-process if it links two threaded tasks, shared by every task
+            # that follows)
+            spsc = len(task.children) == 1 and task._get_max_workers() == 1 \
+                and task.children[0]._get_max_workers() == 1
+            local = len(task.children) == 1 and task.THREADED \
+                and task.children[0].THREADED
+            output_q = output_qs[task] = Queue(
+                job_specs[task], capacity=self.queue_max_size, spsc=spsc,
+                num_readers=len(task.children),
+                arena_nbytes=task.ARENA_NBYTES,
+                num_producers=task._get_max_workers(), local=local,
+                trace=self.trace)
+
+            # ragged subjobs are stored in an arena, which can not be batched
+            if isinstance(output_q, ArenaQueue) and any(
+                    other.MICRO_BATCH_SIZE is not None
+                    for other in [task] + task.children):
+                raise ValueError(
+                    f"Task {task.name} has ragged subjobs, so neither it nor "
+                    "the tasks that follow it can set `MICRO_BATCH_SIZE`")
+            if task.WAIT_POLICY != "auto":
+                output_q.set_wait_policy(*task.WAIT_POLICY)
+
             # create workers and assign them to task
             task.create_workers(input_q, output_q,
-                                self.meta_manager.meta_q)
+                                self.meta_manager.meta_rings)
+            self._set_up_autoscaling(task, output_q)
+
+        # store output job structures for later runs
+        self._save_spec_cache(cached_specs)
 
-            # set input queue of task.next to output queue of task
-            input_q = output_q
+        # the output queue of each task that is followed by other tasks
+        self._output_qs = output_qs
 
-            # update task
-            task = task.next
+    @staticmethod
+    def _get_reader(parent, task, output_qs):
+        """
+        Returns the queue that `task` reads the output jobs of `parent` from.
+        """
+
+        output_q = output_qs[parent]
+        if len(parent.children) == 1:
+            return output_q
 
-        # like above
-        task._set_input_queue(input_q)
+        return output_q.get_reader(parent.children.index(task))
 
-        # create workers and assign them to the final task
-        task.create_workers(input_q, Queue(), self.meta_manager.meta_q)
+    @staticmethod
+    def _join_jobs(task, jobs):
+        """
+        Returns an example input job for `task` with the subjobs of each job
+        in `jobs` (see `ptlib.core.queue.JoinQueue`).
+        """
+
+        input_job = Job()
+        for job in jobs:
+            for key, subjob in job.items():
+                if key in input_job:
+                    raise ValueError(f"Subjob {key} of the jobs joined by "
+                                     f"task {task.name} is not unique")
+                input_job[key] = subjob
+
+        return input_job
+
+    def _place_workers(self):
+        """
+        Pins the workers of each task that sets `Task.CPU_AFFINITY` and reads
+        the pages of its input queue from its cores, so that the jobs are
+        allocated on the NUMA node of its workers (Linux allocates a page on
+        the node that first touches it). Nothing has been put yet, since no
+        worker has started.
+        """
+
+        tasks = [task for task in self.pipeline.iter_tasks()
+                 if task.CPU_AFFINITY is not None]
+        placement = affinity.place_tasks(
+            [task for task in tasks if task.CPU_AFFINITY == "auto"],
+            affinity.get_numa_nodes())
+
+        for task in tasks:
+            if task.CPU_AFFINITY == "auto":
+                cpus = placement[task]
+            elif all(isinstance(cpu, int) for cpu in task.CPU_AFFINITY):
+                cpus = [set(task.CPU_AFFINITY)]
+            else:
+                cpus = [set(worker_cpus) for worker_cpus in task.CPU_AFFINITY]
+            task._set_cpus(cpus)
+
+            with affinity.pinned(set().union(*cpus)):
+                task.input_q._touch()
+
+    def _set_up_autoscaling(self, task, output_q):
+        """
+        Enables autoscaling of `task` if it sets `Task.MAX_WORKERS`. The first
+        tasks of the pipeline are not scaled, since their workers usually
+        split the jobs between them by worker id.
+        """
+
+        if task.MAX_WORKERS is None or not task.parents:
+            return
+
+        task._enable_autoscaling(output_q, self.meta_manager.meta_rings)
+
+    def _autoscale(self, tasks):
+        """
+        Adds or retires a worker of each task in `tasks` that is
+        autoscaled. A task grows while its input queue stays nearly full and
+        its workers are busy, and it shrinks while its input queue stays
+        nearly empty and its workers are idle. The thresholds for growing and
+        shrinking are apart and a decision must be reached `SCALE_PATIENCE`
+        times in a row, so the number of workers does not oscillate.
+        """
+
+        now = time_ns()
+        elapsed, self._scale_time = now - self._scale_time, now
+
+        for task in tasks:
+            if task._sem_retire is None:
+                continue
+
+            # fraction of time the running workers spent on jobs
+            num_alive = sum([worker.is_alive() for worker in task.workers])
+            busy = self.meta_manager._busy.pop(task.id, 0) / \
+                (elapsed * max(num_alive, 1))
+
+            fill = task.input_q.get_fill()
+            if fill >= self.SCALE_UP_FILL and busy >= self.SCALE_UP_BUSY:
+                task._scale_votes = max(task._scale_votes, 0) + 1
+            elif fill <= self.SCALE_DOWN_FILL and \
+                    busy <= self.SCALE_DOWN_BUSY:
+                task._scale_votes = min(task._scale_votes, 0) - 1
+            else:
+                task._scale_votes = 0
+
+            # (a worker is only added once a retired worker it would replace
+            # has exited)
+            if task._scale_votes >= self.SCALE_PATIENCE and \
+                    task._num_active < task.MAX_WORKERS:
+                if task._add_worker():
+                    print(f"Adding Worker -- Task: {task.name}")
+                    task._scale_votes = 0
+            elif task._scale_votes <= -self.SCALE_PATIENCE and \
+                    task._num_active > task.MIN_WORKERS:
+                print(f"Retiring Worker -- Task: {task.name}")
+                task._retire_worker()
+                task._scale_votes = 0
+
+    def _tune_waits(self, tasks):
+        """
+        Sets the wait policy of the output queue of each task in `tasks`
+        whose `Task.WAIT_POLICY` is "auto" from the mean time between the
+        jobs it put since the last call. While jobs are less than `PARK_NS`
+        apart, waiting endpoints spin for about that long (at most
+        `MAX_SPIN_NS`) before they sleep, since being woken up would take
+        about as long as the wait. Otherwise they sleep almost at once.
+        """
+
+        now = time_ns()
+        elapsed, self._tune_time = now - self._tune_time, now
+
+        for task in tasks:
+            num_jobs = self.meta_manager._num_jobs.pop(task.id, 0)
+            if task not in self._output_qs or task.WAIT_POLICY != "auto" \
+                    or num_jobs == 0:
+                continue
+
+            interval = elapsed / num_jobs
+            if interval < self.PARK_NS:
+                spin_count = int(min(interval, self.MAX_SPIN_NS) /
+                                 self._spin_ns)
+                yield_count = ptconfig._QUEUE.YIELD_COUNT
+            else:
+                spin_count, yield_count = 0, 1
+
+            self._output_qs[task].set_wait_policy(spin_count, yield_count)
+
+    def _export_metrics(self):
+        """
+        Publishes the current metrics of the pipeline (see `metrics_port`).
+        """
+
+        self._exporter.export(self.meta_manager,
+                              list(self.pipeline.iter_tasks()), self.stats())
+        self._metrics_time = time_ns()
 
     def _add_worker(self, name, task_id, worker_id):
         """
@@ -139,3 +536,41 @@ class Controller:
         latest_start = self.Value("i", 0)
 
         self._worker_map[task_id, worker_id] = (name, pairs, latest_start)
+
+    @staticmethod
+    def _get_preload_modules(pipeline):
+        """
+        Returns the names of the modules imported by the forkserver before it
+        starts any worker, which are `PRELOAD_MODULES` and the module of 
+        each task in `pipeline`.
+        """
+
+        modules = list(ptconfig._CONTROLLER.PRELOAD_MODULES)
+        for task in pipeline.iter_tasks():
+            if task.ttype.__module__ not in modules:
+                modules.append(task.ttype.__module__)
+
+        return modules
+
+    def _load_spec_cache(self):
+        """
+        Returns the dictionary of output job structures stored in
+        `self.spec_cache`, which is empty if there is no cache.
+        """
+
+        if self.spec_cache is None or not os.path.exists(self.spec_cache):
+            return dict()
+
+        with open(self.spec_cache, "rb") as f:
+            return load(f)
+
+    def _save_spec_cache(self, cached_specs: dict):
+        """
+        Writes the output job structures to `self.spec_cache`.
+        """
+
+        if self.spec_cache is None:
+            return
+
+        with open(self.spec_cache, "wb") as f:
+            dump(cached_specs, f)
@@ -10,7 +10,8 @@ class JobSpec:
                  dtype: np.dtype = None,
                  *,
                  name: Hashable = None,
-                 example: np.ndarray = None):
+                 example: np.ndarray = None,
+                 ragged: bool = False):
         """
         Parameters:
             shape -- Tuple[int]
@@ -22,9 +23,16 @@ class JobSpec:
             example -- ndarray
                 An example data to infer structure and space requirements of
                 the data (if provided, shape and dtype will be ignored)
+            ragged -- bool
+                If True, the first dimension of `shape` is the largest number
+                of rows and each job may have fewer. The rows are stored in the
+                arena of a `ptlib.core.queue.ArenaQueue` rather than in the 
+                slot, so the subjob only takes up the space it needs.
         """
 
         self.next = None
+        self._dtype = None
+        self.ragged = ragged
 
         # if no shape nor example is given, assumed to be an empty spec
         self._is_empty = shape is None and example is None
@@ -57,13 +65,60 @@ class JobSpec:
 
         return job_specs
 
+    def get_dtype(self):
+        """
+        Compiles the specification into a single aligned numpy structured 
+        dtype with one field per subjob, so that a job is one record and a 
+        queue of jobs is a record array. The result is cached until another 
+        spec is added with `+`.
+        """
+
+        if self._dtype is None:
+            # (a ragged subjob is stored as its offset in the arena and its
+            # number of rows)
+            self._dtype = np.dtype([(self._get_field(js, i), np.int64, (2,))
+                                    if js.ragged else
+                                    (self._get_field(js, i), js.dtype,
+                                     tuple(int(d) for d in js.shape))
+                                    for i, js in enumerate(self)],
+                                   align=True)
+
+        return self._dtype
+
     def get_nbytes(self, capacity: int = 1):
         """
         Calculates the number of bytes required to allocate a `ptlib.Job` 
-        specified by `self` in a `ptlib.Queue` of size `capacity`. 
+        specified by `self` in a `ptlib.Queue` of size `capacity` (including 
+        the padding that aligns each subjob). This does not include the rows 
+        of ragged subjobs (see `get_ragged_nbytes`).
+        """
+
+        return capacity * self.get_dtype().itemsize
+
+    def get_ragged_nbytes(self):
+        """
+        Returns the largest number of bytes taken up by the ragged subjobs of
+        a job.
+        """
+
+        return sum(js.nbytes for js in self if js.ragged)
+
+    def is_ragged(self):
+        """
+        Returns True if any subjob is ragged.
         """
 
-        return capacity * sum([js.nbytes for js in self])
+        return any(js.ragged for js in self)
+
+    @staticmethod
+    def _get_field(js: "JobSpec", index: int):
+        """
+        Returns the name of the field of `js`, the `index`th subjob, in the 
+        dtype returned by `get_dtype`. This is the subjob name if it is a 
+        string.
+        """
+
+        return js.name if isinstance(js.name, str) else f"f{index}"
 
     def __iter__(self):
         js = self
@@ -83,9 +138,10 @@ class JobSpec:
         if self._is_empty:
             return other_js
 
-        js = self
-        while js.next is not None:
-            js = js.next
+        # the compiled dtype of every spec in the chain (each of which is the
+        # head of the rest of it) no longer describes its whole spec
+        for js in self:
+            js._dtype = None
 
         js.next = other_js
 
@@ -96,7 +152,8 @@ class JobSpec:
 
     def __str__(self):
         s = " | ".join(
-            [f"Name: {js.name}, Shape: {js.shape}, DType: {js.dtype}" for js in self])
+            [f"Name: {js.name}, Shape: {js.shape}, DType: {js.dtype}" +
+             (", Ragged" if js.ragged else "") for js in self])
 
         return "[" + s + "]"
 
@@ -107,7 +164,20 @@ class Job(dict):
     itself.
     """
 
-    def __init__(self, job_spec: JobSpec = None):
+    def __init__(self, job_spec: JobSpec = None, buffer: np.ndarray = None):
+        """
+        Parameters:
+            job_spec -- ptlib.core.job.JobSpec
+                Specification for the structure of the job. If None, this 
+                instance is used to infer the structure of a job.
+            buffer -- ()-darray or (k)-darray
+                The record (with dtype `job_spec.get_dtype()`) in which the 
+                subjobs are stored (for example, a slot of a 
+                `ptlib.core.queue.FIFOQueue`). If None, a local record is 
+                created. If `buffer` holds a batch of `k` records, each subjob 
+                has a leading axis of length `k`.
+        """
+
         super().__init__()
 
         # if no job spec is passed, then this instance is used for inferance
@@ -116,18 +186,19 @@ class Job(dict):
             self._subjob = None
             return
 
-        # create local buffer for entire job
-        self._buffer = np.ndarray(job_spec.get_nbytes(), dtype=np.int8)
-
-        # create subjobs
-        offset = 0
-        for js in job_spec:
-            self[js.name] = np.ndarray(shape=js.shape,
-                                       dtype=js.dtype,
-                                       buffer=self._buffer,
-                                       offset=offset)
-
-            offset += js.nbytes
+        # create local record for entire job
+        if buffer is None:
+            buffer = np.zeros((), dtype=job_spec.get_dtype())
+        self._buffer = buffer
+
+        # each subjob is a view of one field of the record(s), except for
+        # ragged subjobs, which start out without rows
+        for i, js in enumerate(job_spec):
+            if js.ragged:
+                self[js.name] = np.zeros((0, *js.shape[1:].astype(int)),
+                                         dtype=js.dtype)
+            else:
+                self[js.name] = self._buffer[JobSpec._get_field(js, i)]
 
     def infer(self):
         """
@@ -1,27 +1,584 @@
+import os
+import numpy as np
+from multiprocessing import Pipe
+from pickle import dump
+from multiprocessing.shared_memory import SharedMemory
 from time import time_ns
 
 import ptlib._backend as ptconfig
-from ptlib.core.job import JobSpec
-from ptlib.core.queue import BaseQueue, Queue
+
+
+class LatencyHistogram:
+    """
+    Fixed-memory histogram of durations in nanoseconds with logarithmic
+    buckets, as in an HDR histogram. Durations below `2**SIGNIFICANT_BITS`
+    nanoseconds each get their own bucket, and above that every power of two
+    is split into `2**(SIGNIFICANT_BITS - 1)` buckets, so a duration is
+    known to within a relative error of `2**(1 - SIGNIFICANT_BITS)` however
+    long it is. Durations of `2**MAX_BITS` nanoseconds or more are counted
+    in the last bucket. Histograms are merged by adding their counts.
+
+    Attributes:
+        counts -- (NUM_BUCKETS)-darray
+            The number of durations counted in each bucket.
+        total -- int
+            The exact sum of the durations counted, or None if it is not
+            known.
+    """
+
+    SIGNIFICANT_BITS = ptconfig._METADATA.HIST_SIGNIFICANT_BITS
+    MAX_BITS = ptconfig._METADATA.HIST_MAX_BITS
+    NUM_BUCKETS = ((MAX_BITS - SIGNIFICANT_BITS) << (SIGNIFICANT_BITS - 1)) \
+        + (1 << SIGNIFICANT_BITS)
+
+    def __init__(self, counts: np.ndarray = None, total: int = None):
+        """
+        Parameters:
+            counts -- (NUM_BUCKETS)-darray
+                The counts of each bucket. An empty histogram is created if
+                None.
+            total -- int
+                The sum of the durations counted, if known.
+        """
+
+        self.counts = np.zeros(self.NUM_BUCKETS, dtype=np.int64) \
+            if counts is None else np.asarray(counts, dtype=np.int64)
+        self.total = 0 if counts is None else total
+
+    @classmethod
+    def from_durations(cls, durations: np.ndarray):
+        """
+        Alternative constructor that counts an array of durations.
+        """
+
+        return cls(np.bincount(cls.get_index(durations),
+                               minlength=cls.NUM_BUCKETS),
+                   int(np.sum(durations)))
+
+    @classmethod
+    def get_index(cls, duration):
+        """
+        Returns the bucket of `duration` (an int or an int64-darray).
+        """
+
+        # (Python ints are handled without numpy, since workers count one
+        # duration per job)
+        if isinstance(duration, int):
+            shift = duration.bit_length() - cls.SIGNIFICANT_BITS
+            if shift <= 0 or duration < 0:
+                return max(duration, 0)
+            if shift > cls.MAX_BITS - cls.SIGNIFICANT_BITS:
+                return cls.NUM_BUCKETS - 1
+
+            return (shift << (cls.SIGNIFICANT_BITS - 1)) + (duration >> shift)
+
+        duration = np.clip(np.asarray(duration, dtype=np.int64), 0,
+                           (1 << cls.MAX_BITS) - 1)
+        shift = np.maximum(np.frexp(duration)[1] - cls.SIGNIFICANT_BITS, 0)
+        index = (shift << (cls.SIGNIFICANT_BITS - 1)) + (duration >> shift)
+
+        return index if index.ndim else int(index)
+
+    @classmethod
+    def get_bounds(cls):
+        """
+        Returns the lowest and highest duration counted by each bucket as two
+        (NUM_BUCKETS)-darrays.
+        """
+
+        index = np.arange(cls.NUM_BUCKETS, dtype=np.int64)
+        half = 1 << (cls.SIGNIFICANT_BITS - 1)
+
+        # buckets below `2 * half` hold one duration each
+        shift = np.maximum(index // half - 1, 0)
+        mantissa = index - (shift << (cls.SIGNIFICANT_BITS - 1))
+
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def get_count(self, max_duration: int = None):
+        """
+        Returns the number of durations counted, or the number of those that
+        are at most `max_duration` (which should be the highest duration of
+        a bucket to be exact).
+        """
+
+        if max_duration is None:
+            return int(self.counts.sum())
+
+        return int(self.counts[self.get_bounds()[1] <= max_duration].sum())
+
+    def get_percentiles(self, percentiles: list):
+        """
+        Returns the duration at each percentile in `percentiles` (between 0
+        and 100) as the highest duration of the bucket it falls in, or None
+        for each if the histogram is empty.
+        """
+
+        cumulative = self.counts.cumsum()
+        if len(cumulative) == 0 or cumulative[-1] == 0:
+            return [None] * len(percentiles)
+
+        ranks = np.maximum(np.ceil(np.asarray(percentiles) / 100 *
+                                   cumulative[-1]), 1)
+        buckets = np.searchsorted(cumulative, ranks)
+
+        return [int(high) for high in self.get_bounds()[1][buckets]]
+
+    def __add__(self, other):
+        total = None if self.total is None or other.total is None \
+            else self.total + other.total
+
+        return LatencyHistogram(self.counts + other.counts, total)
+
+
+class TimingRings:
+    """
+    Shared memory rings of job timings with one ring per worker. Each worker
+    is the only writer of its ring and the controller is the only reader, so
+    neither side takes a lock. The controller drains every ring in bulk. If a
+    ring is full because the controller has fallen behind, the timing is
+    counted as dropped instead of stopping the worker. Each worker also
+    counts the duration of every job (including dropped ones) in its own
+    `ptlib.core.metadata.LatencyHistogram`, which the controller reads
+    without draining it. Jobs got from a traced queue (see
+    `ptlib.core.queue.FIFOQueue.trace`) are also counted in histograms of
+    the time they waited in the queue and of their latency since their
+    origin.
+
+    Attributes:
+        ready -- multiprocessing.connection.Connection
+            Read end of a pipe that a worker writes to when its ring becomes
+            half full, so the controller can sleep on it (together with the
+            worker sentinels) with `multiprocessing.connection.wait`.
+        indices -- dict
+            Dictionary of ring indices where
+            `indices[task id, worker id]=ring index`.
+        ring_size -- int
+            The number of timings each ring can buffer.
+        _arr_dat -- (num rings x ring_size x 2)-darray
+            Array linked to shared memory where `arr_dat[r, i % ring_size]`
+            is the (start time, finish time) of the `i`th job recorded in
+            ring `r`. Each time is in nanoseconds.
+        _arr_ctl -- (num rings x 2 cache lines)-darray
+            Control block where each row holds the following 64-bit words of
+            one ring. The words written by the worker and the word written by
+            the controller are on separate cache lines:
+                =+= `arr_ctl[r, WRITTEN]` is the number of timings ever
+                    recorded in ring `r`.
+                =+= `arr_ctl[r, DROPPED]` is the number of timings dropped
+                    because ring `r` was full.
+                =+= `arr_ctl[r, START]` and `arr_ctl[r, FINISH]` are the
+                    start and finish times of the worker process.
+                =+= `arr_ctl[r, BUSY]` is the sum of the durations counted
+                    in `arr_hist[r]`.
+                =+= `arr_ctl[r, TRACED]` is the number of traced jobs
+                    recorded in ring `r`, and `arr_ctl[r, WAIT]` and
+                    `arr_ctl[r, LATENCY]` are the sums of their queue waits
+                    and latencies.
+                =+= `arr_ctl[r, READ]` is the number of timings ever drained
+                    from ring `r` by the controller.
+        _arr_hist -- (num rings x LatencyHistogram.NUM_BUCKETS)-darray
+            Array linked to shared memory where `arr_hist[r]` is the
+            histogram of the job durations recorded in ring `r`. Workers
+            count durations through the flat view `_flat_hist`.
+        _arr_trc -- (num rings x 2 x LatencyHistogram.NUM_BUCKETS)-darray
+            Same as `_arr_hist` but `arr_trc[r, 0]` and `arr_trc[r, 1]` are
+            the histograms of the queue waits and latencies of the traced
+            jobs recorded in ring `r`.
+    """
+
+    # index of each word in a row of `_arr_ctl`
+    _LINE = ptconfig._QUEUE.CACHE_LINE_NBYTES // np.dtype(np.int64).itemsize
+    WRITTEN, DROPPED, START, FINISH, READ = 0, 1, 2, 3, _LINE
+    TRACED, WAIT, LATENCY, BUSY = 4, 5, 6, 7
+
+    def __init__(self, indices: list, ring_size: int):
+        """
+        Parameters:
+            indices -- list[(task id, worker id)]
+                The workers that each get a ring.
+            ring_size -- int
+                The number of timings each ring can buffer.
+        """
+
+        self.indices = {index: ring for ring, index in enumerate(indices)}
+        self.ring_size = ring_size
+
+        # create shared memory objects
+        num_rings = len(self.indices)
+        self._shm_dat = SharedMemory(
+            create=True, size=max(1, num_rings * ring_size * 2 * 8))
+        self._shm_ctl = SharedMemory(
+            create=True, size=max(1, num_rings * 2 * self._LINE * 8))
+        self._shm_hist = SharedMemory(
+            create=True,
+            size=max(1, num_rings * LatencyHistogram.NUM_BUCKETS * 8))
+        self._shm_trc = SharedMemory(
+            create=True,
+            size=max(1, num_rings * 2 * LatencyHistogram.NUM_BUCKETS * 8))
+
+        # initialize control array and histograms
+        np.ndarray((num_rings, 2 * self._LINE), dtype=np.int64,
+                   buffer=self._shm_ctl.buf).fill(0)
+        np.ndarray((num_rings, LatencyHistogram.NUM_BUCKETS), dtype=np.int64,
+                   buffer=self._shm_hist.buf).fill(0)
+        np.ndarray((num_rings, 2 * LatencyHistogram.NUM_BUCKETS),
+                   dtype=np.int64, buffer=self._shm_trc.buf).fill(0)
+
+        # define arrays
+        self._arr_dat = np.ndarray(0)
+        self._arr_ctl = np.ndarray(0)
+        self._arr_hist = self._flat_hist = np.ndarray(0)
+        self._arr_trc = self._flat_trc = np.ndarray(0)
+
+        # create pipe to wake up the controller
+        self.ready, self._ready_w = Pipe(duplex=False)
+
+    def record(self, ring: int, start_time: int, finish_time: int,
+               num_jobs: int = 1):
+        """
+        Records the timing of a job in `ring`, or of a batch of `num_jobs`
+        jobs mapped together (see `Task.MICRO_BATCH_SIZE`), which is recorded
+        as that many jobs that split its duration evenly. This should only be
+        called by the worker that owns `ring`. Returns False if any timing
+        was dropped.
+        """
+
+        # count the durations even if the timings are dropped
+        duration = finish_time - start_time
+        self._flat_hist[ring * LatencyHistogram.NUM_BUCKETS +
+                        LatencyHistogram.get_index(duration // num_jobs)] += \
+            num_jobs
+        self._arr_ctl[ring, self.BUSY] += duration
+
+        written = self._arr_ctl[ring, self.WRITTEN]
+        num_unread = written - self._arr_ctl[ring, self.READ]
+
+        # the controller has not drained the ring since it was filled
+        num_fit = min(num_jobs, self.ring_size - num_unread)
+        if num_fit < num_jobs:
+            self._arr_ctl[ring, self.DROPPED] += num_jobs - num_fit
+            if num_fit == 0:
+                return False
+
+        # write the entries before publishing them
+        if num_jobs == 1:
+            self._arr_dat[ring, written % self.ring_size] = \
+                start_time, finish_time
+        else:
+            times = start_time + duration * np.arange(num_fit + 1) // num_jobs
+            slots = (written + np.arange(num_fit)) % self.ring_size
+            self._arr_dat[ring, slots, 0] = times[:-1]
+            self._arr_dat[ring, slots, 1] = times[1:]
+        self._arr_ctl[ring, self.WRITTEN] = written + num_fit
+
+        # wake up the controller before the ring overflows
+        if num_unread < self.ring_size // 2 <= num_unread + num_fit:
+            self._ready_w.send_bytes(b"")
+
+        return num_fit == num_jobs
+
+    def record_trace(self, ring: int, wait, latency):
+        """
+        Records the time a traced job waited in its input queue and its
+        latency since its origin (ints, or int64-darrays for a batch of jobs)
+        in `ring`. This should only be called by the worker that owns `ring`.
+        """
+
+        wait_index = ring * 2 * LatencyHistogram.NUM_BUCKETS + \
+            LatencyHistogram.get_index(wait)
+        latency_index = (ring * 2 + 1) * LatencyHistogram.NUM_BUCKETS + \
+            LatencyHistogram.get_index(latency)
+
+        if isinstance(wait, np.ndarray):
+            np.add.at(self._flat_trc, wait_index, 1)
+            np.add.at(self._flat_trc, latency_index, 1)
+            self._arr_ctl[ring, self.TRACED] += len(wait)
+            self._arr_ctl[ring, self.WAIT] += int(wait.sum())
+            self._arr_ctl[ring, self.LATENCY] += int(latency.sum())
+        else:
+            self._flat_trc[wait_index] += 1
+            self._flat_trc[latency_index] += 1
+            self._arr_ctl[ring, self.TRACED] += 1
+            self._arr_ctl[ring, self.WAIT] += wait
+            self._arr_ctl[ring, self.LATENCY] += latency
+
+    def set_lifetime(self, ring: int, start_time: int, finish_time: int):
+        """
+        Records the start and finish times of the worker that owns `ring`.
+        """
+
+        self._arr_ctl[ring, self.FINISH] = finish_time
+        self._arr_ctl[ring, self.START] = start_time
+
+    def drain(self):
+        """
+        Removes every recorded timing from the rings. Returns a dictionary
+        where `timings[task id, worker id]` is a (k x 2)-darray of the new
+        (start time, finish time) pairs of that worker.
+        """
+
+        # clear wake ups (the rings are drained below)
+        while self.ready.poll():
+            self.ready.recv_bytes()
+
+        # snapshot the counters once so each ring is copied in bulk
+        written = self._arr_ctl[:, self.WRITTEN].copy()
+        read = self._arr_ctl[:, self.READ]
+
+        timings = dict()
+        for index, ring in self.indices.items():
+            if written[ring] == read[ring]:
+                continue
+
+            slots = np.arange(read[ring], written[ring]) % self.ring_size
+            timings[index] = self._arr_dat[ring, slots]
+
+            # hand the slots back to the worker
+            self._arr_ctl[ring, self.READ] = written[ring]
+
+        return timings
+
+    def get_lifetimes(self):
+        """
+        Returns a dictionary where `lifetimes[task id, worker id]` is the
+        (start time, finish time) of that worker, or None if it has not
+        started.
+        """
+
+        return {index: (int(self._arr_ctl[ring, self.START]),
+                        int(self._arr_ctl[ring, self.FINISH]))
+                if self._arr_ctl[ring, self.START] != 0 else None
+                for index, ring in self.indices.items()}
+
+    def get_start(self, ring: int):
+        """
+        Returns the start time recorded in `ring`, which is 0 if no worker
+        has used it.
+        """
+
+        return int(self._arr_ctl[ring, self.START])
+
+    def get_histograms(self):
+        """
+        Returns a dictionary where `histograms[task id, worker id]` is a
+        snapshot of the `ptlib.core.metadata.LatencyHistogram` of the job
+        durations of that worker.
+        """
+
+        return {index: LatencyHistogram(self._arr_hist[ring].copy(),
+                                        int(self._arr_ctl[ring, self.BUSY]))
+                for index, ring in self.indices.items()}
+
+    def get_traces(self):
+        """
+        Returns a dictionary where `traces[task id, worker id]` is the
+        (number of traced jobs, total queue wait, total latency, wait
+        histogram, latency histogram) of the traced jobs of that worker, for
+        each worker that recorded any.
+        """
+
+        return {index: (int(self._arr_ctl[ring, self.TRACED]),
+                        int(self._arr_ctl[ring, self.WAIT]),
+                        int(self._arr_ctl[ring, self.LATENCY]),
+                        LatencyHistogram(self._arr_trc[ring, 0].copy(),
+                                         int(self._arr_ctl[ring, self.WAIT])),
+                        LatencyHistogram(self._arr_trc[ring, 1].copy(),
+                                         int(self._arr_ctl[ring, self.LATENCY])))
+                for index, ring in self.indices.items()
+                if self._arr_ctl[ring, self.TRACED] != 0}
+
+    def get_dropped(self):
+        """
+        Returns a dictionary where `dropped[task id, worker id]` is the number
+        of timings that worker dropped.
+        """
+
+        return {index: int(self._arr_ctl[ring, self.DROPPED])
+                for index, ring in self.indices.items()}
+
+    def _link_mem(self):
+        """
+        Links the local arrays to shared memory in the current process.
+        """
+
+        num_rings = len(self.indices)
+        self._arr_dat = np.ndarray((num_rings, self.ring_size, 2),
+                                   dtype=np.int64,
+                                   buffer=self._shm_dat.buf)
+        self._arr_ctl = np.ndarray((num_rings, 2 * self._LINE),
+                                   dtype=np.int64,
+                                   buffer=self._shm_ctl.buf)
+        self._arr_hist = np.ndarray(
+            (num_rings, LatencyHistogram.NUM_BUCKETS), dtype=np.int64,
+            buffer=self._shm_hist.buf)
+        self._flat_hist = self._arr_hist.reshape(-1)
+        self._arr_trc = np.ndarray(
+            (num_rings, 2, LatencyHistogram.NUM_BUCKETS), dtype=np.int64,
+            buffer=self._shm_trc.buf)
+        self._flat_trc = self._arr_trc.reshape(-1)
+
+    def __getstate__(self):
+        """
+        Pickles the rings without the local arrays, which would otherwise be
+        copied out of shared memory. `_link_mem` links them again.
+        """
+
+        state = self.__dict__.copy()
+        state.update(_arr_dat=np.ndarray(0), _arr_ctl=np.ndarray(0),
+                     _arr_hist=np.ndarray(0), _flat_hist=np.ndarray(0),
+                     _arr_trc=np.ndarray(0), _flat_trc=np.ndarray(0))
+
+        return state
+
+
+class TimingBuffer:
+    """
+    Growable (n x 2) column store of (start time, finish time) pairs in
+    nanoseconds. Row 0 holds the start and finish times of the worker process
+    and each following row holds the timing of one job. The preallocated
+    array doubles in size when it is full, so the timings of a long run take
+    16 bytes per job instead of a Python tuple each. Indexing and
+    `np.asarray` give views of the filled rows.
+    """
+
+    def __init__(self, capacity: int = ptconfig._METADATA.RING_SIZE):
+        """
+        Parameters:
+            capacity -- int
+                The number of rows to preallocate.
+        """
+
+        self._arr = np.zeros((max(1, capacity), 2), dtype=np.int64)
+        self._len = 1
+
+    def extend(self, timings: np.ndarray):
+        """
+        Appends a (k x 2)-darray of job timings.
+        """
+
+        new_len = self._len + len(timings)
+
+        # grow geometrically so that appending is amortized O(k)
+        if new_len > len(self._arr):
+            arr = np.zeros((max(new_len, 2 * len(self._arr)), 2),
+                           dtype=np.int64)
+            arr[:self._len] = self._arr[:self._len]
+            self._arr = arr
+
+        self._arr[self._len:new_len] = timings
+        self._len = new_len
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, k):
+        return self._arr[:self._len][k]
+
+    def __setitem__(self, k, v):
+        self._arr[:self._len][k] = v
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self._arr[:self._len]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __repr__(self):
+        return repr(self._arr[:self._len])
+
+
+class SpillBuffer:
+    """
+    Same as `ptlib.core.metadata.TimingBuffer` but the rows are stored in an
+    append-only binary file of (start time, finish time) int64 pairs instead
+    of memory. Job timings are appended to the file as they are drained and
+    row 0 (the worker lifetime) is overwritten in place, so the file can be
+    opened with `np.memmap` at any time (see `ptlib.utils.diagram.Diagram`).
+    The file stays open for writing until `close` is called (or the buffer
+    is used as a context manager), after which the rows can still be read.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+            path -- str
+                The file to write. An existing file is overwritten.
+        """
+
+        self.path = path
+        self._len = 1
+
+        # reserve row 0 for the lifetime of the worker
+        self._file = open(path, "w+b")
+        np.zeros(2, dtype=np.int64).tofile(self._file)
+        self._file.flush()
+
+    def extend(self, timings: np.ndarray):
+        """
+        Appends a (k x 2)-darray of job timings to the file.
+        """
+
+        self._file.seek(0, os.SEEK_END)
+        np.ascontiguousarray(timings, dtype=np.int64).tofile(self._file)
+        self._file.flush()
+
+        self._len += len(timings)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, k):
+        return self._memmap()[k]
+
+    def __setitem__(self, k, v):
+        # only the lifetime is ever overwritten, so write it without mapping
+        if k == 0:
+            self._file.seek(0)
+            np.asarray(v, dtype=np.int64).tofile(self._file)
+            self._file.flush()
+        else:
+            self._memmap()[k] = v
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self._memmap()
+        return arr if dtype is None else arr.astype(dtype)
+
+    def close(self):
+        """
+        Flushes and closes the file. The rows written so far can still be
+        read.
+        """
+
+        if not self._file.closed:
+            self._file.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return f"SpillBuffer({self.path!r}, rows={self._len})"
+
+    def _memmap(self):
+        """
+        Maps the rows written so far into memory.
+        """
+
+        return np.memmap(self.path, dtype=np.int64, mode="r+",
+                         shape=(self._len, 2))
 
 
 class MetadataManager:
     """
     Class to abstract metadata initialization and updates. Metadata is 
-    transported through a `ptlib.core.queue.FIFOQueue` as if it were a job.
+    transported through `ptlib.core.metadata.TimingRings`, where each worker
+    writes the timings of its jobs to its own ring.
 
     Attributes:
-        metadata_spec -- ptlib.core.job.JobSpec
-            The specification for the metadata queue which has two jobs. The 
-            first is used to identify the worker and has the structure
-            [task id, worker id, S/F indicator], where the S/F indicator is 1 if
-            the incoming data is for the start/finish of the worker process, 
-            and 0 if the incoming data is for the worker's job. The second job 
-            transmitted through the metadata queue is the metadata itself and 
-            has the structure
-            [start time, finish time], where each time is in nanoseconds.
-        meta_q_cap -- int
-            The capacity of the metadata queue. 
+        meta_rings -- ptlib.core.metadata.TimingRings
+            The rings that the workers write their timings to.
         _total_jobs -- int
             The number of jobs processed by the pipeline.
         _start -- int
@@ -34,66 +591,134 @@ class MetadataManager:
             Dictionary of worker names where 
             `_names[task id, worker id]=worker name`. 
         _meta -- dict
-            Dictionary of metadata where 
+            Dictionary of `ptlib.core.metadata.TimingBuffer` objects where 
             `_meta[task id, worker id][i]=(start time, finish time)`. Note that 
             each start and finish time are in nanoseconds. If `i==0`, then 
             the metadata corresponds to the start or finish of the worker 
             process. Otherwise, the metadata corresponds to the ith job.
+        _dropped -- dict
+            Dictionary where `_dropped[task id, worker id]` is the number of
+            job timings that were lost because the worker's ring was full.
+        _busy -- dict
+            Dictionary where `_busy[task id]` is the total time in nanoseconds
+            that the workers of that task spent on jobs drained since the
+            controller last reset it (used for autoscaling).
+        _num_jobs -- dict
+            Dictionary where `_num_jobs[task id]` is the number of jobs of
+            that task drained since the controller last reset it (used for
+            tuning the wait policies of queues).
+        _worker_busy -- dict
+            Dictionary where `_worker_busy[task id, worker id]` is the total
+            time in nanoseconds that the worker spent on jobs.
+        _hists -- dict
+            Dictionary where `_hists[task id]` is the
+            `ptlib.core.metadata.LatencyHistogram` of the durations of every
+            job of that task, merged from the histograms of its workers.
+        _traces -- dict
+            Dictionary where `_traces[task id]` is the (number of jobs, total
+            queue wait, total latency) in nanoseconds of the traced jobs of
+            that task (see `ptlib.core.queue.FIFOQueue.trace`). The queue
+            wait is the time from the put of a job into the input queue of
+            the task until a worker started it, and the latency is the time
+            from the origin of the job until a worker finished it.
+        _wait_hists -- dict
+            Same as `_hists` but of the queue waits of the traced jobs.
+        _latency_hists -- dict
+            Same as `_hists` but of the latencies of the traced jobs.
+        _spill_dir -- str
+            If not None, the directory where each worker's timings are
+            spilled by a `ptlib.core.metadata.SpillBuffer` instead of being
+            kept in memory, along with the manifest `SPILL_MANIFEST` that
+            `ptlib.utils.diagram.Diagram.from_spill` reads.
         """
 
-    # job specification for metadata (task id, worker id, if data is start/finish time)
-    metadata_spec = JobSpec(name="id", example=ptconfig._METADATA.JOB_SPEC_EXAMPLES[0]) + \
-        JobSpec(name="data", example=ptconfig._METADATA.JOB_SPEC_EXAMPLES[1])
+    # the number of timings buffered per worker
+    ring_size = ptconfig._METADATA.RING_SIZE
 
-    # the queue max size
-    meta_q_cap = ptconfig._METADATA.QUEUE_MAX_SIZE
+    # name of the file describing the spilled metadata
+    SPILL_MANIFEST = ptconfig._METADATA.SPILL_MANIFEST
 
-    def __init__(self, pipeline, total_jobs=None):
+    def __init__(self, pipeline, total_jobs=None, spill_dir=None):
         # store total number of jobs processed by the pipeline
         self._total_jobs = total_jobs
 
+        # create spill directory
+        self._spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
         # initialize start and finish times
         self._start = self._finish = None
 
-        # create mappings for worker names and metadata
-        self._names, self._meta = dict(), dict()
+        # create mappings for worker names, metadata, and dropped timings
+        self._names, self._meta, self._dropped = dict(), dict(), dict()
+        self._busy, self._num_jobs = dict(), dict()
+        self._worker_busy, self._hists = dict(), dict()
+        self._traces, self._wait_hists, self._latency_hists = \
+            dict(), dict(), dict()
 
-        # create initial entries
+        # create initial entries (and names for workers added by autoscaling)
         for task in pipeline.iter_tasks():
-            for worker_id in range(task.num_workers):
+            for worker_id in range(task._get_max_workers()):
                 # set name
                 self._names[task.id,
                             worker_id] = f"{task.name}: {worker_id}"
 
-                # set metadata to list with one element (will get overridden in first `update` call)
-                self._meta[task.id, worker_id] = [None]
+                if worker_id < task.num_workers:
+                    self._add_buffer((task.id, worker_id))
 
-        # queue for retreiving metadata from asnychronous workers
-        self.meta_q = Queue(self.metadata_spec,
-                            capacity=self.meta_q_cap)
-
-        # link metadata queue and get local buffer
-        meta_buffer = self.meta_q._link_mem()
-        self._id_buffer = meta_buffer["id"]
-        self._data_buffer = meta_buffer["data"]
+        # rings for retreiving metadata from asnychronous workers
+        self.meta_rings = TimingRings(list(self._names), self.ring_size)
+        self.meta_rings._link_mem()
 
     def update(self):
         """
-        Update metadata while `self.meta_q` is not empty.
+        Drains the timings recorded by every worker since the last update.
         """
 
-        while self.meta_q.get() is not BaseQueue.Empty:
-            # get the index and new metadata
-            *index, sf_ind = self._id_buffer
-            new_meta = tuple(self._data_buffer)
+        for index, timings in self.meta_rings.drain().items():
+            if index not in self._meta:
+                self._add_buffer(index)
+            self._meta[index].extend(timings)
+
+            task_id = index[0]
+            busy = int(np.sum(timings[:, 1] - timings[:, 0]))
+            self._busy[task_id] = self._busy.get(task_id, 0) + busy
+            self._num_jobs[task_id] = self._num_jobs.get(task_id, 0) + \
+                len(timings)
+            self._worker_busy[index] = self._worker_busy.get(index, 0) + busy
+
+        # merge the histograms of the workers of each task
+        hists = dict()
+        for (task_id, _), hist in self.meta_rings.get_histograms().items():
+            hists[task_id] = hists[task_id] + hist if task_id in hists \
+                else hist
+        self._hists = hists
 
-            # if the S/F indicator is HIGH, set the first index
-            if sf_ind == 1:
-                self._meta[tuple(index)][0] = new_meta
+        # merge the queue waits and latencies of the traced jobs of each task
+        traces, wait_hists, latency_hists = dict(), dict(), dict()
+        for (task_id, _), (num, wait, latency, wait_hist, latency_hist) in \
+                self.meta_rings.get_traces().items():
+            if task_id in traces:
+                total = traces[task_id]
+                num, wait, latency = \
+                    total[0] + num, total[1] + wait, total[2] + latency
+                wait_hist += wait_hists[task_id]
+                latency_hist += latency_hists[task_id]
+            traces[task_id] = num, wait, latency
+            wait_hists[task_id] = wait_hist
+            latency_hists[task_id] = latency_hist
+        self._traces = traces
+        self._wait_hists, self._latency_hists = wait_hists, latency_hists
 
-            # otherwise add job metadata to list
-            else:
-                self._meta[tuple(index)].append(new_meta)
+        # the start and finish times of each worker process
+        for index, lifetime in self.meta_rings.get_lifetimes().items():
+            if lifetime is not None:
+                if index not in self._meta:
+                    self._add_buffer(index)
+                self._meta[index][0] = lifetime
+
+        self._dropped = self.meta_rings.get_dropped()
 
     def set_time(self):
         """ 
@@ -106,3 +731,57 @@ class MetadataManager:
             self._start = time_ns()
         else:
             self._finish = time_ns()
+
+        if self._spill_dir is not None:
+            self._write_manifest()
+
+    def close(self):
+        """
+        Closes the files that the timings are spilled to, once no more
+        metadata will be collected.
+        """
+
+        for buffer in self._meta.values():
+            if isinstance(buffer, SpillBuffer):
+                buffer.close()
+
+    def _add_buffer(self, index):
+        """
+        Creates the metadata of worker `index=(task id, worker id)` as a
+        buffer with one row (which is overridden by its lifetime).
+        """
+
+        task_id, worker_id = index
+        if self._spill_dir is None:
+            self._meta[index] = TimingBuffer()
+        else:
+            self._meta[index] = SpillBuffer(os.path.join(
+                self._spill_dir, f"task{task_id}_worker{worker_id}.bin"))
+        self._dropped[index] = 0
+
+    def _write_manifest(self):
+        """
+        Writes everything but the job timings to `SPILL_MANIFEST` in the
+        spill directory. The timing file of each worker is stored relative to
+        the directory so that it can be moved.
+        """
+
+        manifest = {
+            "total_jobs": self._total_jobs,
+            "start_time": self._start,
+            "finish_time": self._finish,
+            "process_names": self._names,
+            "paths": {index: os.path.basename(buffer.path)
+                      for index, buffer in self._meta.items()},
+            "dropped": self._dropped,
+            "histograms": {task_id: hist.counts
+                           for task_id, hist in self._hists.items()},
+            "traces": self._traces,
+            "wait_histograms": {task_id: hist.counts for task_id, hist
+                                in self._wait_hists.items()},
+            "latency_histograms": {task_id: hist.counts for task_id, hist
+                                   in self._latency_hists.items()}
+        }
+
+        with open(os.path.join(self._spill_dir, self.SPILL_MANIFEST), "wb") as f:
+            dump(manifest, f)
@@ -1,10 +1,23 @@
 
+import os
+import mmap
 import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from copy import copy
+from itertools import repeat
 from multiprocessing.shared_memory import SharedMemory
-from multiprocessing import Lock
+from multiprocessing import Lock, Semaphore
+from threading import Condition, Event
+from functools import partial
+from time import sleep, monotonic, time_ns
 
+import ptlib._backend as ptconfig
 from ptlib.core.job import JobSpec, Job
 
+# yields the core to another thread or process
+sched_yield = getattr(os, "sched_yield", partial(sleep, 0))
+
 
 class BaseQueue:
     """ Queue. *** COME BACK *** """
@@ -23,18 +36,73 @@ class BaseQueue:
     def __init__(self, *args, **kwargs):
         self.job = None
 
-    def get(self):
+    def get(self, timeout: float = 0):
         return []
 
-    def put(self):
+    def put(self, timeout: float = 0):
         return True
 
+    def put_many(self, jobs, timeout: float = None):
+        return 0 if jobs is None else len(jobs)
+
     def close(self):
         pass
 
-    def _link_mem(self, create_local=False):
+    def get_fill(self):
+        return 0
+
+    def get_stats(self):
+        return None
+
+    def _reopen(self):
+        pass
+
+    def _reset_local(self):
+        """
+        Resets the state that a worker keeps in its own copy of the queue
+        between jobs. Persistent workers call this at the start of every run,
+        since `_reopen` only resets the state shared by every copy.
+        """
+
+        pass
+
+    def _link_mem(self, batch_size: int = None):
+        pass
+
+    def set_wait_policy(self, spin_count: int, yield_count: int):
         pass
 
+    def _copy(self):
+        """
+        Returns a copy of the queue for another thread of the same process
+        (see `ptlib.core.worker.ThreadWorker`), which links its own local
+        arrays and jobs.
+        """
+
+        return copy(self)
+
+    def _touch(self):
+        """
+        Reads every page of the shared memory that holds jobs, so that the
+        pages are allocated on the NUMA node of the calling thread (see
+        `ptlib.utils.affinity.pinned`).
+        """
+
+        for shm in self._get_job_shms():
+            pages = np.ndarray(shm.size, dtype=np.uint8, buffer=shm.buf)
+            pages[::mmap.PAGESIZE].sum()
+            del pages
+
+    def _get_job_shms(self):
+        """
+        Returns the shared memory that holds jobs (see `_touch`).
+        """
+
+        return []
+
+    # (see `FIFOQueue`)
+    seq = origin = enqueued = None
+
 
 class FIFOQueue(BaseQueue):
     """ Object to faciliate memory management across parallel processes.
@@ -49,162 +117,825 @@ class FIFOQueue(BaseQueue):
             kwarg `create_local=True`. Very important that this is created if
             queue is acting as an input or else data in `_job_buffer` might get
             overwritten by an upstream task before it is used.
-        _arr_sel -- (3 x 1)-darray
-            Buffer with following elements:
-                =+= `arr_sel[0]=i` indicates that `put()` will store data in
-                    `arr_dat[i]`
-                =+= `arr_sel[1]=j` indicates that `get()` will retreive data
-                    from `arr_dat[j]`.
-                =+= `arr_sel[0]=k` where `k==0` indicates queue is open and
-                    `k==1` indicates queue is closed.
+        _arr_dat -- (capacity)-darray
+            Record array with dtype `job_spec.get_dtype()` linked to the shared
+            memory buffer. Each record is the slot of one job, so a slot is
+            copied with one record assignment and `arr_dat[field]` views a
+            subjob across every slot.
+        _arr_ctl -- (3 x cache line)-darray
+            Control block where each of the following 64-bit words sits on its
+            own cache line, so producers and consumers do not falsely share:
+                =+= `arr_ctl[HEAD]=i` is the number of slots ever claimed by
+                    `put()`, so the next `put()` stores data in
+                    `arr_dat[i % capacity]`.
+                =+= `arr_ctl[TAIL]=j` is the number of slots ever claimed by
+                    `get()`, so the next `get()` retreives data from
+                    `arr_dat[j % capacity]`.
+                =+= `arr_ctl[CLOSED]=k` where `k==0` indicates queue is open
+                    and `k==1` indicates queue is closed.
+                =+= `arr_ctl[SPIN]` and `arr_ctl[YIELD]` are the wait policy
+                    (see `set_wait_policy`). They share the cache line of
+                    `CLOSED`, which is rarely written.
+                =+= The telemetry counters of producers share the cache line
+                    of `HEAD` and those of consumers share the cache line of
+                    `TAIL` (see `get_stats`). Each is written together with
+                    the counter on its line, so they add no cache traffic.
         _arr_chk -- (capacity x 1)-darray
-            Buffer where each `arr_chk[i]` is 0 if `arr_dat[i]` is full or 1 if
-            `arr_dat[i]` is empty.
+            Buffer where each `arr_chk[i]` is the sequence number of
+            `arr_dat[i]`. The slot claimed by the `t`th call to `put()` may be
+            written once `arr_chk[i]==t`, and the slot claimed by the `t`th
+            call to `get()` may be read once `arr_chk[i]==t+1`. Slots are
+            claimed under `_lock_sel`, but data is copied in and out of them
+            (or leased) outside of it, so slots can be released out of order.
+        _arr_seq -- (capacity)-darray
+            Slot header where each `arr_seq[i]` is the sequence number of the
+            job in `arr_dat[i]`. It is copied from `seq` when a job is put (or
+            from the ticket of the put if `seq` is None, which numbers the
+            jobs of the first task in the order they were put) and copied to
+            `seq` when a job is got.
+        seq -- int or darray
+            The sequence number of the job last got, or of the job put next.
+            Sequence numbers of a batch (see `get_many`) are an array.
+        _arr_trc -- (capacity x 2)-darray
+            Optional slot header (see `trace`) where `arr_trc[i]` is the
+            origin time of the job in `arr_dat[i]` and the time it was put,
+            in nanoseconds. The origin time is copied from `origin` when a
+            job is put (or is the time of the put if `origin` is None, so
+            jobs originate in the first task) and both are copied to `origin`
+            and `enqueued` when a job is got. They are None if the queue is
+            not traced.
+        _sem_filled -- multiprocessing.Semaphore
+            Counts the slots of `arr_dat` that hold a job. Blocking calls to
+            `get()` sleep on this semaphore instead of spinning.
+        _sem_free -- multiprocessing.Semaphore
+            Counts the slots of `arr_dat` that are free. Blocking calls to
+            `put()` sleep on this semaphore instead of spinning.
         """
 
+    # index of each word in `_arr_ctl` (one cache line apart)
+    _LINE = ptconfig._QUEUE.CACHE_LINE_NBYTES // np.dtype(np.int64).itemsize
+    HEAD, TAIL, CLOSED = 0, _LINE, 2 * _LINE
+    SPIN, YIELD = CLOSED + 1, CLOSED + 2
+
+    # offsets of the telemetry counters from `HEAD` and `TAIL` (see
+    # `get_stats`), and the most jobs ever in the queue
+    _WAITS, _BLOCKED_NS = 1, 2
+    HIGH_WATER = HEAD + 3
+
+    # the number of cache lines in the control block
+    _num_ctl_lines = 3
+
     def __init__(self,
                  capacity: int,
-                 job_spec: JobSpec):
+                 job_spec: JobSpec,
+                 trace: bool = False):
         """
         Parameters:
             capacity -- int
                 The number of data-sized slots to send data.
             job_spec -- ptlib.core.job.JobSpec
                 Specification for the structure of the input job into the queue.
+            trace -- bool
+                If True, each slot has a header with the origin time of its
+                job and the time it was put (see `_arr_trc`).
         """
 
         self.capacity = capacity
         self.job_spec = job_spec
+        self.trace = trace
 
-        # define local job buffer
+        # define local job buffer and views of each slot
         self._job_buffer = None
+        self._slot_jobs = dict()
 
         # create shared memory objects
         self._shm_dat = SharedMemory(
             create=True, size=job_spec.get_nbytes(capacity))
-        self._shm_sel = SharedMemory(create=True, size=3)
-        self._shm_chk = SharedMemory(create=True, size=capacity)
+        self._shm_ctl = SharedMemory(
+            create=True,
+            size=self._num_ctl_lines * ptconfig._QUEUE.CACHE_LINE_NBYTES)
+        self._shm_chk = SharedMemory(
+            create=True, size=capacity * np.dtype(np.int64).itemsize)
+        self._shm_seq = SharedMemory(
+            create=True, size=capacity * np.dtype(np.int64).itemsize)
+        self._shm_trc = SharedMemory(
+            create=True, size=2 * capacity * np.dtype(np.int64).itemsize) \
+            if trace else None
 
-        # initialize selection and check arrays
-        np.ndarray(2, dtype=np.int8, buffer=self._shm_sel.buf).fill(0)
-        np.ndarray(capacity, dtype=np.int8, buffer=self._shm_chk.buf).fill(0)
+        # initialize control and check arrays
+        arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE, dtype=np.int64,
+                             buffer=self._shm_ctl.buf)
+        arr_ctl.fill(0)
+        arr_ctl[[self.SPIN, self.YIELD]] = ptconfig._QUEUE.SPIN_COUNT, \
+            ptconfig._QUEUE.YIELD_COUNT
+        np.ndarray(capacity, dtype=np.int64,
+                   buffer=self._shm_chk.buf)[:] = np.arange(capacity)
 
         # define arrays
         self._arr_dat = np.ndarray(0)
-        self._arr_sel = np.ndarray(0)
+        self._arr_ctl = np.ndarray(0)
         self._arr_chk = np.ndarray(0)
+        self._arr_seq = np.ndarray(0)
+        self._arr_trc = np.ndarray(0)
+        self.seq = self.origin = self.enqueued = None
 
         # create selection lock
         self._lock_sel = Lock()
 
+        # create counting semaphores for filled and free slots
+        self._sem_filled = Semaphore(0)
+        self._sem_free = Semaphore(capacity)
+
         # flag to check if arrays have been linked in current context
         self._is_linked = False
 
-    def get(self):
+        # how long the last `_acquire` waited (None if it did not), and the
+        # failed puts and gets without waiting that are not yet counted
+        self._wait_ns = None
+        self._full_polls = self._empty_polls = 0
+
+    def get(self, timeout: float = 0):
+        """
+        Attemps to retreive data from shared memory. If the selected index is
+        empty, this returns `BaseQueue.Empty`. If the queue is closed, then
+        `BaseQueue.Closed` is returned. Otherwise, this loads data into
+        `self._arr_dat` and returns True.
+
+        If `timeout` is 0, this returns immediately. If `timeout` is None, this
+        sleeps until a job is available or the queue is closed. Otherwise,
+        this sleeps for at most `timeout` seconds.
+        """
+
+        if (claim := self._claim_get(timeout)) is None:
+            return self._flag(BaseQueue.Empty)
+        ticket, _ = claim
+
+        # get payload (must copy because buffer might change in other process)
+        self._job_buffer[...] = self._arr_dat[ticket % self.capacity]
+        self._get_seq(ticket)
+
+        self._release_get(ticket)
+
+        return True
+
+    def put(self, timeout: float = 0):
+        """
+        Attempts to load `self._job_buffer` into shared memory. If the selected
+        index is full, then this returns `BaseQueue.Full`. If the queue is
+        closed, then `BaseQueue.Closed` is returned. Otherwise, this loads data
+        into `self._arr_dat` and returns True.
+
+        If `timeout` is 0, this returns immediately. If `timeout` is None, this
+        sleeps until a slot is free. Otherwise, this sleeps for at most
+        `timeout` seconds.
+        """
+
+        if (claim := self._claim_put(timeout)) is None:
+            return self._flag(BaseQueue.Full)
+        ticket, _ = claim
+
+        # load payload into shared memory
+        self._arr_dat[ticket % self.capacity] = self._job_buffer
+        self._set_seq(ticket)
+
+        self._release_put(ticket)
+
+        return True
+
+    @contextmanager
+    def acquire_get(self, timeout: float = None):
+        """
+        Leases the next filled slot without copying it. Yields a
+        `ptlib.core.job.Job` whose subjobs are views of the slot in shared
+        memory, or `BaseQueue.Empty` or `BaseQueue.Closed` if no job arrived
+        within `timeout` (see `get`). The slot is handed back to producers
+        when the context exits, so the yielded job must not be used after.
+
+            with queue.acquire_get() as job:
+                if job is not BaseQueue.Closed:
+                    ...
+        """
+
+        if (claim := self._claim_get(timeout)) is None:
+            yield self._flag(BaseQueue.Empty)
+            return
+        ticket, _ = claim
+
+        self._get_seq(ticket)
+
+        try:
+            yield self._get_slot_job(ticket % self.capacity)
+        finally:
+            self._release_get(ticket)
+
+    @contextmanager
+    def reserve_put(self, timeout: float = None):
+        """
+        Leases the next free slot so that a job can be written directly into
+        shared memory. Yields a `ptlib.core.job.Job` whose subjobs are views of
+        the slot, or `BaseQueue.Full` or `BaseQueue.Closed` if no slot was
+        freed within `timeout` (see `put`). The slot is only handed to
+        consumers when the context exits.
+
+            with queue.reserve_put() as job:
+                job["images"][:] = frames
+        """
+
+        if (claim := self._claim_put(timeout)) is None:
+            yield self._flag(BaseQueue.Full)
+            return
+        ticket, _ = claim
+
+        try:
+            yield self._get_slot_job(ticket % self.capacity)
+        finally:
+            self._set_seq(ticket)
+            self._release_put(ticket)
+
+    @contextmanager
+    def get_many(self, n: int, timeout: float = None):
         """
-        Attemps to retreive data from shared memory. If the selected index is 
-        empty, this returns `BaseQueue.Empty`. If the queue is closed, then 
-        `BaseQueue.Closed` is returned. Otherwise, this loads data into 
-        `self._arr_dat` and returns True. 
+        Leases up to `n` of the oldest jobs in the queue with a single
+        acquisition of `_lock_sel`. Yields a `ptlib.core.job.Job` whose
+        subjobs are (k x shape) views of `k` consecutive slots, where `k` is
+        however many jobs (at least one) were ready without wrapping around
+        the end of `arr_dat`, or a flag as in `acquire_get`.
+
+            with queue.get_many(64) as jobs:
+                if jobs is not BaseQueue.Closed:
+                    total += jobs["x"].sum()
+        """
+
+        if (claim := self._claim_get(timeout, n)) is None:
+            yield self._flag(BaseQueue.Empty)
+            return
+        ticket, num = claim
+
+        sel_index = ticket % self.capacity
+        self._get_seq(ticket, num)
+
+        try:
+            yield self._get_slot_job(sel_index, num)
+        finally:
+            self._release_get(ticket, num)
+
+    def put_many(self, jobs, timeout: float = None):
+        """
+        Loads a batch of jobs into shared memory, claiming as many consecutive
+        slots as are free with each acquisition of `_lock_sel`. `jobs` is a
+        `ptlib.core.job.Job` with a leading batch axis (see `_link_mem`) or
+        its (k)-record array. Returns the number of jobs put, which is
+        less than `k` only if no slot was freed within `timeout` or the queue
+        is closed.
+        """
+
+        buffer = jobs._buffer if isinstance(jobs, Job) else jobs
+
+        num_put = 0
+        while num_put < len(buffer):
+            if (claim := self._claim_put(timeout, len(buffer) - num_put)) is None:
+                break
+            ticket, num = claim
+
+            # load payloads into consecutive slots
+            sel_index = ticket % self.capacity
+            self._arr_dat[sel_index:sel_index + num] = \
+                buffer[num_put:num_put + num]
+            self._set_seq(ticket, num, num_put)
+
+            self._release_put(ticket, num)
+            num_put += num
+
+        return num_put
+
+    def close(self):
+        """
+        Closes queue by setting `self._arr_ctl[CLOSED]` to HIGH. Any process
+        sleeping in `get` or `put` is woken up.
+        """
+
+        # link control array if it isn't already
+        if not self._is_linked:
+            self._arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE,
+                                       dtype=np.int64,
+                                       buffer=self._shm_ctl.buf)
+
+        # set `self._arr_ctl[CLOSED]` to HIGH
+        self._arr_ctl[self.CLOSED] = 1
+
+        # wake up sleeping consumers and producers
+        self._sem_filled.release()
+        self._sem_free.release()
+
+    def set_wait_policy(self, spin_count: int, yield_count: int):
+        """
+        Sets how `get` and `put` wait for a job or a free slot: they try
+        `spin_count` times without pausing, then `yield_count` times after
+        yielding the core, and then sleep on a semaphore until they are woken
+        up. Spinning avoids the latency of being woken up when jobs arrive
+        less than a few tens of microseconds apart, but burns a core
+        otherwise. This can be called by any process at any time.
+        """
+
+        # link control array if it isn't already
+        if not self._is_linked:
+            self._arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE,
+                                       dtype=np.int64,
+                                       buffer=self._shm_ctl.buf)
+
+        self._arr_ctl[[self.SPIN, self.YIELD]] = spin_count, yield_count
+
+    def get_fill(self):
+        """
+        Returns the fraction of slots claimed by `put` and not yet released by
+        `get`. This is a snapshot that may be stale as soon as it is read.
+        """
+
+        # link control array if it isn't already
+        if not self._is_linked:
+            self._arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE,
+                                       dtype=np.int64,
+                                       buffer=self._shm_ctl.buf)
+
+        head, tail = self._arr_ctl[self.HEAD], self._arr_ctl[self.TAIL]
+
+        return min(max(int(head - tail), 0), self.capacity) / self.capacity
+
+    def get_stats(self):
+        """
+        Returns a snapshot of the telemetry counters of the queue as a dict
+        with the following items, which are read without locking and so may
+        be slightly inconsistent with each other:
+            puts, gets -- the number of jobs ever put and got.
+            full_waits, empty_waits -- the number of puts that found the
+                queue full and of gets that found it empty. A put or get
+                that fails without waiting (`timeout=0`) is only counted by
+                the next put or get of the same endpoint.
+            put_blocked_ns, get_blocked_ns -- the total time in nanoseconds
+                that puts and gets waited.
+            high_water -- the most jobs that were ever in the queue.
+            fill -- the current fraction of slots that hold jobs.
+        The counters are reset by `_reopen`.
+        """
+
+        # link control array if it isn't already
+        if not self._is_linked:
+            self._arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE,
+                                       dtype=np.int64,
+                                       buffer=self._shm_ctl.buf)
+
+        return self._make_stats(self._arr_ctl.copy(), [FIFOQueue.TAIL])
+
+    def _make_stats(self, ctl: np.ndarray, tails: list):
+        """
+        Returns the stats (see `get_stats`) of the control block `ctl`, where
+        consumers count on the cache lines starting at each index in `tails`.
+        """
+
+        head, tail = int(ctl[self.HEAD]), int(ctl[FIFOQueue.TAIL])
+        tails = np.asarray(tails)
+
+        return {"puts": head,
+                "gets": tail,
+                "full_waits": int(ctl[self.HEAD + self._WAITS]),
+                "empty_waits": int(ctl[tails + self._WAITS].sum()),
+                "put_blocked_ns": int(ctl[self.HEAD + self._BLOCKED_NS]),
+                "get_blocked_ns": int(ctl[tails + self._BLOCKED_NS].sum()),
+                "high_water": int(ctl[self.HIGH_WATER]),
+                "fill": min(max(head - tail, 0), self.capacity) /
+                self.capacity}
+
+    def _get_job_shms(self):
+        return [self._shm_dat]
+
+    def _reopen(self):
+        """
+        Empties and reopens a closed queue so that it can be used by another
+        run of a persistent pipeline. Any jobs left in the queue are dropped.
+        This must only be called while no other process is using the queue.
         """
 
+        # reset the control and check arrays as in `__init__` (keeping the
+        # wait policy)
+        arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE, dtype=np.int64,
+                             buffer=self._shm_ctl.buf)
+        policy = arr_ctl[[self.SPIN, self.YIELD]]
+        arr_ctl.fill(0)
+        arr_ctl[[self.SPIN, self.YIELD]] = policy
+        np.ndarray(self.capacity, dtype=np.int64,
+                   buffer=self._shm_chk.buf)[:] = np.arange(self.capacity)
+
+        # drop the tokens left by `close` and any unclaimed jobs
+        while self._sem_filled.acquire(False):
+            pass
+        while self._sem_free.acquire(False):
+            pass
+        self._release(self._sem_free, self.capacity)
+
+    def __getstate__(self):
+        """
+        Pickles the queue without its local arrays and jobs, which are views
+        of shared memory (or local copies) in the pickling process. The
+        shared memory, lock and semaphores are pickled by reference when a
+        worker is started, and `_link_mem` links the queue again.
+        """
+
+        state = self.__dict__.copy()
+        state.update(_job_buffer=None, _slot_jobs=dict(),
+                     _arr_dat=np.ndarray(0), _arr_ctl=np.ndarray(0),
+                     _arr_chk=np.ndarray(0), _arr_seq=np.ndarray(0),
+                     _arr_trc=np.ndarray(0), _is_linked=False)
+
+        return state
+
+    def _reset_local(self):
+        """
+        Drops the polls not yet counted (see `_count_wait`), which belong to
+        the previous run.
+        """
+
+        self._full_polls = self._empty_polls = 0
+
+    def _claim_get(self, timeout: float, n: int = 1):
+        """
+        Claims up to `n` of the oldest jobs in the queue, which are stored in
+        consecutive slots. Returns the ticket `t` of the first claim and the
+        number of jobs claimed `k` (the jobs are in `arr_dat[i:i + k]` where
+        `i = t % capacity`), or None if no job arrived within `timeout`.
+        """
+
+        # wait for a filled slot and take any others without waiting
+        if (num_tokens := self._acquire(self._sem_filled, timeout, n)) == 0:
+            # (polls are counted by the next claim, so they never take the lock)
+            if timeout == 0:
+                self._empty_polls += 1
+            else:
+                with self._lock_sel:
+                    self._count_wait(self.TAIL)
+            return None
+
         # acquire selection lock
         self._lock_sel.acquire()
+        self._count_wait(self.TAIL)
+
+        tail = self._arr_ctl[self.TAIL]
 
-        # get index
-        sel_index = self._arr_sel[1]
+        # only claim jobs that were put and do not wrap around `arr_dat`
+        num = min(num_tokens, self._arr_ctl[self.HEAD] - tail,
+                  self.capacity - tail % self.capacity)
 
-        # if get index == set index and check[set] is low, wait for check[set] to be high
-        if self._arr_chk[sel_index] == 0:  # queue is either empty or closed
+        # nothing was put, so the semaphore must have been released by `close`
+        if num == 0:
             self._lock_sel.release()
-            # print(f"sel get: {sel_index} returning False", self._arr_chk[sel_index])
 
-            return BaseQueue.Empty if self._arr_sel[2] == 0 else BaseQueue.Closed
+            # pass the wakeup along to the next sleeping consumer
+            if self._arr_ctl[self.CLOSED] == 1:
+                self._release(self._sem_filled, num_tokens)
 
-        # increment get index
-        self._arr_sel[1] = (sel_index + 1) % self.capacity
-        # print(f"sel get: {sel_index}", self._arr_chk[sel_index])
+            return None
 
-        # get payload (must copy because buffer might change in other process)
-        self._job_buffer[:] = self._arr_dat[sel_index]
+        # increment get counter
+        self._arr_ctl[self.TAIL] = tail + num
 
         # release selection lock
         self._lock_sel.release()
 
-        # set check[get] to low
-        self._arr_chk[sel_index] = 0
+        # hand back the tokens for jobs that were not claimed
+        self._release(self._sem_filled, num_tokens - num)
 
-        return True
+        # a job put after these ones may have been released first
+        self._wait_chk(tail, tail + 1, num)
+
+        return tail, num
+
+    def _release_get(self, ticket: int, num: int = 1):
+        """
+        Hands the slots claimed by `_claim_get` back to producers.
+        """
+
+        # the slots can be written by the puts that are one lap ahead
+        self._set_chk(ticket, ticket + self.capacity, num)
+
+        # wake up producers waiting for a free slot
+        self._release(self._sem_free, num)
 
-    def put(self):
+    def _claim_put(self, timeout: float, n: int = 1):
         """
-        Attempts to load `self._job_buffer` into shared memory. If the selected 
-        index is full, then this returns `BaseQueue.Full`. If the queue is 
-        closed, then `BaseQueue.Closed` is returned. Otherwise, this loads data 
-        into `self._arr_dat` and returns True. 
+        Claims up to `n` consecutive free slots. Returns the ticket `t` of the
+        first claim and the number of slots claimed `k` (the jobs go in
+        `arr_dat[i:i + k]` where `i = t % capacity`), or None if no slot was
+        freed within `timeout`.
         """
 
+        # wait for a free slot and take any others without waiting
+        if (num_tokens := self._acquire(self._sem_free, timeout, n)) == 0:
+            # (polls are counted by the next claim, so they never take the lock)
+            if timeout == 0:
+                self._full_polls += 1
+            else:
+                with self._lock_sel:
+                    self._count_wait(self.HEAD)
+            return None
+
         # acquire selection lock
         self._lock_sel.acquire()
+        self._count_wait(self.HEAD)
+
+        head = self._arr_ctl[self.HEAD]
 
-        # set index
-        sel_index = self._arr_sel[0]
+        # only claim slots that are free and do not wrap around `arr_dat`
+        num = min(num_tokens,
+                  self.capacity - (head - self._arr_ctl[self.TAIL]),
+                  self.capacity - head % self.capacity)
 
-        # if set index == get index and check[get] is high, wait for check[get] to be low
-        if self._arr_chk[sel_index] == 1:  # queue is either full or closed
+        # every slot is taken, so the semaphore must have been released by `close`
+        if num == 0:
             self._lock_sel.release()
-            # print(f"sel put: {sel_index} returning False", self._arr_chk[sel_index])
 
-            return BaseQueue.Full if self._arr_sel[2] == 0 else BaseQueue.Closed
+            # pass the wakeup along to the next sleeping producer
+            if self._arr_ctl[self.CLOSED] == 1:
+                self._release(self._sem_free, num_tokens)
 
-        # increment set index
-        self._arr_sel[0] = (sel_index + 1) % self.capacity
-        # print(f"sel put: {sel_index}", self._arr_chk[sel_index])
+            return None
 
-        # print(self._arr_dat, self._job_buffer)
-        self._arr_dat[sel_index][:] = self._job_buffer
+        # increment put counter
+        self._arr_ctl[self.HEAD] = head + num
+        self._count_fill(head + num)
 
         # release selection lock
         self._lock_sel.release()
 
-        # set check[set] to high
-        self._arr_chk[sel_index] = 1
+        # hand back the tokens for slots that were not claimed
+        self._release(self._sem_free, num_tokens - num)
 
-        return True
+        # the jobs last stored in these slots may still be being read
+        self._wait_chk(head, head, num)
 
-    def close(self):
+        return head, num
+
+    def _release_put(self, ticket: int, num: int = 1):
         """
-        Closes queue by setting `self._arr_sel[2]` to HIGH.
+        Hands the slots claimed by `_claim_put` to consumers.
         """
 
-        # link selection array if it isn't already
-        if not self._is_linked:
-            self._arr_sel = np.ndarray(
-                3, dtype=np.int8, buffer=self._shm_sel.buf)
+        # the slots can be read by the gets with the same tickets
+        self._set_chk(ticket, ticket + 1, num)
+
+        # wake up consumers waiting for a filled slot
+        self._release(self._sem_filled, num)
+
+    def _set_chk(self, ticket: int, seq: int, num: int = 1):
+        """
+        Sets the sequence numbers of the `num` slots from `ticket` onwards to
+        `seq`, `seq + 1`, ...
+        """
 
-        # set `self._arr_sel[2]` to HIGH
-        self._arr_sel[2] = 1
+        if num == 1:
+            self._arr_chk[ticket % self.capacity] = seq
+        else:
+            sel_index = ticket % self.capacity
+            self._arr_chk[sel_index:sel_index + num] = np.arange(
+                seq, seq + num)
 
-    def _link_mem(self):
+    def _set_seq(self, ticket: int, num: int = None, offset: int = 0):
+        """
+        Writes the sequence number `seq` into the header of the slot of
+        `ticket`, or `seq[offset:offset + num]` into the headers of the `num`
+        slots from `ticket` onwards. The tickets are used instead if `seq` is
+        None or does not match the number of jobs put (a single number or a
+        batch).
+        """
 
-        # create local array connected to shared memory buffer
-        self._arr_dat = np.ndarray((self.capacity, self.job_spec.get_nbytes()),
-                                   dtype=np.int8,
-                                   buffer=self._shm_dat.buf)
+        sel_index = ticket % self.capacity
+        is_batch = isinstance(self.seq, np.ndarray)
+        if num is None:
+            self._arr_seq[sel_index] = ticket if self.seq is None or is_batch \
+                else self.seq
+        elif is_batch:
+            self._arr_seq[sel_index:sel_index + num] = \
+                self.seq[offset:offset + num]
+        else:
+            self._arr_seq[sel_index:sel_index + num] = np.arange(
+                ticket, ticket + num)
 
-        # create local job buffer
-        local_job = Job(self.job_spec)
-        self._job_buffer = local_job._buffer
+        if self.trace:
+            self._set_trace(sel_index, num, offset)
+
+    def _set_trace(self, sel_index: int, num: int = None, offset: int = 0):
+        """
+        Writes `origin` (or `origin[offset:offset + num]`) and the current
+        time into the trace headers of the slot at `sel_index` (or of the
+        `num` slots from there onwards). The current time is used as the
+        origin too if `origin` is None or does not match the number of jobs.
+        """
+
+        now = time_ns()
+        is_batch = isinstance(self.origin, np.ndarray)
+        if num is None:
+            self._arr_trc[sel_index] = now if self.origin is None or \
+                is_batch else self.origin, now
+        else:
+            headers = self._arr_trc[sel_index:sel_index + num]
+            headers[:, 0] = self.origin[offset:offset + num] if is_batch \
+                else now if self.origin is None else self.origin
+            headers[:, 1] = now
+
+    def _get_seq(self, ticket: int, num: int = None):
+        """
+        Copies the sequence number (and trace header) of the slot of `ticket`
+        to `seq` (and `origin` and `enqueued`), or those of the `num` slots
+        from `ticket` onwards as arrays.
+        """
+
+        sel_index = ticket % self.capacity
+        if num is None:
+            self.seq = int(self._arr_seq[sel_index])
+            if self.trace:
+                self.origin, self.enqueued = \
+                    self._arr_trc[sel_index].tolist()
+        else:
+            self.seq = self._arr_seq[sel_index:sel_index + num].copy()
+            if self.trace:
+                headers = self._arr_trc[sel_index:sel_index + num]
+                self.origin = headers[:, 0].copy()
+                self.enqueued = headers[:, 1].copy()
+
+    def _wait_chk(self, ticket: int, seq: int, num: int = 1):
+        """
+        Waits for the sequence numbers of the `num` slots claimed from
+        `ticket` onwards to reach `seq`, `seq + 1`, ... This only waits if
+        neighbouring slots are released out of order.
+        """
+
+        sel_index = ticket % self.capacity
+
+        delay = 0
+        if num == 1:
+            while self._arr_chk[sel_index] != seq:
+                sleep(delay)
+                delay = min(2 * delay or 1e-6, 1e-3)
+        else:
+            # no slot is ahead of its target, so the sums match once all do
+            total = num * seq + num * (num - 1) // 2
+            while self._arr_chk[sel_index:sel_index + num].sum() != total:
+                sleep(delay)
+                delay = min(2 * delay or 1e-6, 1e-3)
+
+    def _acquire(self, semaphore, timeout: float, n: int = 1):
+        """
+        Acquires `semaphore` once (waiting as in `get` with the wait policy,
+        see `set_wait_policy`) and then up to `n - 1` more times without
+        waiting. Returns the number of acquisitions, and sets `_wait_ns` to
+        how long it waited (or None if the first attempt succeeded).
+        """
+
+        acquire = semaphore.acquire
+        if acquire(False):
+            self._wait_ns = None
+        elif timeout == 0:
+            self._wait_ns = 0
+            return 0
+        else:
+            start = time_ns()
+
+            # spin, then yield the core, then sleep until woken up
+            for _ in repeat(None, int(self._arr_ctl[self.SPIN])):
+                if acquire(False):
+                    break
+            else:
+                for _ in repeat(None, int(self._arr_ctl[self.YIELD])):
+                    sched_yield()
+                    if acquire(False):
+                        break
+                else:
+                    if not acquire(True, timeout):
+                        self._wait_ns = time_ns() - start
+                        return 0
+
+            self._wait_ns = time_ns() - start
+
+        num = 1
+        while num < n and acquire(False):
+            num += 1
+
+        return num
+
+    def _count_wait(self, line: int):
+        """
+        Adds the wait of the last `_acquire` (if it waited) and the polls
+        not yet counted to the telemetry counters on the cache line starting
+        at `line` (`HEAD` or `TAIL`). Only the endpoints that advance the
+        counter on that line may call this, while they hold `_lock_sel` (see
+        `get_stats`).
+        """
+
+        if line == self.HEAD:
+            waits, self._full_polls = self._full_polls, 0
+        else:
+            waits, self._empty_polls = self._empty_polls, 0
+
+        if self._wait_ns is not None:
+            waits += 1
+            self._arr_ctl[line + self._BLOCKED_NS] += self._wait_ns
+        if waits:
+            self._arr_ctl[line + self._WAITS] += waits
+
+    def _count_fill(self, head: int):
+        """
+        Raises the high-water mark to the number of jobs in the queue once
+        `HEAD` reaches `head`. Only producers may call this.
+        """
+
+        if (fill := head - self._arr_ctl[FIFOQueue.TAIL]) > \
+                self._arr_ctl[self.HIGH_WATER]:
+            self._arr_ctl[self.HIGH_WATER] = fill
+
+    @staticmethod
+    def _time_try_acquire(num_tries: int = 1000):
+        """
+        Returns the time in nanoseconds of one spin of `_acquire` (a failed
+        attempt to acquire a semaphore without waiting).
+        """
+
+        semaphore = Semaphore(0)
+        start = time_ns()
+        for _ in repeat(None, num_tries):
+            semaphore.acquire(False)
+
+        return (time_ns() - start) / num_tries
+
+    @staticmethod
+    def _release(semaphore, n: int):
+        """
+        Releases `semaphore` `n` times.
+        """
+
+        release = semaphore.release
+        for _ in repeat(None, n):
+            release()
+
+    def _flag(self, flag):
+        """
+        Returns `flag` if the queue is open and `BaseQueue.Closed` otherwise.
+        """
+
+        return flag if self._arr_ctl[self.CLOSED] == 0 else BaseQueue.Closed
+
+    def _get_slot_job(self, sel_index: int, num: int = None):
+        """
+        Returns a `ptlib.core.job.Job` whose subjobs are views of
+        `arr_dat[sel_index]`, or of `arr_dat[sel_index:sel_index + num]` with
+        a leading batch axis if `num` is given. These are created lazily and
+        reused.
+        """
+
+        if (key := (sel_index, num)) not in self._slot_jobs:
+            # (indexing with `...` keeps a view rather than a copied record)
+            buffer = self._arr_dat[sel_index, ...] if num is None else \
+                self._arr_dat[sel_index:sel_index + num]
+            self._slot_jobs[key] = Job(self.job_spec, buffer)
+
+        return self._slot_jobs[key]
 
-        # link selection and check arrays to buffers in memory
-        self._arr_sel = np.ndarray(
-            3, dtype=np.int8, buffer=self._shm_sel.buf)
+    def _link_mem(self, batch_size: int = None):
+        """
+        Links the local arrays to shared memory in the current process and
+        returns a local `ptlib.core.job.Job` used by `get` and `put`. If
+        `batch_size` is given, the returned job instead has a leading axis of
+        `batch_size` jobs for use with `get_many` and `put_many`.
+        """
+
+        # create local record array connected to shared memory buffer
+        self._arr_dat = np.ndarray(self.capacity,
+                                   dtype=self.job_spec.get_dtype(),
+                                   buffer=self._shm_dat.buf)
+
+        # link control and check arrays to buffers in memory
+        self._arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE,
+                                   dtype=np.int64, buffer=self._shm_ctl.buf)
         self._arr_chk = np.ndarray(
-            self.capacity, dtype=np.int8, buffer=self._shm_chk.buf)
+            self.capacity, dtype=np.int64, buffer=self._shm_chk.buf)
+        self._arr_seq = np.ndarray(
+            self.capacity, dtype=np.int64, buffer=self._shm_seq.buf)
+        if self.trace:
+            self._arr_trc = np.ndarray((self.capacity, 2), dtype=np.int64,
+                                       buffer=self._shm_trc.buf)
 
         # set linked flag to HIGH
         self._is_linked = True
 
+        # create local batch of jobs (keeping the job used by `get` and `put`)
+        if batch_size is not None:
+            if self._job_buffer is None:
+                self._job_buffer = Job(self.job_spec)._buffer
+
+            return Job(self.job_spec,
+                       np.zeros(batch_size, dtype=self.job_spec.get_dtype()))
+
+        # create local job buffer
+        local_job = Job(self.job_spec)
+        self._job_buffer = local_job._buffer
+
         return local_job
 
     # def _generate_dynamic_put(self):
@@ -220,13 +951,1082 @@ class FIFOQueue(BaseQueue):
     #     self._put = dp._put
 
 
-def Queue(job_spec: JobSpec = None,
-          *,
-          capacity: int = 1):
+class SPSCQueue(FIFOQueue):
+    """ FIFOQueue for exactly one producer and one consumer process.
+
+    Slots are selected with the `HEAD` and `TAIL` counters of `_arr_ctl`
+    alone, so neither `get` nor `put` takes `_lock_sel` or waits on
+    `_arr_chk`. Only the producer writes `HEAD` and only the consumer writes
+    `TAIL`, and each counter sits on its own cache line so the two processes
+    never contend for one.
+
+    A slot is published by writing it before posting `_sem_filled`, and it is
+    recycled by reading it before posting `_sem_free`. Semaphore operations
+    are full memory barriers, so the consumer never sees a partially written
+    slot (and the producer never overwrites a partially read one).
+
+    Because there is no lock to order them, each endpoint may only hold one
+    lease (`acquire_get` or `reserve_put`) at a time. Counters only advance
+    when a slot is released, so `HEAD` counts jobs ever put and `TAIL` counts
+    jobs ever retreived. Likewise, each endpoint is the only writer of its
+    own telemetry counters (see `FIFOQueue.get_stats`).
+    """
+
+    def _claim_get(self, timeout: float, n: int = 1):
+        """
+        Same as `FIFOQueue._claim_get` but without acquiring `_lock_sel`.
+        """
+
+        # wait for a filled slot and take any others without waiting
+        num_tokens = self._acquire(self._sem_filled, timeout, n)
+        self._count_wait(self.TAIL)
+        if num_tokens == 0:
+            return None
+
+        tail = self._arr_ctl[self.TAIL]
+        num = min(num_tokens, self._arr_ctl[self.HEAD] - tail,
+                  self.capacity - tail % self.capacity)
+
+        # nothing was put, so the semaphore must have been released by `close`
+        if num == 0:
+            if self._arr_ctl[self.CLOSED] == 1:
+                self._release(self._sem_filled, num_tokens)
+
+            return None
+
+        self._release(self._sem_filled, num_tokens - num)
+
+        return tail, num
+
+    def _release_get(self, ticket: int, num: int = 1):
+        """
+        Hands the slots back to the producer.
+        """
+
+        self._arr_ctl[self.TAIL] += num
+        self._release(self._sem_free, num)
+
+    def _claim_put(self, timeout: float, n: int = 1):
+        """
+        Same as `FIFOQueue._claim_put` but without acquiring `_lock_sel`.
+        """
+
+        # wait for a free slot and take any others without waiting
+        num_tokens = self._acquire(self._sem_free, timeout, n)
+        self._count_wait(self.HEAD)
+        if num_tokens == 0:
+            return None
+
+        head = self._arr_ctl[self.HEAD]
+        num = min(num_tokens,
+                  self.capacity - (head - self._arr_ctl[self.TAIL]),
+                  self.capacity - head % self.capacity)
+
+        # every slot is full, so the semaphore must have been released by `close`
+        if num == 0:
+            if self._arr_ctl[self.CLOSED] == 1:
+                self._release(self._sem_free, num_tokens)
+
+            return None
+
+        self._release(self._sem_free, num_tokens - num)
+
+        return head, num
+
+    def _release_put(self, ticket: int, num: int = 1):
+        """
+        Publishes the slots to the consumer.
+        """
+
+        self._arr_ctl[self.HEAD] += num
+        self._count_fill(self._arr_ctl[self.HEAD])
+        self._release(self._sem_filled, num)
+
+
+class BroadcastQueue(FIFOQueue):
     """
-    Returns BaseQueue or FIFOQueue depending on the inputs.
+    Queue whose jobs are read by several groups of consumers (one for each
+    task that follows the producing task). Each job is stored in a single
+    slot and every group reads it from there. The slot has a reference count
+    that starts at the number of groups, and the slot is only handed back to
+    producers when the last group releases it.
+
+    Each group reads through its own reader (see `get_reader`), which is a
+    copy of the queue with the group's own get counter, selection lock and
+    semaphore for filled slots. In the queue itself, `arr_ctl[TAIL]` counts
+    the slots that have been freed by every group.
     """
 
-    queue = BaseQueue if job_spec is None else FIFOQueue
+    def __init__(self,
+                 capacity: int,
+                 job_spec: JobSpec,
+                 num_readers: int,
+                 trace: bool = False):
+        """
+        Parameters:
+            capacity -- int
+                The number of data-sized slots to send data.
+            job_spec -- ptlib.core.job.JobSpec
+                Specification for the structure of the input job into the queue.
+            num_readers -- int
+                The number of groups of consumers that read every job.
+            trace -- bool
+                See `FIFOQueue`.
+        """
+
+        # each reader has its own get counter after `HEAD`, `TAIL` and `CLOSED`
+        self.num_readers = num_readers
+        self._num_ctl_lines = 3 + num_readers
+
+        super().__init__(capacity, job_spec, trace)
+
+        # create reference counts of the slots
+        self._shm_ref = SharedMemory(
+            create=True, size=capacity * np.dtype(np.int64).itemsize)
+        np.ndarray(capacity, dtype=np.int64, buffer=self._shm_ref.buf).fill(0)
+        self._arr_ref = np.ndarray(0)
+
+        # create selection locks and semaphores for filled slots of readers
+        self._locks_sel = [Lock() for _ in range(num_readers)]
+        self._sems_filled = [Semaphore(0) for _ in range(num_readers)]
+
+        # lock for decrementing reference counts
+        self._lock_ref = Lock()
+
+    def get_reader(self, reader_id: int):
+        """
+        Returns the queue used by the consumers in group `reader_id` to get
+        jobs.
+        """
+
+        reader = copy(self)
+        reader.TAIL = (3 + reader_id) * self._LINE
+        reader._lock_sel = self._locks_sel[reader_id]
+        reader._sem_filled = self._sems_filled[reader_id]
+        reader._slot_jobs = dict()
+        reader._empty_polls = 0
+
+        return reader
+
+    def close(self):
+        """
+        Same as `FIFOQueue.close` but wakes up the consumers of every group.
+        """
+
+        # link control array if it isn't already
+        if not self._is_linked:
+            self._arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE,
+                                       dtype=np.int64,
+                                       buffer=self._shm_ctl.buf)
+
+        # set `self._arr_ctl[CLOSED]` to HIGH
+        self._arr_ctl[self.CLOSED] = 1
+
+        # wake up sleeping consumers and producers
+        for semaphore in self._sems_filled:
+            semaphore.release()
+        self._sem_free.release()
+
+    def get_stats(self):
+        """
+        Same as `FIFOQueue.get_stats`, where `gets` counts the jobs read by
+        every group and the waits of gets are summed over the groups.
+        """
+
+        # link control array if it isn't already
+        if not self._is_linked:
+            self._arr_ctl = np.ndarray(self._num_ctl_lines * self._LINE,
+                                       dtype=np.int64,
+                                       buffer=self._shm_ctl.buf)
+
+        return self._make_stats(
+            self._arr_ctl.copy(),
+            [(3 + i) * self._LINE for i in range(self.num_readers)])
+
+    def _reopen(self):
+        """
+        Same as `FIFOQueue._reopen` but for every group of consumers.
+        """
+
+        np.ndarray(self.capacity, dtype=np.int64,
+                   buffer=self._shm_ref.buf).fill(0)
+        for semaphore in self._sems_filled:
+            while semaphore.acquire(False):
+                pass
+
+        super()._reopen()
+
+    def _release_get(self, ticket: int, num: int = 1):
+        """
+        Releases this group's reference to the slots claimed by `_claim_get`
+        and hands the slots that are no longer referenced back to producers.
+        """
+
+        sel_index = ticket % self.capacity
+
+        with self._lock_ref:
+            refs = self._arr_ref[sel_index:sel_index + num]
+            refs -= 1
+
+            # the last group to read a slot frees it
+            for i in np.flatnonzero(refs == 0):
+                self._set_chk(ticket + i, ticket + i + self.capacity)
+
+            num_freed = int(np.count_nonzero(refs == 0))
+            self._arr_ctl[FIFOQueue.TAIL] += num_freed
+
+        # wake up producers waiting for a free slot
+        self._release(self._sem_free, num_freed)
+
+    def _release_put(self, ticket: int, num: int = 1):
+        """
+        Hands the slots claimed by `_claim_put` to every group of consumers.
+        """
+
+        # every group holds a reference until it has read the slot
+        sel_index = ticket % self.capacity
+        self._arr_ref[sel_index:sel_index + num] = self.num_readers
+
+        # the slots can be read by the gets with the same tickets
+        self._set_chk(ticket, ticket + 1, num)
+
+        # wake up consumers of every group waiting for a filled slot
+        for semaphore in self._sems_filled:
+            self._release(semaphore, num)
+
+    def _link_mem(self, batch_size: int = None):
+        """
+        Same as `FIFOQueue._link_mem` but also links the reference counts.
+        """
+
+        self._arr_ref = np.ndarray(self.capacity, dtype=np.int64,
+                                   buffer=self._shm_ref.buf)
+
+        return super()._link_mem(batch_size)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.update(_arr_ref=np.ndarray(0))
+
+        return state
+
+
+class ArenaQueue(FIFOQueue):
+    """
+    FIFOQueue for jobs with ragged subjobs (see `ptlib.core.job.JobSpec`).
+    The slot of a job only holds the offset and number of rows of each ragged
+    subjob, and the rows are stored in a shared arena instead. The arena is
+    allocated with a first-fit free list, so it only needs to hold the rows
+    that are actually in the queue rather than `capacity` of the largest jobs.
+
+    The ragged subjobs of a job are allocated together before a slot is
+    claimed (and freed before the slot is released), so a producer waiting
+    for space in the arena never holds a slot that a consumer is waiting on.
+    Each `get` replaces the ragged subjobs of the local job with views of
+    local buffers, so a job map must index the job for them on every call
+    (and a producer assigns them, e.g. `output_job["boxes"] = boxes`).
+    Leases and batches of jobs (`acquire_get`, `reserve_put`, `get_many` and
+    `put_many`) are not supported, since the slots do not hold the rows, so
+    `_link_mem` rejects micro-batching (as does `ptlib.Controller` for the
+    tasks on either side of the queue).
+
+    Attributes:
+        _arr_free -- (capacity + num_producers + 2 x 2)-darray
+            Free list of the arena. `arr_free[0, 0]` is the number of free
+            blocks and `arr_free[1:]` holds the offset and size of each free
+            block in order of their offsets. At most `capacity` jobs in the
+            slots and one job of each producer waiting for a slot hold space
+            in the arena, so there are at most `capacity + num_producers + 1`
+            blocks.
+    """
+
+    def __init__(self,
+                 capacity: int,
+                 job_spec: JobSpec,
+                 arena_nbytes: int = None,
+                 trace: bool = False,
+                 num_producers: int = 1):
+        """
+        Parameters:
+            capacity -- int
+                The number of data-sized slots to send data.
+            job_spec -- ptlib.core.job.JobSpec
+                Specification for the structure of the input job into the queue.
+            arena_nbytes -- int
+                The number of bytes of the arena. By default, enough for
+                `ptconfig._QUEUE.ARENA_FRACTION` of the slots to hold their
+                largest jobs. The arena always fits the largest job.
+            trace -- bool
+                See `FIFOQueue`.
+            num_producers -- int
+                The largest number of processes or threads that put at once.
+        """
+
+        super().__init__(capacity, job_spec, trace)
+        self.num_producers = num_producers
+
+        # field, name and shape of each ragged subjob
+        self._ragged = [(JobSpec._get_field(js, i), js.name,
+                         tuple(int(d) for d in js.shape), js.dtype)
+                        for i, js in enumerate(job_spec) if js.ragged]
+
+        if arena_nbytes is None:
+            arena_nbytes = capacity * job_spec.get_ragged_nbytes() * \
+                ptconfig._QUEUE.ARENA_FRACTION
+        self.arena_nbytes = self._align(
+            max(int(arena_nbytes), self._get_job_nbytes(
+                [shape[0] for _, _, shape, _ in self._ragged]), 1))
+
+        # create the arena and its free list (a single block to begin with)
+        self._shm_arena = SharedMemory(create=True, size=self.arena_nbytes)
+        self._shm_free = SharedMemory(
+            create=True, size=(capacity + num_producers + 2) * 2 *
+            np.dtype(np.int64).itemsize)
+        self._init_free()
+
+        self._arr_free = np.ndarray(0)
+
+        # local buffers of the largest ragged subjobs and the jobs whose
+        # ragged subjobs are replaced by views of them on every get
+        self._ragged_bufs = dict()
+        self._local_jobs = list()
+
+        # lock for allocating and freeing space in the arena
+        self._lock_arena = Lock()
+
+    def get(self, timeout: float = 0):
+        """
+        Same as `FIFOQueue.get` but also copies the ragged subjobs out of the
+        arena and frees their space.
+        """
+
+        if (claim := self._claim_get(timeout)) is None:
+            return self._flag(BaseQueue.Empty)
+        ticket, _ = claim
+
+        self._job_buffer[...] = self._arr_dat[ticket % self.capacity]
+        self._get_seq(ticket)
+
+        # copy the rows of each ragged subjob into the local buffers
+        offsets, num_rows = [], []
+        for field, name, shape, dtype in self._ragged:
+            offset, rows = (int(x) for x in self._job_buffer[field])
+            buffer = self._ragged_bufs[field][:rows]
+            buffer[...] = np.ndarray(buffer.shape, dtype=dtype,
+                                     buffer=self._shm_arena.buf, offset=offset)
+            for job in self._local_jobs:
+                job[name] = buffer
+
+            offsets.append(offset)
+            num_rows.append(rows)
+
+        self._free(offsets[0], self._get_job_nbytes(num_rows))
+        self._release_get(ticket)
+
+        return True
+
+    def put(self, timeout: float = 0):
+        """
+        Same as `FIFOQueue.put` but first copies the ragged subjobs of the
+        local job into the arena, which may wait for space as for a slot.
+        """
+
+        # check the rows of each ragged subjob
+        subjobs = []
+        for field, name, shape, dtype in self._ragged:
+            subjob = np.asarray(self._local_jobs[0][name])
+            if subjob.shape[1:] != shape[1:] or len(subjob) > shape[0]:
+                raise ValueError(f"Ragged subjob {name} has shape "
+                                 f"{subjob.shape} but at most {shape}")
+            subjobs.append(subjob)
+
+        # allocate the ragged subjobs of the job together
+        nbytes = self._get_job_nbytes([len(subjob) for subjob in subjobs])
+        if (offset := self._claim_arena(nbytes, timeout)) is None:
+            return self._flag(BaseQueue.Full)
+
+        if (claim := self._claim_put(timeout)) is None:
+            self._free(offset, nbytes)
+            return self._flag(BaseQueue.Full)
+        ticket, _ = claim
+
+        # load the rows into the arena and their offsets into the slot
+        for (field, name, shape, dtype), subjob in zip(self._ragged, subjobs):
+            rows = np.ndarray(subjob.shape, dtype=dtype,
+                              buffer=self._shm_arena.buf, offset=offset)
+            rows[...] = subjob
+            self._job_buffer[field] = offset, len(subjob)
+            offset += self._align(rows.nbytes)
+
+        self._arr_dat[ticket % self.capacity] = self._job_buffer
+        self._set_seq(ticket)
+
+        self._release_put(ticket)
+
+        return True
+
+    def get_arena_fill(self):
+        """
+        Returns the fraction of the arena that is allocated.
+        """
+
+        if not self._is_linked:
+            self._arr_free = self._link_free()
+        with self._lock_arena:
+            num = self._arr_free[0, 0]
+            free = self._arr_free[1:num + 1, 1].sum()
+
+        return 1 - free / self.arena_nbytes
+
+    def _get_job_shms(self):
+        return [self._shm_dat, self._shm_arena]
+
+    def _reopen(self):
+        """
+        Same as `FIFOQueue._reopen` but also frees the whole arena.
+        """
+
+        self._init_free()
+
+        super()._reopen()
+
+    def _claim_arena(self, nbytes: int, timeout: float):
+        """
+        Allocates `nbytes` of the arena, waiting as in `put` for jobs to be
+        got if there is not enough space. Returns the offset of the space, or
+        None if there was not enough space within `timeout` or the queue is
+        closed.
+        """
+
+        deadline = None if timeout is None else monotonic() + timeout
+
+        delay = 0
+        while (offset := self._alloc(nbytes)) is None:
+            if self._arr_ctl[self.CLOSED] == 1 or \
+                    (deadline is not None and monotonic() >= deadline):
+                return None
+            sleep(delay)
+            delay = min(2 * delay or 1e-6, 1e-3)
+
+        return offset
+
+    def _alloc(self, nbytes: int):
+        """
+        Allocates `nbytes` of the arena from the first free block that is
+        large enough. Returns the offset of the space or None.
+        """
+
+        if nbytes == 0:
+            return 0
+
+        with self._lock_arena:
+            num = self._arr_free[0, 0]
+            blocks = self._arr_free[1:num + 1]
+            if len(fits := np.flatnonzero(blocks[:, 1] >= nbytes)) == 0:
+                return None
+            i = fits[0]
+            offset = int(blocks[i, 0])
+
+            # take the space from the start of the block
+            if blocks[i, 1] == nbytes:
+                blocks[i:-1] = blocks[i + 1:].copy()
+                self._arr_free[0, 0] = num - 1
+            else:
+                blocks[i] += (nbytes, -nbytes)
+
+        return offset
+
+    def _free(self, offset: int, nbytes: int):
+        """
+        Hands `nbytes` of the arena at `offset` back to the free list,
+        merging it with the free blocks next to it.
+        """
+
+        if nbytes == 0:
+            return
+
+        with self._lock_arena:
+            num = self._arr_free[0, 0]
+            blocks = self._arr_free[1:num + 2]
+            i = int(np.searchsorted(blocks[:num, 0], offset))
+
+            after_prev = i > 0 and blocks[i - 1].sum() == offset
+            before_next = i < num and offset + nbytes == blocks[i, 0]
+            if after_prev and before_next:
+                blocks[i - 1, 1] += nbytes + blocks[i, 1]
+                blocks[i:num - 1] = blocks[i + 1:num].copy()
+                self._arr_free[0, 0] = num - 1
+            elif after_prev:
+                blocks[i - 1, 1] += nbytes
+            elif before_next:
+                blocks[i] = offset, blocks[i, 1] + nbytes
+            else:
+                blocks[i + 1:num + 1] = blocks[i:num].copy()
+                blocks[i] = offset, nbytes
+                self._arr_free[0, 0] = num + 1
+
+    def _init_free(self):
+        """
+        Resets the free list to a single block spanning the arena.
+        """
+
+        arr_free = self._link_free()
+        arr_free.fill(0)
+        arr_free[0, 0] = 1
+        arr_free[1] = 0, self.arena_nbytes
+
+    def _link_free(self):
+        return np.ndarray((self.capacity + self.num_producers + 2, 2),
+                          dtype=np.int64, buffer=self._shm_free.buf)
+
+    def _get_job_nbytes(self, num_rows: list):
+        """
+        Returns the number of bytes of the arena taken up by ragged subjobs
+        with `num_rows` rows, each starting on its own cache line.
+        """
+
+        return sum(self._align(rows * np.dtype(dtype).itemsize *
+                               int(np.prod(shape[1:])))
+                   for rows, (_, _, shape, dtype) in zip(num_rows, self._ragged))
+
+    @staticmethod
+    def _align(nbytes: int):
+        line = ptconfig._QUEUE.CACHE_LINE_NBYTES
+        return -(-nbytes // line) * line
+
+    def _link_mem(self, batch_size: int = None):
+        """
+        Same as `FIFOQueue._link_mem` but also links the free list and creates
+        the local buffers of the ragged subjobs. Micro-batching is not
+        supported.
+        """
+
+        if batch_size is not None:
+            raise ValueError("A task with ragged subjobs can not set "
+                             "`MICRO_BATCH_SIZE`")
+
+        self._arr_free = self._link_free()
+
+        local_job = super()._link_mem()
+        self._ragged_bufs = {field: np.zeros(shape, dtype=dtype)
+                             for field, _, shape, dtype in self._ragged}
+        self._local_jobs = [local_job]
+
+        return local_job
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.update(_arr_free=np.ndarray(0), _ragged_bufs=dict(),
+                     _local_jobs=list())
+
+        return state
+
+
+class LocalQueue(BaseQueue):
+    """
+    Queue between threaded tasks (see `Task.THREADED`), whose workers are
+    threads of the same process. Each job is passed as a reference to a copy
+    of the record of the local job instead of through shared memory. A
+    subjob that the job map replaced rather than wrote into is passed by
+    reference without copying it, so the job map must assign a new array for
+    every job, e.g.
+
+        output_job["frame"] = cv2.resize(frame, size)
+
+    Ragged subjobs are always passed this way. Each thread uses its own copy
+    of the queue (see `_copy`), which shares the jobs but not the local job.
+    Micro-batching is not supported.
+    """
+
+    # telemetry counters (see `FIFOQueue.get_stats`)
+    _STATS = ("puts", "gets", "full_waits", "empty_waits", "put_blocked_ns",
+              "get_blocked_ns", "high_water")
+
+    def __init__(self,
+                 capacity: int,
+                 job_spec: JobSpec,
+                 trace: bool = False):
+        """
+        Parameters:
+            capacity -- int
+                The largest number of jobs in the queue.
+            job_spec -- ptlib.core.job.JobSpec
+                Specification for the structure of the input job into the queue.
+            trace -- bool
+                If True, jobs carry their origin time and the time they were
+                put (see `FIFOQueue._arr_trc`).
+        """
+
+        self.capacity = capacity
+        self.job_spec = job_spec
+        self.trace = trace
+        self.seq = self.origin = self.enqueued = None
+
+        # jobs in the queue as (record, replaced subjobs, sequence number,
+        # origin time, time put), and the number of jobs ever put (a list so copies share it)
+        self._jobs = deque()
+        self._num_put = [0]
+        self._cond = Condition()
+        self._closed = Event()
+
+        # telemetry counters (see `FIFOQueue.get_stats`), shared by copies
+        self._stats = dict.fromkeys(self._STATS, 0)
+
+        # local job buffer, the subjobs that are views of it, and the jobs
+        # whose subjobs are replaced on every get
+        self._job_buffer = None
+        self._views = dict()
+        self._local_jobs = list()
+
+    def get(self, timeout: float = 0):
+        """
+        Loads the oldest job into the local job (see `FIFOQueue.get`).
+        """
+
+        with self._cond:
+            if not self._jobs:
+                start = time_ns()
+                self._cond.wait_for(
+                    lambda: self._jobs or self._closed.is_set(), timeout)
+                self._stats["empty_waits"] += 1
+                self._stats["get_blocked_ns"] += time_ns() - start
+            if not self._jobs:
+                return BaseQueue.Closed if self._closed.is_set() \
+                    else BaseQueue.Empty
+
+            record, replaced, self.seq, self.origin, self.enqueued = \
+                self._jobs.popleft()
+            self._stats["gets"] += 1
+            self._cond.notify_all()
+
+        self._job_buffer[...] = record
+        for job in self._local_jobs:
+            for key, view in self._views.items():
+                job[key] = replaced.get(key, view)
+
+        return True
+
+    def put(self, timeout: float = 0):
+        """
+        Adds a copy of the local job to the queue (see `FIFOQueue.put`).
+        """
+
+        local_job = self._local_jobs[0]
+        replaced = {key: subjob for key, subjob in local_job.items()
+                    if subjob is not self._views[key]}
+        record = self._job_buffer.copy()
+
+        with self._cond:
+            if len(self._jobs) == self.capacity:
+                start = time_ns()
+                self._cond.wait_for(
+                    lambda: len(self._jobs) < self.capacity or
+                    self._closed.is_set(), timeout)
+                self._stats["full_waits"] += 1
+                self._stats["put_blocked_ns"] += time_ns() - start
+            if len(self._jobs) == self.capacity:
+                return BaseQueue.Closed if self._closed.is_set() \
+                    else BaseQueue.Full
+
+            # number the jobs in the order they were put as in `FIFOQueue`
+            ticket = self._num_put[0]
+            self._num_put[0] += 1
+            seq = ticket if self.seq is None or \
+                isinstance(self.seq, np.ndarray) else int(self.seq)
+            origin = enqueued = None
+            if self.trace:
+                enqueued = time_ns()
+                origin = enqueued if self.origin is None or \
+                    isinstance(self.origin, np.ndarray) else int(self.origin)
+
+            self._jobs.append((record, replaced, seq, origin, enqueued))
+            self._stats["puts"] += 1
+            self._stats["high_water"] = max(self._stats["high_water"],
+                                            len(self._jobs))
+            self._cond.notify_all()
+
+        return True
+
+    def close(self):
+        """
+        Closes the queue and wakes up any thread sleeping in `get` or `put`.
+        """
+
+        with self._cond:
+            self._closed.set()
+            self._cond.notify_all()
+
+    def get_fill(self):
+        return len(self._jobs) / self.capacity
+
+    def get_stats(self):
+        return dict(self._stats, fill=self.get_fill())
+
+    def _reopen(self):
+        with self._cond:
+            self._jobs.clear()
+            self._num_put[0] = 0
+            self._stats.update(dict.fromkeys(self._STATS, 0))
+            self._closed.clear()
+
+    def _copy(self):
+        """
+        Returns a copy of the queue for another thread, which shares the jobs
+        in the queue but links its own local job.
+        """
+
+        queue = copy(self)
+        queue.seq, queue._job_buffer = None, None
+        queue.origin = queue.enqueued = None
+        queue._views, queue._local_jobs = dict(), list()
+
+        return queue
+
+    def _link_mem(self, batch_size: int = None):
+        """
+        Returns the local job used by `get` and `put`.
+        """
+
+        if batch_size is not None:
+            raise ValueError("A threaded task can not set `MICRO_BATCH_SIZE`")
+
+        local_job = Job(self.job_spec)
+        self._job_buffer = local_job._buffer
+        self._views = dict(local_job)
+        self._local_jobs = [local_job]
+
+        return local_job
+
+
+class JoinQueue(BaseQueue):
+    """
+    Input queue of a task that follows several tasks. Each `get` joins a job
+    from every queue in `queues` that has the same sequence number (see
+    `FIFOQueue.seq`), so the task maps together the jobs that the tasks it
+    follows made from the same job, even if they have several workers and
+    put their jobs out of order. Jobs that arrive before the jobs they are
+    joined with are copied into a reorder buffer of each queue. If every
+    queue holds `buffer_size` jobs (which only happens if a task renumbers
+    its jobs), the earliest job held from each queue is joined instead. The
+    subjobs of the joined job are the subjobs of the jobs in every queue, so
+    their names must differ. A joined queue has a single consumer.
+    """
+
+    def __init__(self, queues: list, buffer_size: int):
+        """
+        Parameters:
+            queues -- list
+                The output queue (or reader) of each task that is joined.
+            buffer_size -- int
+                The largest number of jobs held back from each queue.
+        """
+
+        self.queues = queues
+        self.buffer_size = buffer_size
+        self.seq = self.origin = self.enqueued = None
+
+        # the jobs held back from each queue by sequence number and the
+        # queues that are closed
+        self._held = [dict() for _ in queues]
+        self._closed = set()
+
+    def get(self, timeout: float = 0):
+        """
+        Loads the next joined job into the local job (see `FIFOQueue.get`).
+        Once any queue is closed and holds no job, the jobs left in the
+        others can not be joined, so they are dropped until every queue is
+        closed.
+        """
+
+        while True:
+            if any(not self._held[i] for i in self._closed):
+                return self._drain(timeout)
+
+            # get from the open queue that holds the fewest jobs
+            open_qs = [i for i, held in enumerate(self._held) if
+                       i not in self._closed and len(held) < self.buffer_size]
+            if not open_qs:
+                self._hand_over([min(held) for held in self._held])
+                return True
+            i = min(open_qs, key=lambda i: len(self._held[i]))
+
+            queue = self.queues[i]
+            status = queue.get(timeout)
+            if status is BaseQueue.Closed:
+                self._closed.add(i)
+                continue
+            if status is not True:
+                return status
+
+            # join the job without copying it once the other queues hold a
+            # job with its sequence number
+            seq = queue.seq
+            if all(seq in held for j, held in enumerate(self._held) if j != i):
+                self._hand_over([seq] * len(self.queues), got=i)
+                return True
+
+            # (subjobs passed by reference by a `LocalQueue` are kept too,
+            # while the ragged subjobs of an `ArenaQueue` are local buffers)
+            self._held[i][seq] = self._buffers[i].copy(), \
+                {key: np.copy(self._local_job[key]) if key in self._ragged[i]
+                 else self._local_job[key] for key in self._keys[i]}, \
+                (queue.origin, queue.enqueued)
+
+    def _hand_over(self, seqs: list, got: int = None):
+        """
+        Loads the job held back from each queue with the sequence number in
+        `seqs` into the local job, except for queue `got`, whose job was just
+        got.
+        """
+
+        traces = list()
+        for i, seq in enumerate(seqs):
+            if i == got:
+                traces.append((self.queues[i].origin, self.queues[i].enqueued))
+                continue
+
+            record, subjobs, trace = self._held[i].pop(seq)
+            self._buffers[i][...] = record
+            self._local_job.update(subjobs)
+            traces.append(trace)
+
+        # the earliest origin time and the time the last of the jobs was put,
+        # or None if any queue is not traced
+        origins, enqueued = zip(*traces)
+        self.seq = seqs[0]
+        self.origin = None if None in origins else min(origins)
+        self.enqueued = None if None in enqueued else max(enqueued)
+
+    def close(self):
+        for queue in self.queues:
+            queue.close()
+
+    def get_fill(self):
+        return max(queue.get_fill() for queue in self.queues)
+
+    def _drain(self, timeout: float):
+        """
+        Drops jobs from every queue until they are all closed. Returns
+        `BaseQueue.Closed`, or the status of a queue that is still open but
+        has no job within `timeout`.
+        """
+
+        for queue in self.queues:
+            while (status := queue.get(timeout)) is True:
+                pass
+            if status is not BaseQueue.Closed:
+                return status
+
+        for held in self._held:
+            held.clear()
+
+        return BaseQueue.Closed
+
+    def _reopen(self):
+        self._reset_local()
+        for queue in self.queues:
+            queue._reopen()
+
+    def _reset_local(self):
+        self.seq = self.origin = self.enqueued = None
+        for held in self._held:
+            held.clear()
+        self._closed.clear()
+        for queue in self.queues:
+            queue._reset_local()
+
+    def _link_mem(self, batch_size: int = None):
+        """
+        Links every queue and returns a `ptlib.core.job.Job` holding the
+        subjobs of each of their local jobs. Micro-batching is not supported.
+        """
+
+        if batch_size is not None:
+            raise ValueError("A task that joins several tasks can not set "
+                             "`MICRO_BATCH_SIZE`")
+
+        job = Job()
+        self._keys, self._ragged = list(), list()
+        for queue in self.queues:
+            local_job = queue._link_mem()
+            for key, subjob in local_job.items():
+                job[key] = subjob
+            self._keys.append(list(local_job))
+            self._ragged.append({name for _, name, _, _ in queue._ragged}
+                                if isinstance(queue, ArenaQueue) else set())
+
+        # the ragged (or replaced) subjobs of the joined job are replaced on
+        # every get
+        for queue in self.queues:
+            if isinstance(queue, (ArenaQueue, LocalQueue)):
+                queue._local_jobs.append(job)
+
+        # the records that make up the joined job
+        self._buffers = [queue._job_buffer for queue in self.queues]
+        self._local_job = job
+
+        return job
+
+    def _copy(self):
+        return JoinQueue([queue._copy() for queue in self.queues],
+                         self.buffer_size)
+
+    def _get_job_shms(self):
+        return sum([queue._get_job_shms() for queue in self.queues], [])
+
+
+class OrderedQueue(BaseQueue):
+    """
+    Input queue that hands the jobs of `queue` to a single consumer in the
+    order of their sequence numbers (see `FIFOQueue.seq`), starting from 0.
+    Jobs that arrive early are copied into a local reorder buffer. If the
+    buffer holds `buffer_size` jobs (or the queue is closed) before the next
+    job arrives, the held job with the lowest sequence number is handed over
+    instead, so a missing job only delays the consumer by a bounded number of
+    jobs. A job that arrives after a later one was handed over is handed over
+    as soon as it arrives.
+    """
+
+    def __init__(self, queue: FIFOQueue, buffer_size: int):
+        """
+        Parameters:
+            queue -- ptlib.core.queue.FIFOQueue
+                The queue (or reader or joined queues) to get jobs from.
+            buffer_size -- int
+                The largest number of jobs held back.
+        """
+
+        queues = queue.queues if isinstance(queue, JoinQueue) else [queue]
+        if any(isinstance(queue, ArenaQueue) for queue in queues):
+            raise ValueError("An ordered task can not get ragged subjobs")
+
+        self.queue = queue
+        self.buffer_size = buffer_size
+        self.seq = self.origin = self.enqueued = None
+
+        # the sequence number handed over next and the jobs held back
+        self._next_seq = 0
+        self._held = dict()
+
+    def get(self, timeout: float = 0):
+        """
+        Loads the next job in order into the local job (see `FIFOQueue.get`).
+        """
+
+        while self._next_seq not in self._held:
+            if len(self._held) == self.buffer_size:
+                break
+
+            status = self.queue.get(timeout)
+            if status is BaseQueue.Closed and self._held:
+                break
+            if status is not True:
+                return status
+
+            # hand over the next job or a late one without copying it
+            trace = self.queue.origin, self.queue.enqueued
+            if (seq := self.queue.seq) <= self._next_seq:
+                self.seq, (self.origin, self.enqueued) = seq, trace
+                self._next_seq = max(self._next_seq, seq + 1)
+                return True
+
+            # (subjobs passed by reference by a `LocalQueue` are kept too)
+            self._held[seq] = [buffer.copy() for buffer in self._buffers], \
+                dict(self._local_job), trace
+
+        # hand over the next job (or the earliest one held back)
+        seq = self._next_seq if self._next_seq in self._held \
+            else min(self._held)
+        records, subjobs, (self.origin, self.enqueued) = self._held.pop(seq)
+        for buffer, held in zip(self._buffers, records):
+            buffer[...] = held
+        self._local_job.update(subjobs)
+        self.seq, self._next_seq = seq, seq + 1
+
+        return True
+
+    def close(self):
+        self.queue.close()
+
+    def get_fill(self):
+        return self.queue.get_fill()
+
+    def _reopen(self):
+        self._reset_local()
+        self.queue._reopen()
+
+    def _reset_local(self):
+        """
+        Forgets the jobs held back, so that the next run is handed over in
+        order from sequence number 0 again.
+        """
+
+        self.seq, self._next_seq = None, 0
+        self.origin = self.enqueued = None
+        self._held.clear()
+        self.queue._reset_local()
+
+    def _copy(self):
+        return OrderedQueue(self.queue._copy(), self.buffer_size)
+
+    def _get_job_shms(self):
+        return self.queue._get_job_shms()
+
+    def _link_mem(self, batch_size: int = None):
+        """
+        Links `queue` and returns its local job, which jobs are handed over
+        in. Micro-batching is not supported.
+        """
+
+        if batch_size is not None:
+            raise ValueError("An ordered task can not set `MICRO_BATCH_SIZE`")
+
+        local_job = self.queue._link_mem()
+
+        # the records that make up the local job
+        queues = self.queue.queues if isinstance(self.queue, JoinQueue) \
+            else [self.queue]
+        self._buffers = [queue._job_buffer for queue in queues]
+        self._local_job = local_job
+
+        return local_job
+
+
+def Queue(job_spec: JobSpec = None,
+          *,
+          capacity: int = 1,
+          spsc: bool = False,
+          num_readers: int = 1,
+          arena_nbytes: int = None,
+          num_producers: int = 1,
+          local: bool = False,
+          trace: bool = False):
+    """
+    Returns BaseQueue, FIFOQueue, SPSCQueue, BroadcastQueue, ArenaQueue or 
+    LocalQueue depending on the inputs. Pass `spsc=True` only if exactly one 
+    process puts and one process gets. If `num_readers > 1`, every job is read 
+    by `num_readers` groups of consumers (see `BroadcastQueue.get_reader`). If 
+    `job_spec` has ragged subjobs, they are stored in an arena of 
+    `arena_nbytes` that at most `num_producers` processes or threads put 
+    into at once (see `ArenaQueue`). Pass `local=True` only if every 
+    producer and consumer is a thread of the same process. If `trace=True`, 
+    jobs carry their origin time and the time they were put (see 
+    `FIFOQueue._arr_trc`).
+    """
+
+    if job_spec is None:
+        return BaseQueue(capacity, job_spec)
+    if local:
+        return LocalQueue(capacity, job_spec, trace)
+    if job_spec.is_ragged():
+        if num_readers > 1:
+            raise ValueError("Jobs with ragged subjobs can not be read by "
+                             "several tasks")
+        return ArenaQueue(capacity, job_spec, arena_nbytes, trace,
+                          num_producers)
+    if num_readers > 1:
+        return BroadcastQueue(capacity, job_spec, num_readers, trace)
+
+    queue = SPSCQueue if spsc else FIFOQueue
 
-    return queue(capacity, job_spec)
+    return queue(capacity, job_spec, trace)
@@ -1,10 +1,12 @@
+import asyncio
 from typing import Iterable
+from multiprocessing import Pipe, Semaphore
 import numpy as np
 
-from ptlib.core.job import Job, Job
+from ptlib.core.job import JobSpec, Job
 from ptlib.errors import WorkerCreationError, WorkerStartError
 from ptlib.core.queue import Queue
-from ptlib.core.worker import Worker
+from ptlib.core.worker import Worker, ThreadWorker
 
 
 class EmptyTask:
@@ -25,8 +27,86 @@ class Task:
             Task configuration object passed at runtime.
         EXIT_FLAG -- bool
             Used to determine loop termination in process.
+        MICRO_BATCH_SIZE -- int
+            If set, each worker gets and puts up to this many jobs at once.
+            The subjobs passed to `create_map` then have a leading batch axis
+            and the job map should only read and write the first
+            `worker.batch_len` jobs (which it may lower when producing jobs).
+        ORDERED -- bool
+            If True, the task gets its jobs in the order of their sequence
+            numbers (`worker.seq`), which are assigned when the first task
+            puts them, even if the tasks before it have several workers.
+            Jobs that arrive early are held back in a buffer of at most
+            `REORDER_BUFFER_SIZE` jobs. An ordered task has a single worker.
+            A task that joins several tasks matches their jobs by
+            sequence number with a buffer of this size for each of them (see
+            `ptlib.core.queue.JoinQueue`), and also has a single worker.
+        MIN_WORKERS, MAX_WORKERS -- int
+            If `MAX_WORKERS` is set, the controller adds or retires workers
+            of this task (starting from `num_workers`) to keep up with its
+            input queue. The first task of a pipeline is never scaled.
+        THREADED -- bool
+            If True, the workers of this task are threads of the controller's
+            process rather than processes (see
+            `ptlib.core.worker.ThreadWorker`), which only pays off if the job
+            map releases the GIL. Jobs between two threaded tasks are passed
+            by reference (see `ptlib.core.queue.LocalQueue`).
+        CPU_AFFINITY -- set, list or str
+            The cores the workers of this task are pinned to: a set of cores
+            shared by every worker, a list with a set of cores for each
+            worker, or "auto" to give each worker a core next to the workers
+            of the task it follows (see `ptlib.utils.affinity.place_tasks`).
+            The jobs in the input queue are then allocated on the NUMA node
+            of the workers. Pinning is only supported on Linux.
+        WAIT_POLICY -- tuple or str
+            How the workers of this task and of the tasks that follow it wait
+            on the output queue: a `(spin count, yield count)` pair (see
+            `ptlib.core.queue.FIFOQueue.set_wait_policy`), or "auto" to let
+            the controller spin only while jobs are put less than
+            `ptconfig._QUEUE.PARK_NS` apart.
+        ARENA_NBYTES -- int
+            If the output jobs have ragged subjobs (see `output_spec` and
+            `ptlib.core.job.JobSpec`), the number of bytes of shared memory
+            that holds their rows (see `ptlib.core.queue.ArenaQueue`).
     """
 
+    # overload to process jobs in batches (see class documentation)
+    MICRO_BATCH_SIZE = None
+
+    # overload to get jobs in order (see class documentation)
+    ORDERED = False
+    REORDER_BUFFER_SIZE = 64
+
+    # overload to scale the number of workers (see class documentation)
+    MIN_WORKERS = 1
+    MAX_WORKERS = None
+
+    # overload to run the workers as threads (see class documentation)
+    THREADED = False
+
+    # overload to pin the workers to cores (see class documentation)
+    CPU_AFFINITY = None
+
+    # overload to change how workers wait on the output queue (see class
+    # documentation)
+    WAIT_POLICY = "auto"
+
+    # overload to size the shared memory of ragged subjobs (see class
+    # documentation)
+    ARENA_NBYTES = None
+
+    # pipes to persistent workers (see `_make_persistent`)
+    _run_conns = None
+
+    # semaphore used to retire workers (see `_enable_autoscaling`)
+    _sem_retire = None
+
+    # True if the job map is a coroutine function (see `AsyncTask`)
+    _is_async = False
+
+    # cores of each worker (see `_set_cpus`)
+    _cpus = None
+
     class Exit:
         pass
 
@@ -46,6 +126,9 @@ class Task:
         self.next = EmptyTask
         self.input_q = Queue()
 
+        # the tasks this task follows and the tasks that follow it
+        self.parents, self.children = list(), list()
+
     @property
     def ttype(self):
         """
@@ -93,6 +176,21 @@ class Task:
 
         return map_job
 
+    @classmethod
+    def output_spec(cls) -> JobSpec:
+        """
+        Returns a `ptlib.core.job.JobSpec` describing the output job of this 
+        task. If this is overloaded, the controller sizes the output queue 
+        from it and never runs `create_map` in the main process, which 
+        avoids opening files or loading models twice. For example:
+
+            @classmethod
+            def output_spec(cls):
+                return JobSpec((1080, 1920, 3), np.uint8, name="frame")
+        """
+
+        return None
+
     def get_example_job(self):
         """
         Returns an object resembling the output job of this task. If this is 
@@ -102,7 +200,7 @@ class Task:
 
         return None
 
-    def create_workers(self, input_q, output_q, meta_q):
+    def create_workers(self, input_q, output_q, meta_rings):
         """
         Returns a list of pt.Worker objects and stores input queue. Overloading
         this function allows the developer to modify the controller's
@@ -114,10 +212,10 @@ class Task:
                 f"Workers already exist for task: {self}")
 
         # create workers
-        from copy import copy
+        worker_type = ThreadWorker if self.THREADED else Worker
         for worker_id in range(self.num_workers):
             self.workers.append(
-                Worker(self.ttype, self.num_workers, self.id, worker_id, input_q, output_q, meta_q))
+                worker_type(self.ttype, self.num_workers, self.id, worker_id, input_q, output_q, meta_rings))
 
     def get_total_jobs(self):
         """
@@ -128,6 +226,17 @@ class Task:
 
         return None
 
+    def reset(self, worker: Worker, inputs):
+        """
+        Called in each worker before every run with the `inputs` passed to 
+        `Controller.run`, which are stored in `worker.inputs`. A persistent 
+        worker reuses the job map returned by `create_map` for every run, so 
+        this should be overloaded to reset any state the job map keeps 
+        between jobs (such as a job counter).
+        """
+
+        worker.inputs = inputs
+
     def cleanup(self):
         """
         Routine for task cleanup after termination. This function should be
@@ -143,28 +252,79 @@ class Task:
         """
         Tries to infer the structure (shape, dtype) of task's output job an
         example input job. This is done by creating (and later deleting) a
-        temporary worker to analyze the output of `map_job(input_job)`.
+        temporary worker to analyze the output of `map_job(input_job)`. If 
+        the task declares `output_spec`, nothing is run and the returned 
+        output job is an empty job with that structure.
         """
 
+        if (job_spec := self.output_spec()) is not None:
+            return job_spec, Job(job_spec)
+
         input_job = self.get_example_job() or input_job
 
-        worker = Worker(self.ttype, 0, 0, 0, Queue(), Queue(), Queue())
+        # a micro-batching task maps a batch containing the single example job
+        if self.MICRO_BATCH_SIZE is not None and input_job is not None:
+            input_job = self._stack_job(input_job)
+
+        worker = Worker(self.ttype, 0, 0, 0, Queue(), Queue(), None)
         output_job = Job()
-        self.create_map(worker, input_job, output_job)()
+        job_map = self.create_map(worker, input_job, output_job)
+        self.reset(worker, None)
+        if self._is_async:
+            asyncio.run(job_map(input_job, output_job))
+        else:
+            job_map()
         job_spec, ouput_job = output_job.infer()
 
+        # drop the batch axis so the output describes a single job
+        if self.MICRO_BATCH_SIZE is not None:
+            job_spec, output_job = self._unstack_job(output_job).infer()
+
         return job_spec, output_job
 
+    @staticmethod
+    def _stack_job(job):
+        """
+        Returns a copy of `job` where each subjob is a batch of length 1.
+        """
+
+        batch = Job()
+        for key, subjob in job.items():
+            batch[key] = np.asarray(subjob)[np.newaxis]
+
+        return batch
+
+    @staticmethod
+    def _unstack_job(batch):
+        """
+        Returns the first job in `batch`.
+        """
+
+        job = Job()
+        for key, subjob in batch.items():
+            job[key] = np.asarray(subjob)[0]
+
+        return job
+
     def iter_tasks(self):
         """
-        Generator that iterates over linked list structure of tasks using the
-        `task.next` attribute.
+        Generator that iterates over the graph of tasks reachable through the
+        `task.children` attribute. Each task is yielded once and after every
+        task it follows, so a linear pipeline is yielded in order.
         """
 
-        task = self
-        while task is not EmptyTask:
-            yield task
-            task = task.next
+        order, seen = list(), set()
+
+        def visit(task):
+            if task in seen:
+                return
+            seen.add(task)
+            for child in reversed(task.children):
+                visit(child)
+            order.append(task)
+
+        visit(self)
+        yield from reversed(order)
 
     def _set_input_queue(self, input_q):
         """
@@ -175,24 +335,188 @@ class Task:
 
         self.input_q = input_q
 
-    def _start_workers(self):
+    def _make_persistent(self):
+        """
+        Gives each worker a pipe used to start its runs, so that it stays 
+        alive between runs of the controller instead of exiting.
+        """
+
+        self._run_conns = list()
+        for worker in self.workers:
+            conn, worker.run_conn = Pipe()
+            self._run_conns.append(conn)
+
+    def _enable_autoscaling(self, output_q, meta_rings):
+        """
+        Lets the controller add workers with `_add_worker` and retire them
+        with `_retire_worker`. Each worker checks `_sem_retire` after every
+        job (and whenever it waited `Worker.RETIRE_POLL_INTERVAL` for a job
+        in vain) and exits if it can acquire it.
+        """
+
+        self._output_q, self._meta_rings = output_q, meta_rings
+        self._sem_retire = Semaphore(0)
+        self._num_active, self._scale_votes = len(self.workers), 0
+        for worker in self.workers:
+            worker.retire = self._sem_retire
+
+    def _start_workers(self, inputs=None):
         """
-        Starts each of the worker processes. This should not be overloaded.
+        Starts a run of each of the worker processes with `inputs`. Persistent
+        workers are only started once. This should not be overloaded.
         """
 
         if len(self.workers) == 0:
             raise WorkerStartError(
                 f"Workers have not been created for task: {self}")
 
+        # kept for workers added during the run
+        self._inputs, self._finished = inputs, set()
+
+        # drop retirements that no worker acted on before the last run ended
+        if self._sem_retire is not None:
+            while self._sem_retire.acquire(False):
+                pass
+
+        for i, worker in enumerate(self.workers):
+            if worker.pid is None:
+                worker.inputs = inputs
+                worker.start()
+            elif not worker.is_alive():
+                continue
+
+            if self._run_conns is not None:
+                self._run_conns[i].send((Worker.RUN, inputs))
+
+        if self._sem_retire is not None:
+            self._num_active = sum([worker.is_alive()
+                                    for worker in self.workers])
+
+    def _add_worker(self):
+        """
+        Starts a new worker during a run, either by taking back a retirement
+        that no worker has acted on yet or by creating a process (or thread)
+        in the place of a worker that has exited. Returns False if every
+        worker id is taken, since a retired worker has not exited yet.
+        """
+
+        if self._sem_retire.acquire(False):
+            self._num_active += 1
+            return True
+
+        # reuse the id (and timing ring) of the first exited worker
+        worker_id = next((i for i, worker in enumerate(self.workers)
+                          if worker.exitcode is not None), len(self.workers))
+        if worker_id == self._get_max_workers():
+            return False
+
+        self._num_active += 1
+        worker_type = ThreadWorker if self.THREADED else Worker
+        worker = worker_type(self.ttype, self.num_workers, self.id, worker_id,
+                             self.input_q, self._output_q, self._meta_rings)
+        worker.inputs, worker.retire = self._inputs, self._sem_retire
+        worker.cpus = self._get_cpus(worker_id)
+
+        if worker_id == len(self.workers):
+            self.workers.append(worker)
+        else:
+            self.workers[worker_id] = worker
+
+        if self._run_conns is not None:
+            conn, worker.run_conn = Pipe()
+            if worker_id == len(self._run_conns):
+                self._run_conns.append(conn)
+            else:
+                self._run_conns[worker_id] = conn
+            self._finished.discard(worker_id)
+
+        worker.start()
+        if self._run_conns is not None:
+            conn.send((Worker.RUN, self._inputs))
+
+        return True
+
+    def _retire_worker(self):
+        """
+        Signals one worker to exit after its current job, or as soon as it
+        is idle.
+        """
+
+        self._num_active -= 1
+        self._sem_retire.release()
+
+    def _set_cpus(self, cpus: list):
+        """
+        Pins the workers to the cores in `cpus`, a list with a set of cores
+        for each worker (repeated if there are more workers).
+        """
+
+        self._cpus = cpus
         for worker in self.workers:
-            worker.start()
+            worker.cpus = self._get_cpus(worker.id)
+
+    def _get_cpus(self, worker_id: int):
+        """
+        Returns the cores of worker `worker_id` or None if it is not pinned.
+        """
+
+        if self._cpus is None:
+            return None
+
+        return self._cpus[worker_id % len(self._cpus)]
+
+    def _get_max_workers(self):
+        """
+        Returns the largest number of workers this task can have at once.
+        """
+
+        return max(self.num_workers, self.MAX_WORKERS or 0)
+
+    def _get_handles(self):
+        """
+        Returns the objects that become ready when a worker finishes its run.
+        """
+
+        handles = list()
+        for i, worker in enumerate(self.workers):
+            if worker.exitcode is None:
+                handles.append(worker.sentinel)
+                if self._run_conns is not None:
+                    handles.append(self._run_conns[i])
+
+        return handles
 
     def _workers_running(self):
         """
         Returns True if workers are still running, False if otherwise.
         """
 
-        return any([worker.is_alive() for worker in self.workers])
+        if self._run_conns is None:
+            return any([worker.is_alive() for worker in self.workers])
+
+        # persistent workers report the end of each run
+        for i, conn in enumerate(self._run_conns):
+            while self.workers[i].is_alive() and conn.poll():
+                conn.recv()
+                self._finished.add(i)
+
+        return any([worker.is_alive() and i not in self._finished
+                    for i, worker in enumerate(self.workers)])
+
+    def _stop_workers(self):
+        """
+        Signals persistent workers to exit and waits for them to finish. The
+        workers of a task that is not persistent exit after their only run.
+        """
+
+        if self._run_conns is not None:
+            for worker, conn in zip(self.workers, self._run_conns):
+                if worker.is_alive():
+                    conn.send((Worker.STOP, None))
+
+        for worker in self.workers:
+            if worker.pid is not None:
+                worker.join()
 
     def _kill_workers(self):
         """
@@ -201,24 +525,113 @@ class Task:
 
         self.input_q.close()
 
+    def _get_connected(self):
+        """
+        Returns every task connected to this one through `task.parents` or
+        `task.children`.
+        """
+
+        tasks, i = [self], 0
+        while i < len(tasks):
+            for task in tasks[i].parents + tasks[i].children:
+                if task not in tasks:
+                    tasks.append(task)
+            i += 1
+
+        return tasks
+
+    def _add_child(self, child):
+        """
+        Connects the output of this task to the input of `child`. The first
+        child is also `self.next`.
+        """
+
+        if self.next is EmptyTask:
+            self.next = child
+
+        self.children.append(child)
+        child.parents.append(self)
+
     def __rshift__(self, other):
         """
         Allows tasks to be connected into a pipeline using the `>>` operator.
-        This operation finds the last task in linked list of tasks by iterating
-        over the `task.next` attribute. Assigns `other.id` to the last
-        task ID + 1.
+        Every last task of the graph (a task without children) is connected 
+        to `other`, which is a task or a list of tasks that each receive 
+        every job (fan-out). A task that ends up following several tasks 
+        joins their jobs (fan-in, see `ptlib.core.queue.JoinQueue`):
+
+            decode >> [encode, analyze] >> merge
+
+        Tasks that are new to the graph are assigned the next task IDs.
         """
 
-        if not isinstance(other, Task):
+        if isinstance(other, Task):
+            others = [other]
+        elif isinstance(other, (list, tuple)) and \
+                all(isinstance(task, Task) for task in other):
+            others = list(other)
+        else:
             return self
 
-        task = self
-        while task.next is not EmptyTask:
-            task = task.next
+        last_tasks = [task for task in self.iter_tasks() if not task.children]
+
+        # number new tasks after every task connected to this one
+        tasks = self._get_connected()
+        next_id = max(task.id for task in tasks) + 1
+        for other in others:
+            for task in other.iter_tasks():
+                if task not in tasks:
+                    task.id = next_id
+                    next_id += 1
+                    tasks.append(task)
 
-        other.id = task.id + 1
-        task.next = other
+        for task in last_tasks:
+            for other in others:
+                task._add_child(other)
 
         return self
 
     # ---------------------------------------------------------------------- #
+
+
+class AsyncTask(Task):
+    """
+    Template class for I/O-bound tasks, such as reading from object stores or
+    writing to disk. `create_map` returns a coroutine function
+
+        async def job_map(input_job, output_job): ...
+
+    and each worker runs up to `MAX_IN_FLIGHT` calls of it at once on an
+    event loop. Every call gets its own copy of the input job and its own
+    output job, so the job map must use the jobs it is passed rather than
+    the ones passed to `create_map` (which only show their structure). The
+    queues are read and written by helper threads, so waiting for a job or a
+    free slot never blocks the event loop.
+
+    Jobs finish out of order, but each output job keeps the sequence number
+    of its input job (see `Task.ORDERED`). If the job map sets
+    `worker.EXIT_FLAG`, no more jobs are started and the jobs in flight are
+    finished. Micro-batching is not supported.
+
+    Attributes:
+        MAX_IN_FLIGHT -- int
+            The largest number of jobs a worker maps at once.
+    """
+
+    # overload to change the number of jobs in flight (see class documentation)
+    MAX_IN_FLIGHT = 64
+
+    _is_async = True
+
+    def create_map(self, worker: Worker, input_job, output_job):
+        """
+        Returns a coroutine function that maps an input job to an output job
+        for a specific worker (see class documentation). The default
+        `create_map` should be overloaded.
+        """
+
+        async def job_map(input_job, output_job):
+            for key, subjob in input_job.items():
+                output_job[key][:] = subjob
+
+        return job_map
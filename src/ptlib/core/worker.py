@@ -1,68 +1,159 @@
-from multiprocessing import Process
+import os
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Pipe
+from threading import Thread
 from time import time_ns
 
+import ptlib._backend as ptconfig
+from ptlib.core.job import Job
 from ptlib.core.queue import BaseQueue
+from ptlib.utils.affinity import set_affinity
 
 
-class Worker(Process):
-    """ Worker class. *** come back*** """
+class _WorkerBase:
+    """
+    Processing loop shared by `Worker` and `ThreadWorker`, which run it in a
+    process or a thread.
+    """
+
+    # messages sent to a persistent worker through `run_conn`
+    RUN = "run"
+    STOP = "stop"
+
+    # seconds an autoscaled worker waits for a job before it checks whether
+    # it was retired (see `Task._enable_autoscaling`)
+    RETIRE_POLL_INTERVAL = ptconfig._CONTROLLER.RETIRE_POLL_INTERVAL
 
-    def __init__(self, Task, num_workers, task_id, worker_id, input_q, output_q, meta_q):
+    def __init__(self, Task, num_workers, task_id, worker_id, input_q, output_q, meta_rings):
         self.EXIT_FLAG = False
+        self.batch_len = 1
         self.num_workers = num_workers
         self.task_id = task_id
         self.id = worker_id
 
-        # create worker process
+        # inputs of the current run (see `Task.reset`)
+        self.inputs = None
+
+        # sequence number of the current job (see `Task.ORDERED`)
+        self.seq = None
+
+        # a persistent worker is sent the inputs of each run over this pipe
+        # and reports back when it finishes the run (see `Task._make_persistent`)
+        self.run_conn = None
+
+        # semaphore released by the controller to retire a worker of the
+        # task (see `Task._enable_autoscaling`)
+        self.retire = None
+
+        # cores the worker is pinned to (see `Task.CPU_AFFINITY`)
+        self.cpus = None
+
+        # create worker process (or thread)
         super().__init__(target=self.work,
                          args=(Task, input_q,
-                               output_q, meta_q),
+                               output_q, meta_rings),
                          daemon=True)
 
-    def work(self, Task, input_q, output_q, meta_q):
+    def work(self, Task, input_q, output_q, meta_rings):
         """
         The main processing loop for `task`.
         """
 
+        # pin the worker before it allocates anything
+        if self.cpus is not None:
+            set_affinity(self.cpus)
+
         # create task object and set correct task id
         task = Task(num_workers=self.num_workers, task_id=self.task_id)
 
-        # link queues to memory
-        input_job = input_q._link_mem()
-        output_job = output_q._link_mem()
-        meta_buffer = meta_q._link_mem()
+        # link queues to memory (with a leading batch axis if micro-batching)
+        batch_size = task.MICRO_BATCH_SIZE
+        input_job = input_q._link_mem(batch_size)
+        output_job = output_q._link_mem(batch_size)
+        meta_rings._link_mem()
 
-        # set up local metadata buffers
-        id_buffer = meta_buffer["id"]
-        data_buffer = meta_buffer["data"]
+        # get the index of this worker's timing ring
+        ring = meta_rings.indices[task.id, self.id]
 
-        # set the first job in buffer to (task id, worker id, and S/F indicator to HIGH)
-        id_buffer[:] = [task.id, self.id, 1][:]
-
-        # give main thread worker start time
-        start_time = time_ns()
-        data_buffer[:] = [start_time, start_time][:]
-        # (if metadata seems off, add while loop)
-        assert meta_q.put() is not BaseQueue.Full, "meta q should always put (prejob)"
-
-        # set S/F indicator to LOW
-        id_buffer[-1] = 0
+        # give main thread worker start time (a worker that replaces a
+        # retired one continues the lifetime of its ring)
+        start_time = meta_rings.get_start(ring) or time_ns()
+        meta_rings.set_lifetime(ring, start_time, start_time)
 
         # create job mapping
         job_map = task.create_map(self, input_job, output_job)
+        run_jobs = self._run_jobs_async if task._is_async else self._run_jobs
+
+        if self.run_conn is None:
+            # a worker that is not persistent does a single run
+            task.reset(self, self.inputs)
+            run_jobs(task, job_map, input_q, output_q, input_job, output_job,
+                     meta_rings, ring)
+        else:
+            # a persistent worker stays alive until the controller stops it
+            while (message := self.run_conn.recv())[0] == Worker.RUN:
+                self.EXIT_FLAG = False
+                input_q._reset_local()
+                output_q._reset_local()
+                task.reset(self, message[1])
+                if run_jobs(task, job_map, input_q, output_q, input_job,
+                            output_job, meta_rings, ring):
+                    break
+                self.run_conn.send(Worker.RUN)
+
+        # run cleanup routine
+        task.cleanup()
+
+        # record finish time
+        finish_time = time_ns()
+
+        # give main thread worker finish time
+        meta_rings.set_lifetime(ring, start_time, finish_time)
+
+        print(f"Worker Done -- Task: {task.name} | ID: {self.id}")
+
+    def _run_jobs(self, task, job_map, input_q, output_q, input_job, output_job,
+                  meta_rings, ring):
+        """
+        Maps jobs from `input_q` to `output_q` until `self.EXIT_FLAG` is set
+        or `input_q` is closed. Returns True if the worker was retired.
+        """
+
+        batch_size = task.MICRO_BATCH_SIZE
+        timeout = self._get_timeout()
 
         input_status = BaseQueue.Empty
 
         while not self.EXIT_FLAG:
             # t = time_ns()
-            if (input_status := input_q.get()) is BaseQueue.Empty:
+            # sleep until a job is available or the input queue is closed
+            if batch_size is None:
+                input_status = input_q.get(timeout=timeout)
+            else:
+                input_status = self._get_batch(input_q, input_job, batch_size,
+                                               timeout)
+
+            if input_status is BaseQueue.Empty:
+                # an idle worker exits if the controller retired a worker
+                if self.retire is not None and self.retire.acquire(False):
+                    return True
                 continue
             elif input_status is BaseQueue.Closed:
                 break
             # print(f"Task: {task.id} | Get Time: {time_ns() - t}")
 
             # record start time
-            data_buffer[0] = time_ns()
+            job_start_time = time_ns()
+
+            # the output job keeps the sequence number of the input job
+            # unless the job map sets `self.seq`
+            self.seq = input_q.seq
+
+            # and the origin time of the input job, or the start of this job
+            # if it has none (see `ptlib.core.queue.FIFOQueue.trace`)
+            origin, enqueued = input_q.origin, input_q.enqueued
 
             # map input job to compute output job
             job_map()
@@ -73,28 +164,233 @@ class Worker(Process):
             #         print(output_job_buf[i].shape, output_job[i].shape)
             #         output_job_buf[i][:] = output_job[i]
 
-            # record finish time
-            data_buffer[1] = time_ns()
-
-            # put metadata into queue (if metadata seems off, add while loop)
-            assert meta_q.put() is not BaseQueue.Full, "meta q should always put"
+            # record job timing (dropped and counted if the ring is full),
+            # split between the jobs of a batch
+            job_finish_time = time_ns()
+            num_jobs = 1 if batch_size is None else self.batch_len
+            if num_jobs > 0:
+                meta_rings.record(ring, job_start_time, job_finish_time,
+                                  num_jobs)
+            if enqueued is not None:
+                meta_rings.record_trace(ring, job_start_time - enqueued,
+                                        job_finish_time - origin)
 
+            # sleep until there is a free slot in the output queue
             t = time_ns()
-            while output_q.put() is BaseQueue.Full:
-                pass
+            output_q.seq = self.seq
+            output_q.origin = job_start_time if origin is None else origin
+            if batch_size is None:
+                output_q.put(timeout=None)
+            elif output_job is not None:
+                output_q.put_many(output_job._buffer[:self.batch_len],
+                                  timeout=None)
             # print(f"Task: {task.id} | Put Time: {(time_ns() - t)/1e9}")
 
-        # run cleanup routine
-        task.cleanup()
+            # exit if the controller retired a worker of this task
+            if self.retire is not None and self.retire.acquire(False):
+                return True
 
-        # record finish time
-        finish_time = time_ns()
+        return False
 
-        # set S/F indicator to HIGH
-        id_buffer[-1] = 1
+    def _run_jobs_async(self, task, job_map, input_q, output_q, input_job,
+                        output_job, meta_rings, ring):
+        """
+        Same as `_run_jobs` for a `ptlib.core.task.AsyncTask`, whose job map
+        is a coroutine function. Runs up to `task.MAX_IN_FLIGHT` jobs at once
+        on an event loop.
+        """
 
-        # give main thread worker finish time
-        data_buffer[:] = [start_time, finish_time][:]
-        meta_q.put()  # (if metadata seems off, add while loop)
+        if task.MICRO_BATCH_SIZE is not None:
+            raise ValueError("An AsyncTask can not set `MICRO_BATCH_SIZE`")
 
-        print(f"Worker Done -- Task: {task.name} | ID: {self.id}")
+        return asyncio.run(self._map_jobs_async(
+            task.MAX_IN_FLIGHT, job_map, input_q, output_q, input_job,
+            output_job, meta_rings, ring))
+
+    async def _map_jobs_async(self, max_in_flight, job_map, input_q, output_q,
+                              input_job, output_job, meta_rings, ring):
+        """
+        Gets jobs from `input_q` and maps them concurrently until
+        `self.EXIT_FLAG` is set or `input_q` is closed, then waits for the
+        jobs in flight. Each job in flight has its own copies of the local
+        jobs, and the queues are only used by one helper thread each, so the
+        event loop never waits for them.
+        """
+
+        loop = asyncio.get_running_loop()
+        getter, putter = ThreadPoolExecutor(1), ThreadPoolExecutor(1)
+
+        # the input and output jobs of each job that may be in flight
+        free = asyncio.Queue()
+        for _ in range(max_in_flight):
+            free.put_nowait((self._copy_job(input_job, None),
+                             self._copy_job(output_job, None)))
+
+        async def map_job(jobs, header):
+            seq, origin, enqueued = header
+            job_start_time = time_ns()
+            await job_map(*jobs)
+            job_finish_time = time_ns()
+            meta_rings.record(ring, job_start_time, job_finish_time)
+            if enqueued is not None:
+                meta_rings.record_trace(ring, job_start_time - enqueued,
+                                        job_finish_time - origin)
+
+            # sleep (in the helper thread) until there is a free slot
+            await loop.run_in_executor(
+                putter, self._put_job, output_q, output_job, jobs[1], seq,
+                job_start_time if origin is None else origin)
+            free.put_nowait(jobs)
+
+            # stop getting jobs if the controller retired a worker of this task
+            # (taking a single retirement however many jobs are in flight)
+            if not self._retired and self.retire is not None and \
+                    self.retire.acquire(False):
+                self._retired = True
+
+        self._retired = False
+        in_flight = set()
+        while not self.EXIT_FLAG and not self._retired:
+            jobs = await free.get()
+
+            # sleep (in the helper thread) until a job is available or the
+            # input queue is closed
+            input_status, header = await loop.run_in_executor(
+                getter, self._get_job, input_q, input_job, jobs[0],
+                self._get_timeout())
+            if input_status is BaseQueue.Closed:
+                break
+            if input_status is BaseQueue.Empty:
+                free.put_nowait(jobs)
+
+                # an idle worker exits if the controller retired a worker
+                if self.retire is not None and self.retire.acquire(False):
+                    self._retired = True
+                continue
+
+            future = asyncio.ensure_future(map_job(jobs, header))
+            in_flight.add(future)
+            future.add_done_callback(in_flight.discard)
+
+            # let the job start before the next one is got
+            await asyncio.sleep(0)
+
+        if in_flight:
+            await asyncio.gather(*in_flight)
+        getter.shutdown()
+        putter.shutdown()
+
+        return self._retired
+
+    def _get_timeout(self):
+        """
+        Returns how long a get waits for a job, which is bounded for an
+        autoscaled worker so that it notices when it is retired while its
+        input queue is empty.
+        """
+
+        return None if self.retire is None else self.RETIRE_POLL_INTERVAL
+
+    def _get_job(self, input_q, input_job, job, timeout=None):
+        """
+        Gets a job from `input_q` within `timeout` and copies it into `job`.
+        Returns the status of the get and the sequence number, origin time
+        and time put of the job (see `ptlib.core.queue.FIFOQueue.trace`).
+        """
+
+        if (input_status := input_q.get(timeout=timeout)) is True:
+            self._copy_job(input_job, job)
+
+        return input_status, (input_q.seq, input_q.origin, input_q.enqueued)
+
+    def _put_job(self, output_q, output_job, job, seq, origin=None):
+        """
+        Copies `job` into the local output job and puts it into `output_q`
+        with the sequence number `seq` and origin time `origin`.
+        """
+
+        self._copy_job(job, output_job, copy=False)
+        output_q.seq, output_q.origin = seq, origin
+        output_q.put(timeout=None)
+
+    @staticmethod
+    def _copy_job(job, other_job, copy=True):
+        """
+        Copies the subjobs of `job` into `other_job` and returns it. A subjob
+        whose shape differs (such as a ragged one) replaces the subjob of
+        `other_job`, with a copy if `copy` is True. If `other_job` is None,
+        a new job is returned.
+        """
+
+        if job is None:
+            return None
+        if other_job is None:
+            other_job = Job()
+
+        for key, subjob in job.items():
+            if key in other_job and \
+                    np.shape(other_job[key]) == np.shape(subjob):
+                other_job[key][...] = subjob
+            else:
+                other_job[key] = np.array(subjob) if copy else subjob
+
+        return other_job
+
+    def _get_batch(self, input_q, input_job, batch_size, timeout=None):
+        """
+        Copies up to `batch_size` jobs from `input_q` (waiting at most
+        `timeout` for the first one) into `input_job` and
+        sets `self.batch_len` to the number of jobs copied. Returns True or
+        the flag returned by `input_q.get_many`.
+        """
+
+        # the first task has no input, so it fills an entire batch
+        if input_job is None:
+            self.batch_len = batch_size
+            return True
+
+        with input_q.get_many(batch_size, timeout=timeout) as jobs:
+            if not isinstance(jobs, Job):
+                return jobs
+
+            # copy the payloads so the slots are freed as soon as possible
+            self.batch_len = len(jobs._buffer)
+            input_job._buffer[:self.batch_len] = jobs._buffer
+
+        return True
+
+
+class Worker(_WorkerBase, Process):
+    """ Worker class. *** come back*** """
+
+
+class ThreadWorker(_WorkerBase, Thread):
+    """
+    Worker that runs as a thread of the controller's process (see
+    `Task.THREADED`). This suits tasks whose job map mostly runs code that
+    releases the GIL (such as NumPy or OpenCV). Each thread uses its own
+    copies of the queues (see `ptlib.core.queue.BaseQueue._copy`). The
+    attributes used by the controller mirror those of a process.
+    """
+
+    def __init__(self, Task, num_workers, task_id, worker_id, input_q, output_q, meta_rings):
+        super().__init__(Task, num_workers, task_id, worker_id,
+                         input_q._copy(), output_q._copy(), meta_rings)
+        self.exitcode = None
+
+        # becomes ready when the thread exits, like the sentinel of a process
+        self.sentinel, self._exit_conn = Pipe(duplex=False)
+
+    @property
+    def pid(self):
+        return None if self.ident is None else os.getpid()
+
+    def run(self):
+        try:
+            super().run()
+            self.exitcode = 0
+        except BaseException:
+            self.exitcode = 1
+            raise
+        finally:
+            self._exit_conn.send(self.exitcode)
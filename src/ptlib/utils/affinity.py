@@ -0,0 +1,113 @@
+import os
+from contextlib import contextmanager
+from glob import glob
+
+import ptlib._backend as PTCONFIG
+
+
+def get_numa_nodes():
+    """
+    Returns the cores that this process may run on, grouped by NUMA node. If
+    the topology is unknown (for example, on platforms other than Linux), all
+    cores are returned as a single node.
+    """
+
+    allowed = get_affinity()
+
+    nodes = list()
+    for path in sorted(glob(os.path.join(PTCONFIG._AFFINITY.NODE_DIR,
+                                         "node*", "cpulist"))):
+        with open(path) as f:
+            cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in allowed]
+        if cpus:
+            nodes.append(cpus)
+
+    return nodes or [sorted(allowed)]
+
+
+def get_affinity():
+    """
+    Returns the set of cores that the calling thread may run on.
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        return os.sched_getaffinity(0)
+
+    return set(range(os.cpu_count()))
+
+
+def set_affinity(cpus: set):
+    """
+    Pins the calling thread (or process) to the cores in `cpus`. Returns
+    False if pinning is not supported on this platform.
+    """
+
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+
+    os.sched_setaffinity(0, cpus)
+
+    return True
+
+
+@contextmanager
+def pinned(cpus: set):
+    """
+    Pins the calling thread to the cores in `cpus` until the context exits.
+    Memory that is first touched inside the context is allocated on their
+    NUMA node.
+    """
+
+    previous = get_affinity()
+    set_affinity(cpus)
+    try:
+        yield
+    finally:
+        set_affinity(previous)
+
+
+def place_tasks(tasks: list, nodes: list):
+    """
+    Returns the cores of each worker of each task in `tasks` (which must be
+    in topological order), as a list of sets for each task. Each worker gets
+    a core of its own, and a task is placed on the NUMA node of the task it
+    follows while that node has enough free cores, so producers and consumers
+    share caches and memory. Once no node has enough free cores, the workers
+    of a task share all cores of the node with the most free cores.
+    """
+
+    free = [list(cpus) for cpus in nodes]
+    node_of, placement = dict(), dict()
+    for task in tasks:
+        num_workers = task._get_max_workers()
+
+        # prefer the nodes of the tasks it follows
+        preferred = [node_of[parent] for parent in task.parents
+                     if parent in node_of]
+        by_free = sorted(range(len(nodes)), key=lambda i: -len(free[i]))
+        node = next((i for i in preferred + by_free
+                     if len(free[i]) >= num_workers), by_free[0])
+        node_of[task] = node
+
+        if len(free[node]) >= num_workers:
+            placement[task] = [{cpu} for cpu in free[node][:num_workers]]
+            del free[node][:num_workers]
+        else:
+            placement[task] = [set(nodes[node])]
+
+    return placement
+
+
+def _parse_cpulist(cpulist: str):
+    """
+    Returns the cores in a list such as "0-3,8-11" (see `man 7 cpuset`).
+    """
+
+    cpus = list()
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+
+    return cpus
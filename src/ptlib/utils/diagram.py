@@ -4,10 +4,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 from random import random
 from time import time_ns
-from pickle import dump
+from pickle import dump, load
 
 import ptlib._backend as PTCONFIG
-from ptlib.core.metadata import MetadataManager
+from ptlib.core.metadata import MetadataManager, LatencyHistogram
 
 
 class Diagram:
@@ -22,12 +22,20 @@ class Diagram:
     # time scaling divider
     TIME_DIV = PTCONFIG._DIAGRAM.TIME_DIV
 
+    # number of jobs per chunk when computing statistics
+    STATS_CHUNK_SIZE = PTCONFIG._DIAGRAM.STATS_CHUNK_SIZE
+
+    # percentiles of job durations printed for each task
+    PERCENTILES = PTCONFIG._DIAGRAM.PERCENTILES
+
     def __init__(self,
                  total_jobs: int = None,
                  start_time: int = None,
                  finish_time: int = None,
                  process_names: dict[str] = None,
                  metadata: dict[int, int] = None,
+                 histograms: dict[int] = None,
+                 traces: dict[int] = None,
                  *,
                  meta_manager: MetadataManager = None):
         """
@@ -44,9 +52,20 @@ class Diagram:
             metadata -- dict[task_id, worker_id][i] = (job_start, job_finish)
                 Look at `ptlib.core.metadata.MetadataManager` for a more 
                 detailed explanation.
+            histograms -- dict[task_id]
+                Dict where each entry is the 
+                `ptlib.core.metadata.LatencyHistogram` of the job durations 
+                of the task with `id=task_id`. If None, the histograms are 
+                counted from `metadata`.
+            traces -- dict[task_id]
+                Dict where each entry is the (num jobs, total queue wait,
+                total latency, wait histogram, latency histogram) of the
+                traced jobs of the task with `id=task_id`. Look at
+                `ptlib.core.metadata.MetadataManager._traces` for a more
+                detailed explanation.
         """
 
-        assert isinstance(
+        assert meta_manager is None or isinstance(
             meta_manager, MetadataManager), f"meta_manager is the wrong type: {type(meta_manager)}"
 
         self._total_jobs = meta_manager._total_jobs if meta_manager else total_jobs
@@ -59,6 +78,11 @@ class Diagram:
 
         self._meta = {index: (names[index], meta[index])
                       for index in names.keys()}
+        self._hists = meta_manager._hists if meta_manager else histograms
+        self._traces = {task_id: (*trace, meta_manager._wait_hists[task_id],
+                                  meta_manager._latency_hists[task_id])
+                        for task_id, trace in meta_manager._traces.items()} \
+            if meta_manager else traces or dict()
 
         # create diagram plots
         self.ax_ptd = plt.subplot2grid((2, 3), (0, 0), colspan=5)
@@ -66,6 +90,35 @@ class Diagram:
         self.ax_times = plt.subplot2grid((2, 3), (1, 1), colspan=1)
         self.ax_rates = plt.subplot2grid((2, 3), (1, 2), colspan=1)
 
+    @classmethod
+    def from_spill(cls, spill_dir: str):
+        """
+        Alternative constructor for metadata spilled to `spill_dir` by a
+        `ptlib.Controller`. The timings of each worker are opened with
+        `np.memmap`, so they are only read from disk as they are used.
+        """
+
+        with open(os.path.join(spill_dir, MetadataManager.SPILL_MANIFEST), "rb") as f:
+            manifest = load(f)
+
+        metadata = {index: np.memmap(os.path.join(spill_dir, path),
+                                     dtype=np.int64, mode="r").reshape(-1, 2)
+                    for index, path in manifest["paths"].items()}
+
+        histograms = manifest.get("histograms")
+        if histograms is not None:
+            histograms = {task_id: LatencyHistogram(counts)
+                          for task_id, counts in histograms.items()}
+
+        traces = {task_id: (*trace, LatencyHistogram(
+            manifest["wait_histograms"][task_id]), LatencyHistogram(
+            manifest["latency_histograms"][task_id]))
+            for task_id, trace in manifest.get("traces", dict()).items()}
+
+        return cls(manifest["total_jobs"], manifest["start_time"],
+                   manifest["finish_time"], manifest["process_names"],
+                   metadata, histograms, traces)
+
     def show(self):
         """ 
         Displays current graphs by using `plt.show()`. 
@@ -181,47 +234,130 @@ class Diagram:
         self._finish = self._finish or time_ns()
         stats = list()
         for (task_id, worker_id), (name, metadata) in self._meta.items():
-
-            num_jobs = len(metadata)
-            time_on = time_off = 0
+            metadata = np.asarray(metadata, dtype=np.int64).reshape(-1, 2)
 
             # Start and finish times are specificed by first pair
             assert len(
                 metadata) > 0, f"Error: Worker has no metadata stored. | Name: {name}, Metadata: {metadata}"
-            off_since, finish = metadata[0]
-            metadata = metadata[1:]
+            (start, finish), metadata = metadata[0], metadata[1:]
+            num_jobs = len(metadata)
+
+            # go through the jobs in chunks (which bounds memory use if they
+            # are memory-mapped)
+            off_since, time_on, time_off = start, 0, 0
+            for i in range(0, num_jobs, self.STATS_CHUNK_SIZE):
+                chunk = np.asarray(metadata[i:i + self.STATS_CHUNK_SIZE])
 
-            # increment accumulators
-            for ont, offt in metadata:
-                time_off += ont - off_since
-                time_on += offt - ont
-                off_since = offt
+                # differences of [off since, on 1, off 1, on 2, ...] alternate
+                # between time spent off and time spent on
+                gaps = np.diff(np.append(off_since, chunk.ravel()))
+                time_off += int(np.sum(gaps[0::2]))
+                time_on += int(np.sum(gaps[1::2]))
+                off_since = chunk[-1, 1]
 
             # check edge case
             if finish > off_since:
-                time_off += finish - off_since
+                time_off += int(finish - off_since)
 
             # calculate rates
             rate_on = num_jobs / time_on if time_on else 0
-            rate_off = num_jobs / time_off if time_on else 0
+            rate_off = num_jobs / time_off if time_off else 0
 
             stats.append((name, worker_id, num_jobs, time_on,
                           time_off, rate_on, rate_off))
 
         return stats
 
-    def _create_ptd_lines(self, name: str, metadata: list, y: float):
+    def get_latency_stats(self):
+        """
+        Returns the number of jobs of each task and the duration of its jobs
+        in nanoseconds at each of `PERCENTILES`, as a list of
+        (task name, task id, num jobs, [durations]). The durations are known
+        to within the precision of `ptlib.core.metadata.LatencyHistogram`,
+        and are None if the task has no jobs.
+        """
+
+        hists = self._hists
+        if hists is None:
+            hists = dict()
+            for (task_id, _), (_, metadata) in self._meta.items():
+                hist = self._count_durations(metadata)
+                hists[task_id] = hists[task_id] + hist if task_id in hists \
+                    else hist
+
+        # name each task after its workers (which are named "task: worker")
+        names = {task_id: name.rsplit(": ", 1)[0]
+                 for (task_id, _), (name, _) in self._meta.items()}
+
+        return [(names.get(task_id, str(task_id)), task_id, hist.get_count(),
+                 hist.get_percentiles(self.PERCENTILES))
+                for task_id, hist in sorted(hists.items())]
+
+    def get_trace_stats(self):
+        """
+        Returns where the latency of the traced jobs (see
+        `ptlib.core.queue.FIFOQueue.trace`) accumulates, as a list of
+        (task name, task id, num jobs, mean queue wait, mean compute, mean
+        latency, [latencies]) in nanoseconds for each task in order of id.
+        The queue wait is the time a job spent in the input queue of the
+        task, the compute is the time a worker spent on it and the latency
+        is the time since the job originated in the first task, at each of
+        `PERCENTILES`.
+        """
+
+        # name each task after its workers (which are named "task: worker")
+        names = {task_id: name.rsplit(": ", 1)[0]
+                 for (task_id, _), (name, _) in self._meta.items()}
+
+        # the mean duration of the jobs of each task
+        busy, num_jobs = dict(), dict()
+        for (task_id, _), (_, metadata) in self._meta.items():
+            for i in range(1, len(metadata), self.STATS_CHUNK_SIZE):
+                chunk = np.asarray(metadata[i:i + self.STATS_CHUNK_SIZE],
+                                   dtype=np.int64).reshape(-1, 2)
+                busy[task_id] = busy.get(task_id, 0) + \
+                    int(np.sum(chunk[:, 1] - chunk[:, 0]))
+                num_jobs[task_id] = num_jobs.get(task_id, 0) + len(chunk)
+
+        stats = list()
+        for task_id, (num, wait, latency, _, latency_hist) in \
+                sorted(self._traces.items()):
+            compute = busy.get(task_id, 0) / num_jobs[task_id] \
+                if num_jobs.get(task_id) else None
+            stats.append((names.get(task_id, str(task_id)), task_id, num,
+                          wait / num, compute, latency / num,
+                          latency_hist.get_percentiles(self.PERCENTILES)))
+
+        return stats
+
+    def _count_durations(self, metadata: np.ndarray):
+        """
+        Returns the `ptlib.core.metadata.LatencyHistogram` of the jobs of a
+        single worker, going through them in chunks.
+        """
+
+        hist = LatencyHistogram()
+        for i in range(1, len(metadata), self.STATS_CHUNK_SIZE):
+            chunk = np.asarray(metadata[i:i + self.STATS_CHUNK_SIZE],
+                               dtype=np.int64).reshape(-1, 2)
+            hist += LatencyHistogram.from_durations(chunk[:, 1] - chunk[:, 0])
+
+        return hist
+
+    def _create_ptd_lines(self, name: str, metadata: np.ndarray, y: float):
         """ 
         Creates curve on the timing diagram for a single worker.
         """
 
+        metadata = np.asarray(metadata, dtype=np.int64).reshape(-1, 2)
+
         # Start and finish times are specificed by first pair
         assert len(
             metadata) > 0, f"Error: PTProcess has no metadata stored. | Name: {name}, Metadata: {metadata}"
 
         # set inital on/off times
-        off_since, finish = metadata[0]
-        metadata = metadata[1:]
+        (off_since, finish), metadata = metadata[0], metadata[1:]
+        ont, offt = metadata[:, 0], metadata[:, 1]
 
         # give curve a random color
         color = (random(), random(), random())
@@ -229,13 +365,14 @@ class Diagram:
         # add label
         self.ax_ptd.hlines(y, off_since, off_since, color=color, label=name)
 
-        # create vertical and horizontal lines
-        for ont, offt in metadata:
-            self.ax_ptd.hlines(y, off_since, ont, color=color)
-            self.ax_ptd.vlines(ont, y, y + 1, color=color)
-            self.ax_ptd.hlines(y + 1, ont, offt, color=color)
-            self.ax_ptd.vlines(offt, y, y + 1, color=color)
-            off_since = offt
+        # create vertical and horizontal lines (one collection for all jobs)
+        low, high = np.full(len(metadata), y), np.full(len(metadata), y + 1)
+        self.ax_ptd.hlines(low, np.append(off_since, offt)[:-1], ont, color=color)
+        self.ax_ptd.vlines(ont, low, high, color=color)
+        self.ax_ptd.hlines(high, ont, offt, color=color)
+        self.ax_ptd.vlines(offt, low, high, color=color)
+        if len(metadata):
+            off_since = offt[-1]
 
         # extend LOW line
         if finish > off_since:
@@ -263,6 +400,33 @@ class Diagram:
             s += f" | {time_on} s on, {time_off} s off"
             s += f" | {rate_on} j/s on, {rate_off} j/s off\n"
 
+        # print the percentiles of the job durations of each task
+        s += "\n"
+        for name, task_id, num_jobs, durations in self.get_latency_stats():
+            s += f"Task: {name} & Task ID: {task_id} -- {num_jobs} jobs |"
+            for percentile, duration in zip(self.PERCENTILES, durations):
+                duration = "-" if duration is None else \
+                    f"{duration / self.TIME_DIV * 1e3:.3f} ms"
+                s += f" p{percentile:g}: {duration}"
+            s += "\n"
+
+        # print the queue wait, compute and latency of the traced jobs at
+        # each task, so the stages where latency accumulates stand out
+        if trace_stats := self.get_trace_stats():
+            s += "\n"
+        for name, task_id, num_jobs, wait, compute, latency, latencies in \
+                trace_stats:
+            wait, compute, latency = ["-" if t is None else
+                                      f"{t / self.TIME_DIV * 1e3:.3f} ms"
+                                      for t in (wait, compute, latency)]
+            s += f"Task: {name} & Task ID: {task_id} -- {num_jobs} traced"
+            s += f" jobs | {wait} queue wait, {compute} compute"
+            s += f" | {latency} latency"
+            for percentile, duration in zip(self.PERCENTILES, latencies):
+                s += f" p{percentile:g}: "
+                s += f"{duration / self.TIME_DIV * 1e3:.3f} ms"
+            s += "\n"
+
         s += "\n" + "=" * self.CONSOLE_WIDTH
 
         return s
@@ -0,0 +1,257 @@
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import time_ns
+
+import ptlib._backend as PTCONFIG
+
+
+class MetricsExporter:
+    """
+    Publishes the metrics of a running pipeline in the Prometheus text
+    exposition format, which OpenMetrics scrapers also accept. The metrics
+    are served over HTTP at `http://HOST:port/metrics`, written to a text
+    file (e.g. for the textfile collector of node_exporter), or both. Only
+    the standard library is used.
+
+    The controller renders the metrics in its run loop (see `export`) and the
+    server only hands out the last rendering, so a scrape never reads the
+    metadata or queues while the controller updates them.
+
+    Metrics (all prefixed with `PREFIX`, and labelled with the task name and
+    id, and the worker id for worker metrics):
+        task_jobs_total -- counter
+            The jobs finished by the workers of a task.
+        task_throughput -- gauge
+            The jobs per second finished by a task since the last export.
+        task_job_duration_seconds -- histogram
+            The time spent on each job by the workers of a task.
+        worker_jobs_total -- counter
+            The jobs finished by a worker.
+        worker_busy_seconds_total -- counter
+            The time a worker spent on jobs.
+        worker_busy_ratio -- gauge
+            The fraction of its lifetime a worker spent on jobs.
+        queue_* -- gauges and counters
+            The telemetry of the output queue of each task that other tasks
+            follow (see `ptlib.core.queue.FIFOQueue.get_stats`).
+    """
+
+    # the host the server listens on and the prefix of every metric
+    HOST = PTCONFIG._EXPORTER.HOST
+    PREFIX = PTCONFIG._EXPORTER.PREFIX
+
+    # upper bounds in nanoseconds of the buckets of duration histograms
+    BUCKETS = PTCONFIG._EXPORTER.BUCKETS_NS
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, port: int = None, path: str = None):
+        """
+        Parameters:
+            port -- int
+                If given, the port on `HOST` that the metrics are served on.
+                Port 0 picks a free port, which is then stored in `port`.
+            path -- str
+                If given, the file the metrics are written to. The file is
+                replaced atomically, so readers never see a partial export.
+        """
+
+        self.port, self.path = port, path
+
+        # the last rendering and the jobs of each task when it was rendered
+        self._text = b""
+        self._last = (None, dict())
+
+        # serve metrics from a daemon thread
+        self._server = None
+        if port is not None:
+            self._server = ThreadingHTTPServer((self.HOST, port),
+                                               self._make_handler())
+            self._server.daemon_threads = True
+            self.port = self._server.server_address[1]
+            Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def export(self, meta_manager, tasks: list, queue_stats: dict):
+        """
+        Renders the metrics of `tasks` from `meta_manager`
+        (see `ptlib.core.metadata.MetadataManager`) and `queue_stats` (see
+        `ptlib.Controller.stats`) and publishes them.
+        """
+
+        self.publish(self.render(meta_manager, tasks, queue_stats))
+
+    def publish(self, text: str):
+        """
+        Serves `text` to later scrapes and writes it to `path`.
+        """
+
+        self._text = text.encode()
+
+        if self.path is not None:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(self._text)
+            os.replace(tmp_path, self.path)
+
+    def close(self):
+        """
+        Stops serving metrics.
+        """
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def render(self, meta_manager, tasks: list, queue_stats: dict):
+        """
+        Returns the metrics (see `export`) in the text exposition format.
+        """
+
+        now = time_ns()
+        last_time, last_jobs = self._last
+
+        # per worker
+        names = {task.id: task.name for task in tasks}
+        jobs, busy, ratio = list(), list(), list()
+        task_jobs = dict()
+        for (task_id, worker_id), meta in meta_manager._meta.items():
+            labels = self._labels(task=names[task_id], task_id=task_id,
+                                  worker=worker_id)
+
+            num_jobs = len(meta) - 1
+            busy_ns = meta_manager._worker_busy.get((task_id, worker_id), 0)
+            start, finish = meta[0]
+            lifetime = (finish if finish > start else now) - start
+
+            jobs.append(("", labels, num_jobs))
+            busy.append(("", labels, busy_ns / 1e9))
+            if start > 0 and lifetime > 0:
+                ratio.append(("", labels, busy_ns / lifetime))
+
+            task_jobs[task_id] = task_jobs.get(task_id, 0) + num_jobs
+
+        # per task
+        total, rate, latency = list(), list(), list()
+        for task in tasks:
+            labels = self._labels(task=task.name, task_id=task.id)
+            num_jobs = task_jobs.get(task.id, 0)
+            total.append(("", labels, num_jobs))
+
+            if last_time is not None and now > last_time:
+                rate.append(("", labels, (num_jobs - last_jobs.get(
+                    task.id, 0)) / (now - last_time) * 1e9))
+
+            # (the buckets of the histogram are merged into `BUCKETS`)
+            if (hist := meta_manager._hists.get(task.id)) is None:
+                continue
+            for bound in self.BUCKETS:
+                latency.append(("_bucket", self._labels(
+                    task=task.name, task_id=task.id, le=f"{bound / 1e9:g}"),
+                    hist.get_count(bound)))
+            latency.append(("_bucket", self._labels(
+                task=task.name, task_id=task.id, le="+Inf"),
+                hist.get_count()))
+            latency.append(("_sum", labels, hist.total / 1e9))
+            latency.append(("_count", labels, hist.get_count()))
+
+        self._last = (now, task_jobs)
+
+        metrics = [
+            ("task_jobs_total", "counter",
+             "Jobs finished by the workers of a task.", total),
+            ("task_throughput", "gauge",
+             "Jobs per second finished by a task since the last export.", rate),
+            ("task_job_duration_seconds", "histogram",
+             "Time spent on each job by the workers of a task.", latency),
+            ("worker_jobs_total", "counter",
+             "Jobs finished by a worker.", jobs),
+            ("worker_busy_seconds_total", "counter",
+             "Time a worker spent on jobs.", busy),
+            ("worker_busy_ratio", "gauge",
+             "Fraction of its lifetime a worker spent on jobs.", ratio)]
+
+        # per output queue
+        queue_metrics = [
+            ("queue_depth", "gauge", "Jobs in the output queue of a task.",
+             lambda stats: stats["puts"] - stats["gets"]),
+            ("queue_high_water", "gauge",
+             "Most jobs ever in the output queue of a task.",
+             lambda stats: stats["high_water"]),
+            ("queue_puts_total", "counter",
+             "Jobs put in the output queue of a task.",
+             lambda stats: stats["puts"]),
+            ("queue_gets_total", "counter",
+             "Jobs got from the output queue of a task.",
+             lambda stats: stats["gets"]),
+            ("queue_full_waits_total", "counter",
+             "Puts that found the output queue of a task full.",
+             lambda stats: stats["full_waits"]),
+            ("queue_empty_waits_total", "counter",
+             "Gets that found the output queue of a task empty.",
+             lambda stats: stats["empty_waits"]),
+            ("queue_put_blocked_seconds_total", "counter",
+             "Time puts waited for the output queue of a task.",
+             lambda stats: stats["put_blocked_ns"] / 1e9),
+            ("queue_get_blocked_seconds_total", "counter",
+             "Time gets waited for the output queue of a task.",
+             lambda stats: stats["get_blocked_ns"] / 1e9)]
+        for name, kind, help, value in queue_metrics:
+            metrics.append((name, kind, help, [
+                ("", self._labels(task=stats["task"], task_id=task_id),
+                 value(stats)) for task_id, stats in queue_stats.items()]))
+
+        return "".join(self._format(*metric) for metric in metrics)
+
+    def _format(self, name: str, kind: str, help: str, samples: list):
+        """
+        Returns the lines of metric `name` of type `kind`, where each sample
+        in `samples` is a (name suffix, labels, value).
+        """
+
+        name = f"{self.PREFIX}_{name}"
+        lines = [f"# HELP {name} {help}\n", f"# TYPE {name} {kind}\n"]
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{{{labels}}} {value}\n")
+
+        return "".join(lines)
+
+    @staticmethod
+    def _labels(**labels):
+        """
+        Returns `labels` formatted as the labels of a sample.
+        """
+
+        def escape(value):
+            return str(value).replace("\\", r"\\").replace(
+                "\"", r"\"").replace("\n", r"\n")
+
+        return ",".join(f"{key}=\"{escape(value)}\""
+                        for key, value in labels.items())
+
+    def _make_handler(self):
+        """
+        Returns the request handler of the server, which answers GET requests
+        for /metrics with the last rendering.
+        """
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                text = exporter._text
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
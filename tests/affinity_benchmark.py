@@ -0,0 +1,76 @@
+import numpy as np
+from time import time_ns
+
+import ptlib as pt
+from ptlib.utils.affinity import get_numa_nodes
+
+# large jobs, so copying slots dominates (a 1080p frame)
+FRAME_SHAPE = (1080, 1920, 3)
+
+NUM_JOBS = 500
+AFFINITIES = [None, "auto"]
+
+
+class Frames(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        frame = output_job["frame"]
+        worker.count = 0
+
+        def job_map():
+            frame[0, 0, 0] = worker.count
+            worker.count += 1
+            if worker.count >= NUM_JOBS:
+                worker.EXIT_FLAG = True
+
+        return job_map
+
+    @classmethod
+    def output_spec(cls):
+        return pt.JobSpec(FRAME_SHAPE, np.uint8, name="frame")
+
+
+class Invert(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        frame = input_job["frame"]
+        inverted = output_job["inverted"]
+
+        def job_map():
+            np.subtract(255, frame, out=inverted)
+
+        return job_map
+
+    @classmethod
+    def output_spec(cls):
+        return pt.JobSpec(FRAME_SHAPE, np.uint8, name="inverted")
+
+
+class Mean(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        inverted = input_job["inverted"]
+        worker.total = 0
+
+        def job_map():
+            worker.total += inverted[::64, ::64].mean()
+
+        return job_map
+
+
+if __name__ == '__main__':
+    print(f"NUMA nodes: {get_numa_nodes()}")
+
+    results = list()
+    for cpu_affinity in AFFINITIES:
+        tasks = Frames(1), Invert(2), Mean(1)
+        for task in tasks:
+            task.CPU_AFFINITY = cpu_affinity
+
+        controller = pt.Controller(tasks[0] >> tasks[1] >> tasks[2],
+                                   total_jobs=NUM_JOBS)
+
+        t = time_ns()
+        controller.run()
+        t = (time_ns() - t) / 1e9
+        results.append((cpu_affinity, NUM_JOBS / t))
+
+    for cpu_affinity, jobs_per_second in results:
+        print(f"{str(cpu_affinity):>6} | Jobs/s: {jobs_per_second:.0f}")
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+from time import sleep, time_ns
+
+import ptlib as pt
+
+NUM_JOBS = 500
+NUM_CONSUMERS = 4
+PRODUCER_DELAY = 2e-3  # seconds between jobs, so consumers are mostly idle
+
+
+class Producer(pt.Task):
+    """ Task that slowly produces small jobs. """
+
+    def create_map(self, worker, input_job, output_job):
+        osj1 = output_job["data"]
+
+        # spawned workers re-import this file, so read job count from env
+        num_jobs = int(os.environ.get("PTLIB_BENCH_JOBS", NUM_JOBS))
+        worker.count = 0
+
+        def job_map():
+            sleep(PRODUCER_DELAY)
+            osj1[:] = np.full(16, worker.count)
+            worker.count += 1
+
+            if worker.count >= num_jobs:
+                worker.EXIT_FLAG = True
+
+        return job_map
+
+
+class Consumer(pt.Task):
+    """ Task that does almost no work per job. """
+
+    def create_map(self, worker, input_job, output_job):
+        isj1 = input_job["data"]
+
+        def job_map():
+            isj1.sum()
+
+        return job_map
+
+
+def run(num_jobs):
+    """
+    Runs the pipeline and returns the wall time and the CPU time used by the
+    worker processes.
+    """
+
+    os.environ["PTLIB_BENCH_JOBS"] = str(num_jobs)
+    pipeline = Producer(num_workers=1) >> Consumer(num_workers=NUM_CONSUMERS)
+    controller = pt.Controller(pipeline, 5, total_jobs=num_jobs)
+
+    # worker processes are reaped by the controller, so they count as children
+    start = os.times()
+    t = time_ns()
+    controller.run()
+    wall_time = (time_ns() - t) / 1e9
+    finish = os.times()
+
+    cpu_time = (finish.children_user - start.children_user) + \
+        (finish.children_system - start.children_system)
+
+    return wall_time, cpu_time
+
+
+if __name__ == '__main__':
+    # a one job run measures the cost of starting and stopping the workers
+    _, startup_cpu_time = run(1)
+    wall_time, cpu_time = run(NUM_JOBS)
+
+    per_job = (cpu_time - startup_cpu_time) / (NUM_JOBS - 1)
+
+    print(f"Wall Time: {wall_time:.2f} s")
+    print(f"Worker CPU Time: {cpu_time:.2f} s "
+          f"({startup_cpu_time:.2f} s startup)")
+    print(f"Worker CPU Time per Job: {1e3 * per_job:.3f} ms")
@@ -0,0 +1,48 @@
+import numpy as np
+from time import time_ns
+
+import ptlib as pt
+from ptlib.core.job import JobSpec
+
+# a few scalars per job, so the cost of each queue operation dominates
+test_job = np.zeros(4)
+
+NUM_TESTS = 100000
+BATCH_SIZE = 64
+
+
+if __name__ == '__main__':
+    print(f"Generating {NUM_TESTS} random jobs of shape {test_job.shape}...")
+    TEST_ARRAYS = np.array(np.random.rand(
+        NUM_TESTS, *test_job.shape), dtype=test_job.dtype)
+
+    print("Beginning tests...")
+
+    pt_q = pt.Queue(JobSpec(name="x", example=test_job), capacity=BATCH_SIZE)
+    local_job = pt_q._link_mem()
+    local_batch = pt_q._link_mem(batch_size=BATCH_SIZE)
+
+    t1 = time_ns()
+    for job in TEST_ARRAYS:
+        local_job["x"][:] = job
+        pt_q.put()
+        pt_q.get()
+    t1 = (time_ns() - t1) / 1e9
+    print(f"Single Jobs/s: {NUM_TESTS / t1:.0f}")
+
+    t2 = time_ns()
+    for i in range(0, NUM_TESTS, BATCH_SIZE):
+        batch = TEST_ARRAYS[i:i + BATCH_SIZE]
+        local_batch["x"][:len(batch)] = batch
+        pt_q.put_many(local_batch._buffer[:len(batch)])
+
+        # a batch that wraps around the ring comes back in two parts
+        num_received = 0
+        while num_received < len(batch):
+            with pt_q.get_many(BATCH_SIZE) as jobs:
+                num_received += len(jobs["x"])
+    t2 = (time_ns() - t2) / 1e9
+    print(f"Batched Jobs/s: {NUM_TESTS / t2:.0f}")
+
+    ratio = t1 / t2
+    print(f"Batches of {BATCH_SIZE} are {ratio} times faster")
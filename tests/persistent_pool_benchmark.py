@@ -0,0 +1,83 @@
+import numpy as np
+from time import time_ns
+
+import ptlib as pt
+
+NUM_RUNS = 5
+NUM_JOBS = 100
+
+
+class Count(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        x = output_job["x"]
+
+        def job_map():
+            x[:] = np.arange(4) + worker.count
+            worker.count += 1
+            if worker.count >= (worker.inputs or 1):
+                worker.EXIT_FLAG = True
+
+        return job_map
+
+    def reset(self, worker, inputs):
+        super().reset(worker, inputs)
+        worker.count = 0
+
+
+class Square(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        x = input_job["x"]
+        y = output_job["y"]
+
+        def job_map():
+            y[:] = x ** 2
+
+        return job_map
+
+
+class Sum(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        y = input_job["y"]
+
+        def job_map():
+            worker.total += y.sum()
+
+        return job_map
+
+    def reset(self, worker, inputs):
+        super().reset(worker, inputs)
+        worker.total = 0
+
+
+def create_pipeline():
+    return Count(1) >> Square(2) >> Sum(1)
+
+
+if __name__ == '__main__':
+    print(f"Running a pipeline {NUM_RUNS} times with {NUM_JOBS} jobs each...")
+
+    # a new controller (and new worker processes) for every run
+    t1 = time_ns()
+    for _ in range(NUM_RUNS):
+        pt.Controller(create_pipeline(), total_jobs=NUM_JOBS).run(NUM_JOBS)
+    t1 = (time_ns() - t1) / 1e9 / NUM_RUNS
+
+    # one controller whose workers stay alive between runs
+    controller = pt.Controller(create_pipeline(), total_jobs=NUM_JOBS,
+                               persistent=True)
+    t2 = time_ns()
+    controller.run(NUM_JOBS)
+    first = (time_ns() - t2) / 1e9
+
+    t3 = time_ns()
+    for _ in range(NUM_RUNS - 1):
+        controller.run(NUM_JOBS)
+    t3 = (time_ns() - t3) / 1e9 / (NUM_RUNS - 1)
+    controller.close()
+
+    print(f"New Controller Seconds/Run: {t1:.4f}")
+    print(f"Persistent First Run Seconds: {first:.4f}")
+    print(f"Persistent Seconds/Run: {t3:.4f}")
+
+    ratio = t1 / t3
+    print(f"Reused workers start runs {ratio} times faster")
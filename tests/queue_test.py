@@ -114,7 +114,7 @@ if __name__ == '__main__':
     meta_manager = MetadataManager(pipeline)
 
     # create workers and assign them to task
-    pipeline.create_workers(input_q, output_q, meta_manager.meta_q)
+    pipeline.create_workers(input_q, output_q, meta_manager.meta_rings)
 
     # start pseudo-controller
     run(pipeline, meta_manager, output_q)
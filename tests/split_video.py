@@ -57,6 +57,8 @@ class VideoIngest(pt.Task):
                 osj1[i][:] = frame
                 worker.current_pos += 1
 
+            # number the clip by its position in the video
+            worker.seq = worker.batch_id
             worker.batch_id += 1
 
             # return output_batch
@@ -93,9 +95,6 @@ class VideoWrite(pt.Task):
             capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
         capture.release()
 
-        # create batch id counter
-        worker.batch_id = 0
-
         def job_map():
             if input_job is pt.Task.Exit:
                 self.EXIT_FLAG = True
@@ -104,8 +103,9 @@ class VideoWrite(pt.Task):
             # batch = input_job[0]
             batch = isj1
 
+            # (`worker.seq` is the batch id set by `VideoIngest`)
             path = os.path.join(
-                output_dir, f"{clip_name}-{worker.id}-{worker.batch_id}.mp4")
+                output_dir, f"{clip_name}-{worker.seq}.mp4")
             video = cv2.VideoWriter(
                 path, cv2.VideoWriter_fourcc(*"mp4v"), fps, resolution)
 
@@ -113,7 +113,6 @@ class VideoWrite(pt.Task):
                 video.write(frame)
 
             video.release()
-            worker.batch_id += 1
 
             # return [None]
 
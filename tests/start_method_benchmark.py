@@ -0,0 +1,63 @@
+import numpy as np
+
+import ptlib as pt
+
+NUM_JOBS = 100
+START_METHODS = ["spawn", "forkserver", "fork"]
+
+
+class Count(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        x = output_job["x"]
+        worker.count = 0
+
+        def job_map():
+            x[:] = np.arange(4) + worker.count
+            worker.count += 1
+            if worker.count >= NUM_JOBS:
+                worker.EXIT_FLAG = True
+
+        return job_map
+
+
+class Square(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        x = input_job["x"]
+        y = output_job["y"]
+
+        def job_map():
+            y[:] = x ** 2
+
+        return job_map
+
+
+class Sum(pt.Task):
+    def create_map(self, worker, input_job, output_job):
+        y = input_job["y"]
+        worker.total = 0
+
+        def job_map():
+            worker.total += y.sum()
+
+        return job_map
+
+
+if __name__ == '__main__':
+    results = list()
+    for start_method in START_METHODS:
+        controller = pt.Controller(Count(1) >> Square(2) >> Sum(1),
+                                   total_jobs=NUM_JOBS,
+                                   start_method=start_method)
+        controller.run()
+
+        # the first row of each worker's metadata is its lifetime
+        meta_manager = controller.meta_manager
+        run_start = meta_manager._start
+        worker_start = max(meta[0, 0] for meta in meta_manager._meta.values())
+        first_job = min(meta[1, 0] for meta in meta_manager._meta.values())
+        results.append((start_method, (worker_start - run_start) / 1e9,
+                        (first_job - run_start) / 1e9))
+
+    for start_method, worker_start, first_job in results:
+        print(f"{start_method:>10} | Last Worker Started: {worker_start:.4f}s "
+              f"| First Job Started: {first_job:.4f}s")
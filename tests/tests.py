@@ -1,8 +1,10 @@
+import os
 import ptlib as pt
 
 import numpy as np
 
 from ptlib.core.job import JobSpec
+from ptlib.core.queue import BaseQueue, Queue
 
 
 class TestCase:
@@ -115,7 +117,8 @@ def job_infer_test_2():
     return [tuple(js.shape) for js in job_spec1 + job_spec2]
 
 
-@add_test(solutions=[a := 3 * 9, b := np.nbytes[np.float32] * 2 * 5 * 3, a + b])
+# (the float32 subjob is padded to start on a 4 byte boundary)
+@add_test(solutions=[a := 3 * 9, b := np.nbytes[np.float32] * 2 * 5 * 3, a + 1 + b])
 def job_spec_get_nbytes_test_1():
     job_spec1 = JobSpec(example=np.ones((3, 9), dtype=np.int8))
     a1 = job_spec1.get_nbytes()
@@ -125,6 +128,1038 @@ def job_spec_get_nbytes_test_1():
 
     return a1, job_spec2.get_nbytes(), job_spec3.get_nbytes()
 
+
+@add_test(solutions=[[("a", "b", "c"), ("b", "c")]])
+def job_spec_get_dtype_test_2():
+    tail = JobSpec(name="b", example=0)
+    head = JobSpec(name="a", example=0) + tail
+    head.get_dtype(), tail.get_dtype()
+
+    # extending the chain recompiles every spec in it
+    head += JobSpec(name="c", example=0)
+
+    return [head.get_dtype().names, tail.get_dtype().names]
+
+
+@add_test(solutions=[["id", "t"], [0, 8], 24, 3.0])
+def job_spec_get_dtype_test_1():
+    job_spec = JobSpec(name="id", example=np.zeros(3, dtype=np.int8)) + \
+        JobSpec(name="t", example=np.zeros(2))
+    dtype = job_spec.get_dtype()
+
+    # every slot of a queue is one record, so subjobs can be reduced in place
+    queue = Queue(job_spec, capacity=3)
+    local_job = queue._link_mem()
+    for i in range(3):
+        local_job["t"][:] = i
+        queue.put()
+
+    fields = list(dtype.names)
+    offsets = [dtype.fields[name][1] for name in fields]
+
+    return fields, offsets, dtype.itemsize, queue._arr_dat["t"][:, 0].sum()
+
+
+@add_test(solutions=[list(range(5)), BaseQueue.Full, BaseQueue.Empty, BaseQueue.Closed])
+def spsc_queue_test_1():
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=3, spsc=True)
+    local_job = queue._link_mem()
+
+    # wraps around the ring a few times
+    received = list()
+    for i in range(5):
+        local_job["x"][:] = i
+        queue.put()
+        queue.get()
+        received.append(int(local_job["x"][0]))
+
+    # fill the queue until it refuses a job
+    while (put_status := queue.put()) is True:
+        pass
+
+    while queue.get() is True:
+        pass
+
+    empty_status = queue.get()
+    queue.close()
+
+    return received, put_status, empty_status, queue.get()
+
+
+@add_test(solutions=[[0, 1, 2], [2, 3], BaseQueue.Full])
+def fifo_queue_lease_test_1():
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=3)
+    local_job = queue._link_mem()
+
+    # release the leases out of order
+    with queue.reserve_put() as job1:
+        with queue.reserve_put() as job2:
+            job2["x"][:] = 1
+        job1["x"][:] = 0
+
+    local_job["x"][:] = 2
+    queue.put()
+
+    received = list()
+    while queue.get() is True:
+        received.append(int(local_job["x"][0]))
+
+    # slots written through a lease are read back through a lease
+    local_job["x"][:] = 3
+    with queue.reserve_put() as job:
+        job["x"][:] = 2
+    queue.put()
+
+    leased = list()
+    for _ in range(2):
+        with queue.acquire_get() as job:
+            leased.append(int(job["x"][0]))
+
+    for _ in range(3):
+        queue.put()
+
+    return received, leased, queue.put()
+
+
+@add_test(solutions=[[BaseQueue.Full, True], [BaseQueue.Full, True]])
+def fifo_queue_capacity_test_1():
+    num_jobs, capacity = 25000, 10000
+
+    results = list()
+    for spsc in (False, True):
+        queue = Queue(JobSpec(name="x", example=np.zeros(1, dtype=np.int64)),
+                      capacity=capacity, spsc=spsc)
+        local_job = queue._link_mem()
+
+        # fill every slot
+        for i in range(capacity):
+            local_job["x"][:] = i
+            queue.put()
+
+        full_status = queue.put()
+
+        # keep the queue full for a few laps around the ring
+        received = list()
+        for i in range(capacity, num_jobs):
+            queue.get()
+            received.append(int(local_job["x"][0]))
+            local_job["x"][:] = i
+            queue.put()
+
+        while queue.get() is True:
+            received.append(int(local_job["x"][0]))
+
+        results.append([full_status, received == list(range(num_jobs))])
+
+    return tuple(results)
+
+
+@add_test(solutions=[4, [[2, 3, 4], [5, 6]], BaseQueue.Empty, BaseQueue.Closed])
+def fifo_queue_batch_test_1():
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=5)
+    local_job = queue._link_mem()
+    local_batch = queue._link_mem(batch_size=5)
+
+    for i in range(3):
+        local_job["x"][:] = i
+        queue.put()
+
+    queue.get()
+    queue.get()
+
+    # only four slots are free and the batch wraps around the ring
+    local_batch["x"][:] = np.arange(3, 8)[:, np.newaxis]
+    num_put = queue.put_many(local_batch, timeout=0)
+
+    # each batch stops at the end of the ring
+    batches = list()
+    for _ in range(2):
+        with queue.get_many(10, timeout=0) as jobs:
+            batches.append(jobs["x"][:, 0].astype(int).tolist())
+
+    with queue.get_many(10, timeout=0) as jobs:
+        empty_status = jobs
+
+    queue.close()
+    with queue.get_many(10) as jobs:
+        closed_status = jobs
+
+    return num_put, batches, empty_status, closed_status
+
+
+@add_test(solutions=[[True, True, BaseQueue.Full], [0, 1]])
+def fifo_queue_reopen_test_1():
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=2)
+    local_job = queue._link_mem()
+
+    # the jobs left over from the last run are dropped
+    local_job["x"][:] = -1
+    queue.put()
+    queue.put()
+    queue.close()
+    queue._reopen()
+
+    put_status = list()
+    for i in range(3):
+        local_job["x"][:] = i
+        put_status.append(queue.put())
+
+    received = list()
+    while queue.get() is True:
+        received.append(int(local_job["x"][0]))
+
+    return put_status, received
+
+
+@add_test(solutions=[[1000, 3], BaseQueue.Empty, True, True, [1000, 3]])
+def fifo_queue_wait_policy_test_1():
+    from time import time_ns
+
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=2)
+    queue.set_wait_policy(1000, 3)
+    queue._link_mem()
+    policy = queue._arr_ctl[[queue.SPIN, queue.YIELD]].tolist()
+
+    # an empty queue is spun on and then slept on for the rest of the timeout
+    t = time_ns()
+    empty_status = queue.get(timeout=0.05)
+    waited = time_ns() - t >= 0.05 * 1e9
+
+    # a job that is already there is taken without waiting
+    queue.put()
+    get_status = queue.get(timeout=None)
+
+    # the policy is kept for the next run of a persistent pipeline
+    queue.close()
+    queue._reopen()
+
+    return policy, empty_status, waited, get_status, \
+        queue._arr_ctl[[queue.SPIN, queue.YIELD]].tolist()
+
+
+@add_test(solutions=[[0.0, 0.75, 0.5], [0.0, 0.75, 0.5]])
+def fifo_queue_fill_test_1():
+    results = list()
+    for spsc in (False, True):
+        queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=4,
+                      spsc=spsc)
+        queue._link_mem()
+
+        fills = [queue.get_fill()]
+        for _ in range(3):
+            queue.put()
+        fills.append(queue.get_fill())
+        queue.get()
+        fills.append(queue.get_fill())
+
+        results.append(fills)
+
+    return tuple(results)
+
+
+@add_test(solutions=[[(5, 2, 1, 1, 4, 0.75)] * 3, [True] * 3])
+def fifo_queue_stats_test_1():
+    counts, blocked = list(), list()
+    for kwargs in (dict(), dict(spsc=True), dict(local=True)):
+        queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=4,
+                      **kwargs)
+        queue._link_mem()
+
+        # an empty get, four puts, a full put, two gets and a put (which
+        # counts the full put, since it did not wait)
+        queue.get(timeout=0.01)
+        for _ in range(4):
+            queue.put()
+        queue.put(timeout=0)
+        for _ in range(2):
+            queue.get()
+        queue.put()
+
+        stats = queue.get_stats()
+        counts.append((stats["puts"], stats["gets"], stats["full_waits"],
+                       stats["empty_waits"], stats["high_water"],
+                       stats["fill"]))
+        blocked.append(stats["get_blocked_ns"] >= 0.01 * 1e9)
+
+    return counts, blocked
+
+
+@add_test(solutions=[[True] * 3 + [BaseQueue.Full] * 2 + [True], [[0, 1, 2, 3]] * 2, BaseQueue.Closed])
+def broadcast_queue_test_1():
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=3,
+                  num_readers=2)
+    local_job = queue._link_mem()
+    readers = [queue.get_reader(i) for i in range(2)]
+    reader_jobs = [reader._link_mem() for reader in readers]
+
+    put_status = list()
+    for i in range(4):
+        local_job["x"][:] = i
+        put_status.append(queue.put())
+
+    # a slot is only freed once both readers have read it
+    received = [list(), list()]
+    for i in (0, 1):
+        readers[i].get()
+        received[i].append(int(reader_jobs[i]["x"][0]))
+        put_status.append(queue.put())
+
+    for i in (0, 1):
+        while readers[i].get() is True:
+            received[i].append(int(reader_jobs[i]["x"][0]))
+
+    queue.close()
+
+    return put_status, received, readers[1].get()
+
+
+@add_test(solutions=[[("A", 0), ("B", 1), ("C", 2), ("D", 3), ("E", 4)], [["B", "C"], ["A"], ["B", "C"]]])
+def task_graph_test_1():
+    tasks = dict()
+    for name in "ABCDE":
+        tasks[name] = type(name, (pt.Task,), dict())()
+
+    a, b, c, d, e = tasks.values()
+    pipeline = a >> [b, c] >> d
+    d >> e
+
+    return [(task.name, task.id) for task in pipeline.iter_tasks()], \
+        [[task.name for task in tasks] for tasks in (a.children, b.parents, d.parents)]
+
+
+@add_test(solutions=[[0, 1, 2, 5], [[{0}], [{1}, {2}], [{3}], [{3, 4}]]])
+def affinity_placement_test_1():
+    from ptlib.utils.affinity import place_tasks, _parse_cpulist
+
+    # the third task no longer fits on the first node, and the last one
+    # does not fit on any node
+    pipeline = pt.Task(1) >> pt.Task(2) >> pt.Task(1) >> pt.Task(3)
+    tasks = list(pipeline.iter_tasks())
+    placement = place_tasks(tasks, [[0, 1, 2], [3, 4]])
+
+    return _parse_cpulist("0-2,5\n"), [placement[task] for task in tasks]
+
+
+@add_test(solutions=[[(0, 0), (1, 1), (2, 2), (4, 4), (3, 3), (6, 6), (7, 7)], BaseQueue.Closed])
+def ordered_queue_test_1():
+    from ptlib.core.queue import OrderedQueue
+
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=8)
+    local_job = queue._link_mem()
+
+    # job 5 never arrives and job 3 arrives after the buffer overflowed
+    for seq in (2, 0, 1, 4, 6, 3, 7):
+        local_job["x"][:] = seq
+        queue.seq = seq
+        queue.put()
+    queue.close()
+
+    ordered = OrderedQueue(queue, buffer_size=2)
+    ordered_job = ordered._link_mem()
+
+    received = list()
+    while ordered.get() is True:
+        received.append((ordered.seq, int(ordered_job["x"][0])))
+
+    return received, ordered.get()
+
+
+@add_test(solutions=[[(0, 0, 0), (2, 2, 20), (3, 3, 30), (1, 1, 10)], BaseQueue.Closed])
+def join_queue_test_1():
+    from ptlib.core.queue import JoinQueue
+
+    queues = [Queue(JobSpec(name=name, example=np.zeros(2)), capacity=8)
+              for name in "ab"]
+    local_jobs = [queue._link_mem() for queue in queues]
+
+    # the second task puts its jobs out of order and job 4 never reaches it
+    for queue, local_job, name, scale, seqs in zip(
+            queues, local_jobs, "ab", (1, 10), ([0, 1, 2, 3, 4], [2, 0, 3, 1])):
+        for seq in seqs:
+            local_job[name][:] = seq * scale
+            queue.seq = seq
+            queue.put()
+        queue.close()
+
+    joined = JoinQueue(queues, buffer_size=4)
+    joined_job = joined._link_mem()
+
+    received = list()
+    while joined.get() is True:
+        received.append((joined.seq, int(joined_job["a"][0]),
+                         int(joined_job["b"][0])))
+
+    return received, joined.get()
+
+
+@add_test(solutions=["ArenaQueue", True, [(0, 0), (3, 3), (1000, 1000)], 0.0])
+def arena_queue_test_1():
+    job_spec = JobSpec((1000, 4), np.float64, name="boxes", ragged=True) + \
+        JobSpec(name="id", example=0)
+    queue = Queue(job_spec, capacity=4)
+    local_job = queue._link_mem()
+
+    # the arena is smaller than the slots would be without it
+    nbytes = queue._shm_dat.size + queue._shm_arena.size
+    smaller = nbytes < JobSpec((1000, 4), np.float64).get_nbytes(4)
+
+    received = list()
+    for num_rows in (0, 3, 1000):
+        local_job["boxes"] = np.full((num_rows, 4), num_rows)
+        local_job["id"][...] = num_rows
+        queue.put()
+        queue.get()
+        received.append((len(local_job["boxes"]),
+                         int(local_job["boxes"].max(initial=0))))
+
+    return type(queue).__name__, smaller, received, queue.get_arena_fill()
+
+
+@add_test(solutions=[[0, 64, 128, 192], [[0, 64], [128, 64], [320, 64]]])
+def arena_free_list_test_1():
+    from ptlib.core.queue import ArenaQueue
+
+    job_spec = JobSpec((6, 8), np.uint8, name="rows", ragged=True)
+    queue = ArenaQueue(1, job_spec, arena_nbytes=6 * 64, num_producers=2)
+    queue._link_mem()
+
+    # a job in the slot and a job of each producer waiting for the slot
+    # leave three free blocks between them
+    offsets = [queue._alloc(64) for _ in range(3)]
+    queue._free(offsets[0], 64)
+    offsets.append(queue._alloc(128))
+    queue._free(offsets[2], 64)
+
+    num = queue._arr_free[0, 0]
+
+    return offsets, queue._arr_free[1:num + 1].tolist()
+
+
+@add_test(solutions=[["ValueError"] * 2])
+def arena_queue_batch_test_1():
+    class Boxes(pt.Task):
+        @classmethod
+        def output_spec(cls):
+            return JobSpec((8, 4), np.float64, name="boxes", ragged=True)
+
+    class Batched(pt.Task):
+        MICRO_BATCH_SIZE = 4
+
+        @classmethod
+        def output_spec(cls):
+            return JobSpec((8, 4), np.float64, name="boxes", ragged=True)
+
+    # micro-batching on either side of an arena is rejected up front
+    errors = list()
+    for pipeline in (Boxes() >> Batched() >> pt.Task(),
+                     Batched() >> pt.Task()):
+        try:
+            pt.Controller(pipeline)
+        except ValueError as e:
+            errors.append(type(e).__name__)
+
+    return errors
+
+
+@add_test(solutions=["LocalQueue", BaseQueue.Full, [(0, True), (1, True)], BaseQueue.Closed])
+def local_queue_test_1():
+    job_spec = JobSpec(name="x", example=np.zeros(2)) + \
+        JobSpec(name="frame", example=np.zeros((4, 4)))
+    queue = Queue(job_spec, capacity=2, local=True)
+
+    # producer and consumer threads use their own copies of the queue
+    producer, consumer = queue._copy(), queue._copy()
+    output_job, input_job = producer._link_mem(), consumer._link_mem()
+
+    # the replaced subjob is passed by reference, the other one is copied
+    frames = [np.full((4, 4), i) for i in range(2)]
+    for i, frame in enumerate(frames):
+        output_job["x"][:] = i
+        output_job["frame"] = frame
+        producer.put()
+    full_status = producer.put()
+    queue.close()
+
+    received = list()
+    while consumer.get() is True:
+        received.append((int(input_job["x"][0]),
+                         input_job["frame"] is frames[consumer.seq]))
+
+    return type(queue).__name__, full_status, received, consumer.get()
+
+
+@add_test(solutions=[[(4, 8), (3, 6), (2, 4), (1, 2), (0, 0)], 5])
+def async_task_test_1():
+    import asyncio
+    from ptlib.core.metadata import TimingRings
+    from ptlib.core.worker import Worker
+
+    class Double(pt.AsyncTask):
+        def create_map(self, worker, input_job, output_job):
+            async def job_map(input_job, output_job):
+                # later jobs finish first
+                await asyncio.sleep(0.01 * (5 - input_job["x"][0]))
+                output_job["y"][:] = 2 * input_job["x"]
+            return job_map
+
+    input_q = Queue(JobSpec(name="x", example=np.zeros(1)), capacity=5)
+    output_q = Queue(JobSpec(name="y", example=np.zeros(1)), capacity=5)
+    input_job, output_job = input_q._link_mem(), output_q._link_mem()
+    rings = TimingRings([(0, 0)], ring_size=8)
+    rings._link_mem()
+
+    for i in range(5):
+        input_job["x"][:] = i
+        input_q.put()
+    input_q.close()
+
+    task = Double()
+    worker = Worker(Double, 1, 0, 0, input_q, output_q, rings)
+    worker._run_jobs_async(task, task.create_map(worker, None, None), input_q,
+                           output_q, input_job, output_job, rings, 0)
+
+    # each output job keeps the sequence number of its input job
+    received = list()
+    while output_q.get() is True:
+        received.append((output_q.seq, int(output_job["y"][0])))
+
+    return received, len(rings.drain()[0, 0])
+
+
+@add_test(solutions=[[("x", (3,))]])
+def async_task_infer_test_1():
+    from ptlib.core.job import Job
+
+    # the default job map copies each subjob without changing its shape
+    job_spec, _ = pt.AsyncTask()._infer_structure(
+        Job(JobSpec(name="x", example=np.zeros(3))))
+
+    return [(js.name, tuple(js.shape)) for js in job_spec]
+
+
+@add_test(solutions=[[True] * 3 + [False], [[0, 1], [1, 2], [2, 3]], 1, [[4, 5]], (1, 9)])
+def timing_rings_test_1():
+    from ptlib.core.metadata import TimingRings
+
+    rings = TimingRings([(0, 0), (1, 0)], ring_size=3)
+    rings._link_mem()
+    ring = rings.indices[1, 0]
+
+    # the fourth timing overflows the ring
+    recorded = [rings.record(ring, i, i + 1) for i in range(4)]
+    timings = rings.drain()[1, 0].tolist()
+
+    # draining frees the ring for more timings
+    rings.record(ring, 4, 5)
+    rings.set_lifetime(ring, 1, 9)
+
+    return recorded, timings, rings.get_dropped()[1, 0], \
+        rings.drain()[1, 0].tolist(), rings.get_lifetimes()[1, 0]
+
+
+@add_test(solutions=[[True, False], [[0, 3], [3, 6], [6, 10], [10, 11]], 2, [3, 3], 13])
+def timing_rings_batch_test_1():
+    from ptlib.core.metadata import LatencyHistogram, TimingRings
+
+    rings = TimingRings([(0, 0)], ring_size=4)
+    rings._link_mem()
+
+    # a batch of 3 jobs is recorded as 3 jobs, and only 1 of the next batch
+    # of 3 jobs fits in the ring (but all of them are counted)
+    recorded = [rings.record(0, 0, 10, 3), rings.record(0, 10, 13, 3)]
+    hist = rings.get_histograms()[0, 0]
+    counts = [int(hist.counts[LatencyHistogram.get_index(duration)])
+              for duration in (3, 1)]
+
+    return recorded, rings.drain()[0, 0].tolist(), \
+        rings.get_dropped()[0, 0], counts, hist.total
+
+
+@add_test(solutions=[[False, True, True], False])
+def timing_rings_ready_test_1():
+    from ptlib.core.metadata import TimingRings
+
+    rings = TimingRings([(0, 0)], ring_size=4)
+    rings._link_mem()
+
+    # the controller is woken up once the ring is half full
+    ready = list()
+    for i in range(3):
+        rings.record(0, i, i + 1)
+        ready.append(rings.ready.poll())
+
+    rings.drain()
+
+    return ready, rings.ready.poll()
+
+
+@add_test(solutions=[[(5, 5), (127, 127), (1000, 1007), (999424, 1007615)], [2, 1, 1001998], [[("Task", 0, 3, [999, 1007615, 1007615])]] * 2])
+def latency_histogram_test_1():
+    from ptlib.core.metadata import LatencyHistogram, MetadataManager
+    from ptlib.utils.diagram import Diagram
+
+    # each duration is in a bucket at most 1/64 of it wide
+    lows, highs = LatencyHistogram.get_bounds()
+    bounds = [(int(lows[i]), int(highs[i])) for i in
+              LatencyHistogram.get_index(np.array([5, 127, 1000, 10 ** 6]))]
+
+    # a duration is counted (and summed) even if the ring drops its timing
+    meta_manager = MetadataManager(pt.Task())
+    meta_manager.meta_rings.ring_size = 2
+    for start, finish in [(0, 999), (1000, 1999), (2000, 1002000)]:
+        meta_manager.meta_rings.record(0, start, finish)
+    meta_manager.update()
+    num_jobs = [len(meta_manager._meta[0, 0]) - 1,
+                meta_manager._dropped[0, 0], meta_manager._hists[0].total]
+
+    # the merged histograms match the ones counted from the timings
+    meta_manager._meta[0, 0].extend(np.array([[2000, 1002000]]))
+    diagram = Diagram(meta_manager=meta_manager)
+    stats = [diagram.get_latency_stats()]
+    diagram._hists = None
+    stats.append(diagram.get_latency_stats())
+
+    return bounds, num_jobs, stats
+
+
+@add_test(solutions=[[(True, 5, True)] * 3, [None, None], (3, 600, 6000), [("Task", 0, 3, 200.0, 50.0, 2000.0, [2015, 3007, 3007])]])
+def queue_trace_test_1():
+    from ptlib.core.metadata import MetadataManager
+    from ptlib.utils.diagram import Diagram
+
+    # a job without an origin originates when it is put
+    headers = list()
+    for kwargs in (dict(), dict(spsc=True), dict(local=True)):
+        queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=4,
+                      trace=True, **kwargs)
+        queue._link_mem()
+        queue.put()
+        queue.origin = 5
+        queue.put()
+
+        queue.get()
+        origin, enqueued = queue.origin, queue.enqueued
+        queue.get()
+        headers.append((origin == enqueued, queue.origin,
+                        queue.enqueued >= enqueued))
+
+    # untraced queues have no headers
+    queue = Queue(JobSpec(name="x", example=np.zeros(2)), capacity=4)
+    queue._link_mem()
+    queue.put()
+    queue.get()
+    untraced = [queue.origin, queue.enqueued]
+
+    # traces of single jobs and of batches are merged per task
+    meta_manager = MetadataManager(pt.Task())
+    meta_manager.meta_rings.record(0, 0, 50)
+    meta_manager.meta_rings.record_trace(0, 0, 1000)
+    meta_manager.meta_rings.record_trace(0, np.array([200, 400]),
+                                         np.array([2000, 3000]))
+    meta_manager.update()
+
+    return headers, untraced, meta_manager._traces[0], \
+        Diagram(meta_manager=meta_manager).get_trace_stats()
+
+
+@add_test(solutions=[[("Task: 0", 0, 2, 40, 60)], 3 + 3 * 4096])
+def diagram_get_stats_test_1():
+    from ptlib.core.metadata import MetadataManager
+    from ptlib.utils.diagram import Diagram
+
+    meta_manager = MetadataManager(pt.Task())
+    metadata = meta_manager._meta[0, 0]
+    metadata[0] = (0, 100)
+    metadata.extend(np.array([[10, 20], [30, 60]]))
+
+    stats = [stat[:5] for stat in Diagram(meta_manager=meta_manager).get_stats()]
+
+    # the buffer grows once it runs out of preallocated rows
+    for _ in range(3):
+        metadata.extend(np.zeros((4096, 2), dtype=np.int64) - 1)
+
+    return stats, len(metadata)
+
+
+@add_test(solutions=[[("Task: 0", 0, 2, 40, 60)], True, True])
+def diagram_from_spill_test_1():
+    from tempfile import TemporaryDirectory
+    from ptlib.core.metadata import MetadataManager
+    from ptlib.utils.diagram import Diagram
+
+    with TemporaryDirectory() as spill_dir:
+        meta_manager = MetadataManager(pt.Task(), spill_dir=spill_dir)
+        meta_manager.set_time()
+
+        # timings are appended to the file as they are drained
+        metadata = meta_manager._meta[0, 0]
+        metadata.extend(np.array([[10, 20]]))
+        metadata.extend(np.array([[30, 60]]))
+        metadata[0] = (0, 100)
+        meta_manager.set_time()
+
+        # the files are closed once spilling ends
+        meta_manager.close()
+        is_closed = metadata._file.closed
+
+        diagram = Diagram.from_spill(spill_dir)
+        stats = [stat[:5] for stat in diagram.get_stats()]
+        is_memmap = isinstance(diagram._meta[0, 0][1], np.memmap)
+
+        del diagram, metadata, meta_manager
+
+    return stats, is_memmap, is_closed
+
+
+@add_test(solutions=[['task="Task",task_id="0",le="1e-06"} 1', 'task="Task",task_id="0",le="1.6e-05"} 2', 'task="Task",task_id="0",le="+Inf"} 2', 'task="Task",task_id="0"} 5.01e-06', 'task="Task",task_id="0"} 2', 'task="Task",task_id="0",worker="0"} 2', 'task="Task",task_id="0",worker="0"} 0.501'], True, 404])
+def metrics_exporter_test_1():
+    from tempfile import TemporaryDirectory
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+    from ptlib.core.metadata import MetadataManager
+    from ptlib.utils.exporter import MetricsExporter
+
+    task = pt.Task()
+    meta_manager = MetadataManager(task)
+    meta_manager.meta_rings.set_lifetime(0, 1, 10001)
+    meta_manager.meta_rings.record(0, 10, 20)
+    meta_manager.meta_rings.record(0, 30, 5030)
+    meta_manager.update()
+
+    with TemporaryDirectory() as metrics_dir:
+        path = os.path.join(metrics_dir, "ptlib.prom")
+        exporter = MetricsExporter(port=0, path=path)
+        exporter.export(meta_manager, [task], dict())
+
+        url = f"http://{exporter.HOST}:{exporter.port}"
+        text = urlopen(url + "/metrics").read().decode()
+        in_file = open(path).read() == text
+        try:
+            urlopen(url + "/other")
+        except HTTPError as e:
+            status = e.code
+        exporter.close()
+
+    names = ('ptlib_task_job_duration_seconds_bucket{task="Task",task_id="0",le="1e-06"}',
+             'ptlib_task_job_duration_seconds_bucket{task="Task",task_id="0",le="1.6e-05"}',
+             'ptlib_task_job_duration_seconds_bucket{task="Task",task_id="0",le="+Inf"}',
+             "ptlib_task_job_duration_seconds_sum{",
+             "ptlib_task_job_duration_seconds_count{",
+             "ptlib_worker_jobs_total{", "ptlib_worker_busy_ratio{")
+    samples = [line.split("{", 1)[1] for line in text.splitlines()
+               if line.startswith(names)]
+
+    return samples, in_file, status
+
+
+@add_test(solutions=[[True, False, False]])
+def metrics_controller_test_1():
+    from urllib.error import URLError
+    from urllib.request import urlopen
+
+    class Source(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            x = output_job["x"]
+
+            def job_map():
+                x[:] = np.zeros(2)
+                worker.EXIT_FLAG = True
+
+            return job_map
+
+    class Sink(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            return lambda: None
+
+    def is_served(url):
+        try:
+            return urlopen(url).status == 200
+        except URLError:
+            return False
+
+    # the metrics of a pipeline that is not persistent are served until
+    # the end of its run
+    controller = pt.Controller(Source() >> Sink(), total_jobs=1,
+                               start_method="fork", metrics_port=0)
+    exporter = controller._exporter
+    url = f"http://{exporter.HOST}:{exporter.port}/metrics"
+    served = [is_served(url)]
+    controller.run()
+    served.append(is_served(url))
+    controller.close()
+    served.append(is_served(url))
+
+    return served
+
+
+@add_test(solutions=[[(4,)], [(2, 3)], 1])
+def task_output_spec_test_1():
+    from tempfile import TemporaryDirectory
+
+    class Declared(pt.Task):
+        @classmethod
+        def output_spec(cls):
+            return JobSpec((4,), np.int64, name="x")
+
+        def create_map(self, worker, input_job, output_job):
+            raise RuntimeError("create_map should not run")
+
+    class Inferred(pt.Task):
+        num_maps = 0
+
+        def create_map(self, worker, input_job, output_job):
+            Inferred.num_maps += 1
+            y = output_job["y"]
+
+            def job_map():
+                y[:] = np.zeros((2, 3))
+
+            return job_map
+
+    declared_spec, _ = Declared()._infer_structure(None)
+
+    # the second controller reads the structure of `Inferred` from the cache
+    with TemporaryDirectory() as cache_dir:
+        spec_cache = os.path.join(cache_dir, "specs.pkl")
+        for _ in range(2):
+            controller = pt.Controller(Declared() >> Inferred() >> pt.Task(),
+                                       spec_cache=spec_cache)
+            inferred_spec = controller.pipeline.next.next.input_q.job_spec
+
+    return [tuple(js.shape) for js in declared_spec], \
+        [tuple(js.shape) for js in inferred_spec], Inferred.num_maps
+
+@add_test(solutions=[[(5, 20), (8, 56)]])
+def persistent_controller_test_1():
+    class Source(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            x = output_job["x"]
+
+            def job_map():
+                x[:] = np.full(2, worker.count)
+                worker.count += 1
+                worker.EXIT_FLAG = worker.count >= (worker.inputs or 1)
+
+            return job_map
+
+        def reset(self, worker, inputs):
+            super().reset(worker, inputs)
+            worker.count = 0
+
+    class Double(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            x, y = input_job["x"], output_job["y"]
+
+            def job_map():
+                y[:] = 2 * x
+
+            return job_map
+
+    class Sink(pt.Task):
+        THREADED = True
+        runs = list()
+
+        def create_map(self, worker, input_job, output_job):
+            y = input_job["y"]
+
+            def job_map():
+                Sink.runs[-1].append(int(y[0]))
+
+            return job_map
+
+        def reset(self, worker, inputs):
+            super().reset(worker, inputs)
+            Sink.runs.append(list())
+
+    # the second run starts from the state left by the first one
+    controller = pt.Controller(Source() >> Double(2) >> Sink(), total_jobs=1,
+                               persistent=True, start_method="fork")
+    Sink.runs.clear()
+    for num_jobs in (5, 8):
+        controller.run(num_jobs)
+    controller.close()
+
+    return [(len(run), sum(run)) for run in Sink.runs]
+
+
+@add_test(solutions=[5, False])
+def close_controller_test_1():
+    class Source(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            x = output_job["x"]
+            worker.count = 0
+
+            def job_map():
+                x[:] = np.full(2, worker.count)
+                worker.count += 1
+                worker.EXIT_FLAG = worker.count >= 5
+
+            return job_map
+
+    class Sink(pt.Task):
+        THREADED = True
+        jobs = list()
+
+        def create_map(self, worker, input_job, output_job):
+            x = input_job["x"]
+
+            def job_map():
+                Sink.jobs.append(int(x[0]))
+
+            return job_map
+
+    # closing a pipeline that is not persistent only waits for its workers
+    controller = pt.Controller(Source() >> Sink(), total_jobs=5,
+                               start_method="fork")
+    Sink.jobs.clear()
+    controller.run()
+    controller.close()
+
+    return len(Sink.jobs), any(worker.is_alive()
+                               for task in controller.pipeline.iter_tasks()
+                               for worker in task.workers)
+
+
+@add_test(solutions=[[list(range(20))] * 2])
+def ordered_persistent_test_1():
+    import random
+    import time
+
+    class Source(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            x = output_job["x"]
+
+            def job_map():
+                x[:] = np.full(2, worker.count)
+                worker.count += 1
+                worker.EXIT_FLAG = worker.count >= (worker.inputs or 2) // 2
+
+            return job_map
+
+        def reset(self, worker, inputs):
+            super().reset(worker, inputs)
+            worker.count = 0
+
+    class Jitter(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            x, y = input_job["x"], output_job["y"]
+
+            def job_map():
+                time.sleep(random.random() * 0.002)
+                y[:] = x
+
+            return job_map
+
+    class Sink(pt.Task):
+        ORDERED = True
+        THREADED = True
+        runs = list()
+
+        def create_map(self, worker, input_job, output_job):
+            def job_map():
+                Sink.runs[-1].append(worker.seq)
+
+            return job_map
+
+        def reset(self, worker, inputs):
+            super().reset(worker, inputs)
+            Sink.runs.append(list())
+
+    # the reorder buffer of the sink starts from sequence number 0 every run
+    controller = pt.Controller(Source(2) >> Jitter(3) >> Sink(),
+                               total_jobs=1, persistent=True,
+                               start_method="fork")
+    Sink.runs.clear()
+    for _ in range(2):
+        controller.run(20)
+    controller.close()
+
+    return Sink.runs
+
+
+@add_test(solutions=[30, 1, 1])
+def autoscale_controller_test_1():
+    import time
+
+    class Source(pt.Task):
+        def create_map(self, worker, input_job, output_job):
+            x = output_job["x"]
+            worker.count = 0
+
+            def job_map():
+                # pause between two bursts of jobs
+                if worker.count == 10:
+                    time.sleep(1)
+                x[:] = np.full(2, worker.count)
+                worker.count += 1
+                worker.EXIT_FLAG = worker.count >= 30
+
+            return job_map
+
+    class Scaled(pt.Task):
+        MIN_WORKERS, MAX_WORKERS = 1, 3
+
+        def create_map(self, worker, input_job, output_job):
+            x, y = input_job["x"], output_job["y"]
+
+            def job_map():
+                y[:] = [x[0], worker.id]
+
+            return job_map
+
+    class Sink(pt.Task):
+        THREADED = True
+        received = list()
+
+        def create_map(self, worker, input_job, output_job):
+            y = input_job["y"]
+
+            def job_map():
+                Sink.received.append((int(y[0]), int(y[1])))
+
+            return job_map
+
+    class FastController(pt.Controller):
+        AUTOSCALE_INTERVAL = 0.05
+        SCALE_PATIENCE = 1
+
+    # the idle workers retired during the pause exit before the second
+    # burst, so it is mapped by the only worker left
+    Sink.received.clear()
+    controller = FastController(Source() >> Scaled(3) >> Sink(),
+                                total_jobs=30, start_method="fork")
+    controller.run()
+    scaled = controller.pipeline.next
+
+    return len(Sink.received), \
+        len({worker for x, worker in Sink.received if x >= 10}), \
+        scaled._num_active
+
+
+@add_test(solutions=[[False, True], [1, 2]])
+def autoscale_add_worker_test_1():
+    from multiprocessing import Semaphore
+    from types import SimpleNamespace
+
+    class Scaled(pt.Task):
+        MAX_WORKERS = 2
+
+    # both workers are still running, but one of them took a retirement
+    task = Scaled(2)
+    task.workers = [SimpleNamespace(exitcode=None) for _ in range(2)]
+    task._sem_retire, task._num_active = Semaphore(0), 1
+
+    added, num_active = list(), list()
+    for _ in range(2):
+        added.append(task._add_worker())
+        num_active.append(task._num_active)
+
+        # a retirement that no worker has acted on yet is taken back
+        task._sem_retire.release()
+
+    return added, num_active
+
+
 # ---------------------------------------------------------------------- #
 
 